@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+from numpy.testing import assert_equal
+from theanolm.scoring import SLFLattice, ArrayLattice
+
+class TestArrayLattice(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        lattice_path = os.path.join(script_path, 'lattice.slf')
+        with open(lattice_path) as lattice_file:
+            self.lattice = SLFLattice(lattice_file)
+
+    def tearDown(self):
+        pass
+
+    def test_init(self):
+        lattice = ArrayLattice(self.lattice)
+        self.assertEqual(lattice.num_nodes(), 24)
+        self.assertEqual(lattice.num_links(), 39)
+        self.assertEqual(lattice.utterance_id, self.lattice.utterance_id)
+        self.assertEqual(lattice.initial_node_id, self.lattice.initial_node.id)
+        self.assertEqual(lattice.final_node_id, self.lattice.final_node.id)
+
+        for node in self.lattice.nodes:
+            link_indices = lattice.out_links(node.id)
+            self.assertEqual(len(link_indices), len(node.out_links))
+            for index, link in zip(link_indices, node.out_links):
+                self.assertEqual(lattice.link_starts[index], node.id)
+                self.assertEqual(lattice.link_ends[index], link.end_node.id)
+                self.assertEqual(lattice.words[lattice.link_words[index]],
+                                 link.word)
+                self.assertEqual(lattice.link_ac_logprobs[index],
+                                 link.ac_logprob)
+                self.assertEqual(lattice.link_lm_logprobs[index],
+                                 link.lm_logprob)
+
+    def test_sorted_node_ids(self):
+        lattice = ArrayLattice(self.lattice)
+        sorted_ids = [node.id for node in self.lattice.sorted_nodes()]
+        assert_equal(lattice.sorted_node_ids, sorted_ids)
+
+    def test_node_time(self):
+        lattice = ArrayLattice(self.lattice)
+        for node in self.lattice.nodes:
+            self.assertEqual(lattice.node_time(node.id), node.time)
+        self.lattice.nodes[1].time = None
+        lattice = ArrayLattice(self.lattice)
+        self.assertIsNone(lattice.node_time(1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import json
+from theanolm.scoring.decodingstatistics import DecodingStatistics
+
+class TestDecodingStatistics(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_add_nn_call(self):
+        stats = DecodingStatistics()
+        stats.add_nn_call(1, 0.5)
+        stats.add_nn_call(3, 0.25)
+        stats.add_nn_call(4, 0.25)
+        stats.add_nn_call(5, 0.5)
+        self.assertEqual(stats.nn_calls, 4)
+        self.assertEqual(stats.nn_evaluations, 13)
+        self.assertEqual(stats.nn_time, 1.5)
+        self.assertDictEqual(stats.batch_sizes, {1: 1, 4: 2, 8: 1})
+
+    def test_to_dict(self):
+        stats = DecodingStatistics()
+        stats.reset(10, 20)
+        stats.add_nn_call(2, 1.0)
+        stats.decode_time = 3.0
+        result = stats.to_dict()
+        self.assertEqual(result['nodes'], 10)
+        self.assertEqual(result['links'], 20)
+        self.assertDictEqual(result['batch_sizes'], {'2': 1})
+        self.assertEqual(result['python_time'], 2.0)
+        # The result can be serialized to JSON.
+        self.assertDictEqual(json.loads(json.dumps(result)), result)
+
+        stats.reset()
+        self.assertEqual(stats.nn_calls, 0)
+        self.assertDictEqual(stats.batch_sizes, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -204,5 +204,45 @@ class TestIterators(unittest.TestCase):
                                     1, 1, 1,
                                     1, 1, 1, 1, 1])
 
+    def test_sorted_linear_batch_iterator(self):
+        iterator = theanolm.LinearBatchIterator([self.sentences1_file,
+                                                 self.sentences2_file],
+                                                self.vocabulary,
+                                                batch_size=2,
+                                                sort_window=2)
+        self.assertEqual(len(iterator), 5)
+        for _ in range(2):
+            all_indices = []
+            sentences = dict()
+            for word_ids, file_ids, mask in iterator:
+                all_indices.append(iterator.sequence_indices)
+                for sequence, index in enumerate(iterator.sequence_indices):
+                    sequence_mask = mask[:,sequence]
+                    sequence_word_ids = word_ids[sequence_mask != 0,sequence]
+                    sentences[index] = \
+                        ' '.join(self.vocabulary.id_to_word[sequence_word_ids])
+            self.assertEqual(all_indices, [[3, 0], [1, 2], [4, 7], [5, 6],
+                                           [8, 9]])
+            self.assertEqual(' '.join(sentences[index] for index in range(10)),
+                             '<s> yksi kaksi </s> '
+                             '<s> kolme neljä viisi </s> '
+                             '<s> kuusi seitsemän kahdeksan </s> '
+                             '<s> yhdeksän </s> '
+                             '<s> kymmenen </s> '
+                             '<s> kymmenen yhdeksän </s> '
+                             '<s> kahdeksan seitsemän kuusi </s> '
+                             '<s> viisi </s> '
+                             '<s> neljä </s> '
+                             '<s> kolme kaksi yksi </s>')
+            self.assertAlmostEqual(iterator.padding_ratio(), 4 / 44)
+
+        iterator = theanolm.LinearBatchIterator([self.sentences1_file,
+                                                 self.sentences2_file],
+                                                self.vocabulary,
+                                                batch_size=2)
+        for _ in iterator:
+            pass
+        self.assertAlmostEqual(iterator.padding_ratio(), 8 / 48)
+
 if __name__ == '__main__':
     unittest.main()
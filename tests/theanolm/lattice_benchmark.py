@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Measures the throughput of the SLF lattice parser.
+
+Generates a random lattice with the given number of links and reads it using
+both the regular expression based line splitter and the ``shlex`` based
+splitter. Usage:
+
+    python3 tests/theanolm/lattice_benchmark.py [NUM-LINKS]
+"""
+
+import sys
+import io
+import random
+import timeit
+from theanolm.scoring import SLFLattice
+
+def generate_lattice(num_links, words_per_node=4):
+    """Generates an SLF lattice with random words and scores.
+
+    :type num_links: int
+    :param num_links: number of links in the lattice
+
+    :type words_per_node: int
+    :param words_per_node: number of links that start from each node
+
+    :rtype: str
+    :returns: the lattice in SLF format
+    """
+
+    random.seed(1)
+    vocabulary = ['word{}'.format(index) for index in range(1000)]
+    num_nodes = num_links // words_per_node + 2
+    lines = ['VERSION=1.0',
+             'UTTERANCE="benchmark utterance"',
+             'lmscale=14.00 wdpenalty=0.00',
+             'base=10.0',
+             'start=0 end={}'.format(num_nodes - 1),
+             'NODES={} LINKS={}'.format(num_nodes, num_links)]
+    for node_id in range(num_nodes):
+        lines.append('I={}\tt={:.2f}'.format(node_id, node_id * 0.01))
+    for link_id in range(num_links):
+        start_id = min(link_id // words_per_node, num_nodes - 2)
+        end_id = min(start_id + random.randint(1, 3), num_nodes - 1)
+        lines.append('J={}\tS={}\tE={}\tW={}\ta={:.3f}\tl={:.3f}'.format(
+            link_id, start_id, end_id, random.choice(vocabulary),
+            -random.random() * 1000, -random.random() * 10))
+    return '\n'.join(lines) + '\n'
+
+def main():
+    num_links = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    text = generate_lattice(num_links)
+
+    def read_lattice():
+        SLFLattice(io.StringIO(text))
+
+    seconds = min(timeit.repeat(read_lattice, number=1, repeat=3))
+    print("Regular expressions: {:.2f} s, {:.0f} links/s".format(
+          seconds, num_links / seconds))
+
+    fast_split = SLFLattice._split_slf_line
+    SLFLattice._split_slf_line = SLFLattice._split_slf_line_shlex
+    try:
+        seconds = min(timeit.repeat(read_lattice, number=1, repeat=3))
+    finally:
+        SLFLattice._split_slf_line = fast_split
+    print("shlex: {:.2f} s, {:.0f} links/s".format(
+          seconds, num_links / seconds))
+
+if __name__ == '__main__':
+    main()
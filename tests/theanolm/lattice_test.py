@@ -3,6 +3,7 @@
 
 import unittest
 import os
+import io
 import math
 from theanolm.scoring.lattice import Lattice
 from theanolm.scoring.slflattice import SLFLattice
@@ -26,6 +27,43 @@ class TestLattice(unittest.TestCase):
         self.assertEqual(fields[2], 'WORD="QUOTE')
         self.assertEqual(fields[3], "WORD='CAUSE")
 
+        # The regular expression parser gives the same result as shlex.
+        lines = ['J=0 S=0 E=1 W=<s> a=-8.0 l=-1.5\n',
+                 'I=3\tt=0.25  W="wo rd"\r\n',
+                 'UTTERANCE="utt 1" lmscale=14.0\n',
+                 'W=""  W=a"b c"d W=\'\' W=x\'\n',
+                 '\n']
+        for line in lines:
+            self.assertListEqual(lattice._split_slf_line(line),
+                                 lattice._split_slf_line_shlex(line))
+        with self.assertRaises(ValueError):
+            lattice._split_slf_line('W="QUOTE')
+
+    def test_write(self):
+        with open(self.lattice_path, 'r') as lattice_file:
+            lattice = SLFLattice(lattice_file)
+        lattice.links[1].word = 'wo "rd'
+        lattice_file = io.StringIO()
+        lattice.write(lattice_file, log_base=10)
+        lattice_file.seek(0)
+        new_lattice = SLFLattice(lattice_file)
+        self.assertEqual(new_lattice.utterance_id, lattice.utterance_id)
+        self.assertAlmostEqual(new_lattice.lm_scale, lattice.lm_scale)
+        self.assertEqual(len(new_lattice.nodes), len(lattice.nodes))
+        self.assertEqual(len(new_lattice.links), len(lattice.links))
+        self.assertEqual(new_lattice.initial_node.id, lattice.initial_node.id)
+        self.assertEqual(new_lattice.final_node.id, lattice.final_node.id)
+        for node, new_node in zip(lattice.nodes, new_lattice.nodes):
+            self.assertEqual(new_node.time, node.time)
+        for link, new_link in zip(lattice.links, new_lattice.links):
+            self.assertEqual(new_link.start_node.id, link.start_node.id)
+            self.assertEqual(new_link.end_node.id, link.end_node.id)
+            self.assertEqual(new_link.word, link.word)
+            self.assertAlmostEqual(new_link.ac_logprob, link.ac_logprob,
+                                   places=3)
+            self.assertAlmostEqual(new_link.lm_logprob, link.lm_logprob,
+                                   places=3)
+
     def test_split_slf_field(self):
         lattice = SLFLattice(None)
         name, value = lattice._split_slf_field("name=va 'lue")
@@ -126,11 +164,11 @@ class TestLattice(unittest.TestCase):
         lattice.nodes[4].word = 'E'
         lattice.initial_node = lattice.nodes[0]
         lattice.final_node = lattice.nodes[4]
-        lattice._add_link(lattice.nodes[0], lattice.nodes[1])
-        lattice._add_link(lattice.nodes[0], lattice.nodes[2])
-        lattice._add_link(lattice.nodes[1], lattice.nodes[3])
-        lattice._add_link(lattice.nodes[2], lattice.nodes[3])
-        lattice._add_link(lattice.nodes[3], lattice.nodes[4])
+        lattice.add_link(lattice.nodes[0], lattice.nodes[1])
+        lattice.add_link(lattice.nodes[0], lattice.nodes[2])
+        lattice.add_link(lattice.nodes[1], lattice.nodes[3])
+        lattice.add_link(lattice.nodes[2], lattice.nodes[3])
+        lattice.add_link(lattice.nodes[3], lattice.nodes[4])
         lattice._move_words_to_links()
         self.assertEqual(lattice.links[0].word, 'B')
         self.assertEqual(lattice.links[1].word, 'C')
@@ -140,6 +178,107 @@ class TestLattice(unittest.TestCase):
         for node in lattice.nodes:
             self.assertFalse(hasattr(node, 'word'))
 
+        # Long lattices don't exceed the recursion limit.
+        lattice = SLFLattice(None)
+        num_nodes = 5000
+        lattice.nodes = [Lattice.Node(id) for id in range(num_nodes)]
+        for node in lattice.nodes:
+            node.word = str(node.id)
+        lattice.initial_node = lattice.nodes[0]
+        lattice.final_node = lattice.nodes[-1]
+        for id in range(num_nodes - 1):
+            lattice.add_link(lattice.nodes[id], lattice.nodes[id + 1])
+        lattice._move_words_to_links()
+        self.assertEqual(lattice.links[-1].word, str(num_nodes - 1))
+
+    def test_add_link(self):
+        lattice = SLFLattice(None)
+        node1 = lattice.add_node()
+        node2 = lattice.add_node(1.5)
+        self.assertListEqual(lattice.nodes, [node1, node2])
+        self.assertEqual(node1.id, 0)
+        self.assertEqual(node2.id, 1)
+        self.assertIsNone(node1.time)
+        self.assertEqual(node2.time, 1.5)
+        link = lattice.add_link(node1, node2)
+        self.assertListEqual(lattice.links, [link])
+        self.assertIs(link.start_node, node1)
+        self.assertIs(link.end_node, node2)
+        self.assertListEqual(node1.out_links, [link])
+        self.assertListEqual(node2.in_links, [link])
+
+    def test_prune_by_posterior(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        lattice_path = os.path.join(script_path, 'lattice.slf')
+        with open(lattice_path) as lattice_file:
+            lattice = SLFLattice(lattice_file)
+        self.assertEqual(lattice.prune_by_posterior(0.0), 0)
+        self.assertEqual(len(lattice.links), 39)
+        self.assertEqual(len(lattice.nodes), 24)
+
+        num_removed = lattice.prune_by_posterior(0.001)
+        self.assertEqual(len(lattice.links), 39 - num_removed)
+        self.assertLess(len(lattice.links), 39)
+        for id, node in enumerate(lattice.nodes):
+            self.assertEqual(node.id, id)
+        self.assertEqual(len(lattice.sorted_nodes()), len(lattice.nodes))
+
+        # Only the best path is left, if the threshold is higher than one.
+        lattice.prune_by_posterior(2.0)
+        words = [link.word for link in lattice.links]
+        self.assertListEqual(
+            words, ['!ENTER', 'IT', "DIDN'T", 'ELABORATE', '!EXIT'])
+        self.assertEqual(len(lattice.nodes), 6)
+        self.assertEqual(lattice.initial_node.id, 0)
+        self.assertEqual(lattice.final_node.id, 5)
+
+    def test_merge_equivalent_nodes(self):
+        def word_sequences(lattice):
+            result = set()
+            stack = [(lattice.initial_node, ())]
+            while stack:
+                node, words = stack.pop()
+                if node is lattice.final_node:
+                    result.add(words)
+                for link in node.out_links:
+                    stack.append((link.end_node, words + (link.word,)))
+            return result
+
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        lattice_path = os.path.join(script_path, 'lattice.slf')
+        with open(lattice_path) as lattice_file:
+            lattice = SLFLattice(lattice_file)
+        sequences = word_sequences(lattice)
+        num_removed = lattice.merge_equivalent_nodes()
+        self.assertGreater(num_removed, 0)
+        self.assertEqual(len(lattice.nodes), 24 - num_removed)
+        self.assertSetEqual(word_sequences(lattice), sequences)
+        for id, node in enumerate(lattice.nodes):
+            self.assertEqual(node.id, id)
+        self.assertEqual(len(lattice.sorted_nodes()), len(lattice.nodes))
+
+        # Parallel links with the same word are merged, keeping the best one.
+        lattice = Lattice()
+        lattice.nodes = [Lattice.Node(id) for id in range(4)]
+        lattice.initial_node = lattice.nodes[0]
+        lattice.final_node = lattice.nodes[3]
+        link = lattice.add_link(lattice.nodes[0], lattice.nodes[1])
+        link.word = 'A'
+        link.ac_logprob = -10.0
+        link = lattice.add_link(lattice.nodes[0], lattice.nodes[2])
+        link.word = 'A'
+        link.ac_logprob = -5.0
+        link = lattice.add_link(lattice.nodes[1], lattice.nodes[3])
+        link.word = 'B'
+        link.ac_logprob = -1.0
+        link = lattice.add_link(lattice.nodes[2], lattice.nodes[3])
+        link.word = 'B'
+        link.ac_logprob = -2.0
+        self.assertEqual(lattice.merge_equivalent_nodes(), 1)
+        self.assertEqual(len(lattice.links), 2)
+        self.assertEqual(lattice.initial_node.out_links[0].ac_logprob, -5.0)
+        self.assertEqual(lattice.final_node.in_links[0].ac_logprob, -1.0)
+
     def test_sorted_nodes(self):
         lattice = Lattice()
         lattice.nodes = [Lattice.Node(id) for id in range(9)]
@@ -152,18 +291,18 @@ class TestLattice(unittest.TestCase):
         lattice.nodes[6].time = 5.0
         lattice.nodes[7].time = None
         lattice.nodes[8].time = -1.0
-        lattice._add_link(lattice.nodes[0], lattice.nodes[2])
-        lattice._add_link(lattice.nodes[0], lattice.nodes[4])
-        lattice._add_link(lattice.nodes[2], lattice.nodes[3])
-        lattice._add_link(lattice.nodes[4], lattice.nodes[3])
-        lattice._add_link(lattice.nodes[2], lattice.nodes[5])
-        lattice._add_link(lattice.nodes[3], lattice.nodes[5])
-        lattice._add_link(lattice.nodes[5], lattice.nodes[1])
-        lattice._add_link(lattice.nodes[5], lattice.nodes[6])
-        lattice._add_link(lattice.nodes[5], lattice.nodes[7])
-        lattice._add_link(lattice.nodes[1], lattice.nodes[8])
-        lattice._add_link(lattice.nodes[6], lattice.nodes[8])
-        lattice._add_link(lattice.nodes[7], lattice.nodes[8])
+        lattice.add_link(lattice.nodes[0], lattice.nodes[2])
+        lattice.add_link(lattice.nodes[0], lattice.nodes[4])
+        lattice.add_link(lattice.nodes[2], lattice.nodes[3])
+        lattice.add_link(lattice.nodes[4], lattice.nodes[3])
+        lattice.add_link(lattice.nodes[2], lattice.nodes[5])
+        lattice.add_link(lattice.nodes[3], lattice.nodes[5])
+        lattice.add_link(lattice.nodes[5], lattice.nodes[1])
+        lattice.add_link(lattice.nodes[5], lattice.nodes[6])
+        lattice.add_link(lattice.nodes[5], lattice.nodes[7])
+        lattice.add_link(lattice.nodes[1], lattice.nodes[8])
+        lattice.add_link(lattice.nodes[6], lattice.nodes[8])
+        lattice.add_link(lattice.nodes[7], lattice.nodes[8])
         lattice.initial_node = lattice.nodes[0]
         lattice.final_node = lattice.nodes[8]
 
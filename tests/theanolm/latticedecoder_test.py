@@ -4,14 +4,17 @@
 import unittest
 import math
 import os
+import io
 import numpy
 from numpy.testing import assert_equal, assert_almost_equal
 import theano
 from theano import tensor
 from theanolm import Vocabulary
-from theanolm.network import RecurrentState
-from theanolm.scoring import LatticeDecoder, SLFLattice
+from theanolm.scoring import LatticeDecoder, SLFLattice, ArrayLattice
 from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.timeindex import TimeIndex
+from theanolm.scoring.statearena import StateArena
+from theanolm.scoring.decodingstatistics import DecodingStatistics
 
 class DummyNetwork(object):
     def __init__(self, vocabulary, projection_vector):
@@ -36,14 +39,13 @@ class DummyNetwork(object):
                                 ndim=2)
         return result
 
+    def target_logprobs(self):
+        return tensor.log(self.target_probs())
+
 class DummyLatticeDecoder(LatticeDecoder):
     def __init__(self):
-        self._sorted_nodes = [Lattice.Node(id) for id in range(5)]
-        self._sorted_nodes[0].time = 0.0
-        self._sorted_nodes[1].time = 1.0
-        self._sorted_nodes[2].time = 1.0
-        self._sorted_nodes[3].time = None
-        self._sorted_nodes[4].time = 3.0
+        self._sorted_node_ids = list(range(5))
+        self._node_times = [0.0, 1.0, 1.0, None, 3.0]
         self._tokens = [[LatticeDecoder.Token()],
                         [LatticeDecoder.Token()],
                         [LatticeDecoder.Token(), LatticeDecoder.Token(), LatticeDecoder.Token()],
@@ -51,20 +53,27 @@ class DummyLatticeDecoder(LatticeDecoder):
                         []]
         self._tokens[0][0].total_logprob = -10.0
         self._tokens[0][0].recombination_hash = 1
-        self._sorted_nodes[0].best_logprob = -10.0
         self._tokens[1][0].total_logprob = -20.0
         self._tokens[1][0].recombination_hash = 1
-        self._sorted_nodes[1].best_logprob = -20.0
         self._tokens[2][0].total_logprob = -30.0
         self._tokens[2][0].recombination_hash = 1
         self._tokens[2][1].total_logprob = -50.0
         self._tokens[2][1].recombination_hash = 2
         self._tokens[2][2].total_logprob = -70.0
         self._tokens[2][2].recombination_hash = 3
-        self._sorted_nodes[2].best_logprob = -30.0
         self._tokens[3][0].total_logprob = -100.0
         self._tokens[3][0].recombination_hash = 1
-        self._sorted_nodes[3].best_logprob = -100.0
+        self._best_logprobs = [-10.0, -20.0, -30.0, -100.0, None]
+        self._states = StateArena([3])
+        self._tightened_beam = None
+        self._tightened_max_tokens = None
+        self._max_tokens_per_frame = None
+        self._build_lattice = False
+        self.stats = DecodingStatistics()
+        self._time_index = TimeIndex(self._sorted_node_ids, self._node_times)
+        for node_id, best_logprob in enumerate(self._best_logprobs):
+            if not best_logprob is None:
+                self._time_index.update(node_id, best_logprob)
 
 class TestLatticeDecoder(unittest.TestCase):
     def setUp(self):
@@ -95,14 +104,85 @@ class TestLatticeDecoder(unittest.TestCase):
         with open(lattice_path) as lattice_file:
             self.lattice = SLFLattice(lattice_file)
 
+        # A network that gives the same probability to every word in the test
+        # lattice.
+        self.lattice_vocabulary = Vocabulary.from_word_counts({
+            'TO': 1,
+            'AND': 1,
+            'IT': 1,
+            'BUT': 1,
+            'A.': 1,
+            'IN': 1,
+            'A': 1,
+            'AT': 1,
+            'THE': 1,
+            "DIDN'T": 1,
+            'ELABORATE': 1})
+        projection_vector = tensor.ones(
+            shape=(self.lattice_vocabulary.num_words(),),
+            dtype=theano.config.floatX)
+        projection_vector *= 0.05
+        self.lattice_network = DummyNetwork(self.lattice_vocabulary,
+                                            projection_vector)
+        self.all_paths = ["<s> IT DIDN'T ELABORATE </s>",
+                          "<s> BUT IT DIDN'T ELABORATE </s>",
+                          "<s> THE DIDN'T ELABORATE </s>",
+                          "<s> AND IT DIDN'T ELABORATE </s>",
+                          "<s> E. DIDN'T ELABORATE </s>",
+                          "<s> IN IT DIDN'T ELABORATE </s>",
+                          "<s> A DIDN'T ELABORATE </s>",
+                          "<s> AT IT DIDN'T ELABORATE </s>",
+                          "<s> IT IT DIDN'T ELABORATE </s>",
+                          "<s> TO IT DIDN'T ELABORATE </s>",
+                          "<s> A. IT DIDN'T ELABORATE </s>",
+                          "<s> A IT DIDN'T ELABORATE </s>"]
+
     def tearDown(self):
         pass
 
+    def _decoding_options(self, **options):
+        """Returns the decoding options that are used by default, with the
+        given options overridden.
+        """
+
+        result = {
+            'nnlm_weight': 1.0,
+            'lm_scale': None,
+            'wi_penalty': None,
+            'ignore_unk': False,
+            'unk_penalty': None,
+            'linear_interpolation': False,
+            'max_tokens_per_node': None,
+            'max_tokens_per_frame': None,
+            'beam': None,
+            'recombination_order': None,
+            'max_batch_size': None,
+            'frontier_batching': False,
+            'cache_size': None,
+            'early_pruning': False,
+            'max_nnlm_evaluations': None,
+            'max_decoding_time': None,
+            'build_lattice': False
+        }
+        result.update(options)
+        return result
+
+    def _decode_paths(self, decoding_options):
+        """Decodes the test lattice and returns the decoder and the word
+        sequences of the final tokens.
+        """
+
+        decoder = LatticeDecoder(self.lattice_network, decoding_options)
+        tokens = decoder.decode(self.lattice)
+        paths = [' '.join(token.history_words(self.lattice_vocabulary))
+                 for token in tokens]
+        return decoder, tokens, paths
+
     def test_copy_token(self):
         history = [1, 2, 3]
         token1 = LatticeDecoder.Token(history)
         token2 = LatticeDecoder.Token.copy(token1)
-        token2.history.append(4)
+        token2.append_word(4)
         self.assertSequenceEqual(token1.history, [1, 2, 3])
         self.assertSequenceEqual(token2.history, [1, 2, 3, 4])
 
@@ -164,35 +244,24 @@ class TestLatticeDecoder(unittest.TestCase):
         assert_almost_equal(token.total_logprob, -2001.64263, decimal=4)
 
     def test_append_word(self):
-        decoding_options = {
-            'nnlm_weight': 1.0,
-            'lm_scale': 1.0,
-            'wi_penalty': 0.0,
-            'ignore_unk': False,
-            'unk_penalty': 0.0,
-            'linear_interpolation': False,
-            'max_tokens_per_node': 10,
-            'beam': None,
-            'recombination_order': None
-        }
-
-        initial_state = RecurrentState(self.network.recurrent_state_size)
-        token1 = LatticeDecoder.Token(history=[self.sos_id], state=initial_state)
-        token2 = LatticeDecoder.Token(history=[self.sos_id, self.yksi_id], state=initial_state)
+        decoding_options = self._decoding_options(max_tokens_per_node=10)
         decoder = LatticeDecoder(self.network, decoding_options)
+        states = decoder._states
+        token1 = LatticeDecoder.Token(history=[self.sos_id], state=states.initial_state())
+        token2 = LatticeDecoder.Token(history=[self.sos_id, self.yksi_id], state=states.initial_state())
 
         self.assertSequenceEqual(token1.history, [self.sos_id])
         self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id])
-        assert_equal(token1.state.get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
-        assert_equal(token2.state.get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(states.get(token1.state).get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(states.get(token2.state).get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
         self.assertEqual(token1.nn_lm_logprob, 0.0)
         self.assertEqual(token2.nn_lm_logprob, 0.0)
 
         decoder._append_word([token1, token2], self.kaksi_id)
         self.assertSequenceEqual(token1.history, [self.sos_id, self.kaksi_id])
         self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id, self.kaksi_id])
-        assert_equal(token1.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
-        assert_equal(token2.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(states.get(token1.state).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(states.get(token2.state).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
         token1_nn_lm_logprob = math.log(self.sos_prob + self.kaksi_prob)
         token2_nn_lm_logprob = math.log(self.yksi_prob + self.kaksi_prob)
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
@@ -201,8 +270,8 @@ class TestLatticeDecoder(unittest.TestCase):
         decoder._append_word([token1, token2], self.eos_id)
         self.assertSequenceEqual(token1.history, [self.sos_id, self.kaksi_id, self.eos_id])
         self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id])
-        assert_equal(token1.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
-        assert_equal(token2.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
+        assert_equal(states.get(token1.state).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
+        assert_equal(states.get(token2.state).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
         token1_nn_lm_logprob += math.log(self.kaksi_prob + self.eos_prob)
         token2_nn_lm_logprob += math.log(self.kaksi_prob + self.eos_prob)
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
@@ -214,6 +283,61 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertAlmostEqual(token1.total_logprob, token1_nn_lm_logprob * lm_scale - 0.03)
         self.assertAlmostEqual(token2.total_logprob, token2_nn_lm_logprob * lm_scale - 0.04)
 
+        # The vectorized computation gives the same result.
+        token3 = LatticeDecoder.Token.copy(token1)
+        token3.lat_lm_logprob = -3.0
+        decoder._nnlm_weight = 0.25
+        for linear in (False, True):
+            decoder._linear_interpolation = linear
+            decoder._recompute_totals([token3], lm_scale, -0.01)
+            total_logprob = token3.total_logprob
+            token3.recompute_total(0.25, lm_scale, -0.01, linear)
+            self.assertAlmostEqual(total_logprob, token3.total_logprob, places=5)
+
+    def test_append_words(self):
+        decoding_options = self._decoding_options(max_tokens_per_node=10)
+        decoder = LatticeDecoder(self.network, decoding_options)
+        states = decoder._states
+        token1 = LatticeDecoder.Token(history=[self.sos_id], state=states.initial_state())
+        token2 = LatticeDecoder.Token(history=[self.sos_id], state=states.initial_state())
+        token3 = LatticeDecoder.Token(history=[self.sos_id, self.yksi_id], state=states.initial_state())
+
+        decoder._append_words([token1, token2, token3],
+                              [self.yksi_id, self.kaksi_id, self.eos_id])
+        self.assertSequenceEqual(token1.history, [self.sos_id, self.yksi_id])
+        self.assertSequenceEqual(token2.history, [self.sos_id, self.kaksi_id])
+        self.assertSequenceEqual(token3.history, [self.sos_id, self.yksi_id, self.eos_id])
+        assert_equal(states.get(token1.state).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(states.get(token3.state).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        self.assertAlmostEqual(token1.nn_lm_logprob, math.log(self.sos_prob + self.yksi_prob))
+        self.assertAlmostEqual(token2.nn_lm_logprob, math.log(self.sos_prob + self.kaksi_prob))
+        self.assertAlmostEqual(token3.nn_lm_logprob, math.log(self.yksi_prob + self.eos_prob))
+        # The initial states have been released.
+        self.assertEqual(len(states), 3)
+
+    def test_cache(self):
+        decoding_options = self._decoding_options(recombination_order=1,
+                                                  cache_size=2)
+        decoder = LatticeDecoder(self.network, decoding_options)
+
+        states = decoder._states
+        token1 = LatticeDecoder.Token(history=[self.sos_id], state=states.initial_state())
+        token2 = LatticeDecoder.Token(history=[self.sos_id, self.yksi_id], state=states.initial_state())
+        token3 = LatticeDecoder.Token(history=[self.kaksi_id, self.yksi_id], state=states.initial_state())
+        decoder._append_words([token1, token2, token3],
+                              [self.kaksi_id, self.eos_id, self.eos_id])
+        self.assertEqual(decoder._cache.hits, 0)
+        self.assertEqual(decoder._cache.misses, 3)
+        self.assertEqual(len(decoder._cache), 2)
+        self.assertAlmostEqual(token3.nn_lm_logprob, token2.nn_lm_logprob)
+
+        token4 = LatticeDecoder.Token(history=[self.sos_id, self.yksi_id], state=states.initial_state())
+        decoder._append_words([token4], [self.eos_id])
+        self.assertEqual(decoder._cache.hits, 1)
+        self.assertAlmostEqual(token4.nn_lm_logprob, token2.nn_lm_logprob)
+        self.assertEqual(token4.state, token2.state)
+        self.assertSequenceEqual(token4.history, [self.sos_id, self.yksi_id, self.eos_id])
+
     def test_prune(self):
         # token recombination
         decoder = DummyLatticeDecoder()
@@ -223,11 +347,11 @@ class TestLatticeDecoder(unittest.TestCase):
         decoder._tokens[2][0].recombination_hash = 2
         decoder._tokens[2][1].recombination_hash = 2
         decoder._tokens[2][2].recombination_hash = 3
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 2)
         decoder._tokens[2][0].recombination_hash = 4
         decoder._tokens[2][1].recombination_hash = 4
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 1)
 
         # beam pruning
@@ -236,27 +360,27 @@ class TestLatticeDecoder(unittest.TestCase):
         decoder._recombination_order = None
         # best_logprob = -20
         decoder._beam = 60
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 3)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
         self.assertEqual(decoder._tokens[2][1].total_logprob, -50)
         self.assertEqual(decoder._tokens[2][2].total_logprob, -70)
         decoder._beam = 50
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 2)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
         self.assertEqual(decoder._tokens[2][1].total_logprob, -50)
         decoder._beam = 31
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 2)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
         self.assertEqual(decoder._tokens[2][1].total_logprob, -50)
         decoder._beam = 15
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 1)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
         decoder._beam = 0
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 1)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
 
@@ -265,52 +389,115 @@ class TestLatticeDecoder(unittest.TestCase):
         decoder._beam = None
         decoder._recombination_order = None
         decoder._max_tokens_per_node = 3
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 3)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
         self.assertEqual(decoder._tokens[2][1].total_logprob, -50)
         self.assertEqual(decoder._tokens[2][2].total_logprob, -70)
         decoder._max_tokens_per_node = 2
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 2)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
         self.assertEqual(decoder._tokens[2][1].total_logprob, -50)
         decoder._max_tokens_per_node = 1
-        decoder._prune(decoder._sorted_nodes[2])
+        decoder._prune(2)
         self.assertEqual(len(decoder._tokens[2]), 1)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
 
-    def test_decode(self):
-        vocabulary = Vocabulary.from_word_counts({
-            'TO': 1,
-            'AND': 1,
-            'IT': 1,
-            'BUT': 1,
-            'A.': 1,
-            'IN': 1,
-            'A': 1,
-            'AT': 1,
-            'THE': 1,
-            "DIDN'T": 1,
-            'ELABORATE': 1})
-        projection_vector = tensor.ones(shape=(vocabulary.num_words(),),
-                                        dtype=theano.config.floatX)
-        projection_vector *= 0.05
-        network = DummyNetwork(vocabulary, projection_vector)
+    def test_prune_frames(self):
+        # Nodes 1 and 2 are at the same time.
+        decoder = DummyLatticeDecoder()
+        decoder._beam = None
+        decoder._recombination_order = None
+        decoder._max_tokens_per_node = None
+        decoder._max_tokens_per_frame = 3
+        decoder._init_frames()
+        decoder._prune(1)
+        self.assertEqual(len(decoder._tokens[1]), 1)
+        decoder._prune(2)
+        self.assertEqual(len(decoder._tokens[2]), 2)
+        self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
+        self.assertEqual(decoder._tokens[2][1].total_logprob, -50)
+        decoder = DummyLatticeDecoder()
+        decoder._beam = None
+        decoder._recombination_order = None
+        decoder._max_tokens_per_node = None
+        decoder._max_tokens_per_frame = 1
+        decoder._init_frames()
+        decoder._prune(2)
+        self.assertEqual(len(decoder._tokens[2]), 1)
+        self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
+        # At least one token is kept at each node.
+        decoder._prune(1)
+        self.assertEqual(len(decoder._tokens[1]), 1)
+        # Tokens that are added after initialization compete for the frame,
+        # after recombination.
+        decoder = DummyLatticeDecoder()
+        decoder._beam = None
+        decoder._recombination_order = None
+        decoder._max_tokens_per_node = None
+        decoder._max_tokens_per_frame = 4
+        decoder._init_frames()
+        frame = decoder._frames[1.0]
+        self.assertDictEqual(frame.node_scores(1), {1: -20})
+        self.assertDictEqual(frame.node_scores(2), {1: -30, 2: -50, 3: -70})
+        self.assertEqual(frame.num_pending, 4)
+        new_tokens = []
+        for logprob in [-12.0, -10.0]:
+            token = LatticeDecoder.Token()
+            token.total_logprob = logprob
+            token.recombination_hash = 2
+            new_tokens.append(token)
+        decoder._tokens[1].extend(new_tokens)
+        decoder._add_frame_tokens(1, new_tokens)
+        self.assertDictEqual(frame.node_scores(1), {1: -20, 2: -10})
+        self.assertEqual(frame.num_pending, 5)
+        # The token with -12 will be recombined, so the best four scores in the
+        # frame are -10, -20, -30, and -50.
+        decoder._prune(2)
+        self.assertEqual(len(decoder._tokens[2]), 2)
+        self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
+        self.assertEqual(decoder._tokens[2][1].total_logprob, -50)
+        self.assertEqual(frame.num_kept, 2)
+        self.assertEqual(frame.num_pending, 2)
+        decoder._prune(1)
+        self.assertEqual(len(decoder._tokens[1]), 2)
+        self.assertEqual(decoder._tokens[1][0].total_logprob, -10)
+        self.assertEqual(decoder._tokens[1][1].total_logprob, -20)
+        self.assertEqual(frame.num_kept, 4)
+        self.assertEqual(frame.num_pending, 0)
+
+    def test_prune_expansion(self):
+        decoder = DummyLatticeDecoder()
+        decoder._beam = 40
+        decoder._nnlm_weight = 1.0
+        decoder._linear_interpolation = False
+        decoder._nn_logprob_bound = 0.0
+        tokens = [LatticeDecoder.Token(ac_logprob=-30.0),
+                  LatticeDecoder.Token(ac_logprob=-70.0),
+                  LatticeDecoder.Token(ac_logprob=-50.0)]
+        decoder._link_ends = [1]
+        decoder._link_ac_logprobs = [-5.0]
+        decoder._link_lm_logprobs = [0.0]
+        decoder._link_words = ['x']
+        # best_logprob = -20, threshold = -60
+        new_tokens = decoder._prune_expansion(tokens, 0, 1.0, 0.0)
+        self.assertEqual(len(new_tokens), 2)
+        self.assertIs(new_tokens[0], tokens[0])
+        self.assertIs(new_tokens[1], tokens[2])
+        # Word insertion penalty is applied to the new word.
+        new_tokens = decoder._prune_expansion(tokens, 0, 1.0, -10.0)
+        self.assertEqual(len(new_tokens), 1)
+        # The best token is always kept.
+        decoder._beam = 0
+        new_tokens = decoder._prune_expansion(tokens, 0, 1.0, 0.0)
+        self.assertEqual(len(new_tokens), 1)
+        self.assertIs(new_tokens[0], tokens[0])
 
-        decoding_options = {
-            'nnlm_weight': 0.0,
-            'lm_scale': None,
-            'wi_penalty': None,
-            'ignore_unk': False,
-            'unk_penalty': None,
-            'linear_interpolation': True,
-            'max_tokens_per_node': None,
-            'beam': None,
-            'recombination_order': None
-        }
-        decoder = LatticeDecoder(network, decoding_options)
-        tokens = decoder.decode(self.lattice)
+    def test_decode(self):
+        decoding_options = self._decoding_options(nnlm_weight=0.0,
+                                                  linear_interpolation=True)
+        decoder, tokens, paths = self._decode_paths(decoding_options)
 
         # Compare tokens to n-best list given by SRILM lattice-tool.
         log_scale = math.log(10)
@@ -320,25 +507,11 @@ class TestLatticeDecoder(unittest.TestCase):
             print(token.ac_logprob / log_scale,
                   token.lat_lm_logprob / log_scale,
                   token.total_logprob / log_scale,
-                  ' '.join(token.history_words(vocabulary)))
-
-        all_paths = ["<s> IT DIDN'T ELABORATE </s>",
-                     "<s> BUT IT DIDN'T ELABORATE </s>",
-                     "<s> THE DIDN'T ELABORATE </s>",
-                     "<s> AND IT DIDN'T ELABORATE </s>",
-                     "<s> E. DIDN'T ELABORATE </s>",
-                     "<s> IN IT DIDN'T ELABORATE </s>",
-                     "<s> A DIDN'T ELABORATE </s>",
-                     "<s> AT IT DIDN'T ELABORATE </s>",
-                     "<s> IT IT DIDN'T ELABORATE </s>",
-                     "<s> TO IT DIDN'T ELABORATE </s>",
-                     "<s> A. IT DIDN'T ELABORATE </s>",
-                     "<s> A IT DIDN'T ELABORATE </s>"]
-        paths = [' '.join(token.history_words(vocabulary)) for token in tokens]
-        self.assertListEqual(paths, all_paths)
+                  ' '.join(token.history_words(self.lattice_vocabulary)))
+
+        self.assertListEqual(paths, self.all_paths)
 
         token = tokens[0]
-        history = ' '.join(token.history_words(vocabulary))
         self.assertAlmostEqual(token.ac_logprob / log_scale, -8686.28, places=2)
         self.assertAlmostEqual(token.lat_lm_logprob / log_scale, -94.3896, places=2)
         self.assertAlmostEqual(token.nn_lm_logprob, math.log(0.1) * 4)
@@ -353,5 +526,165 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertAlmostEqual(token.lat_lm_logprob / log_scale, -178.00, places=2)
         self.assertAlmostEqual(token.nn_lm_logprob, math.log(0.1) * 5)
 
+    def test_decode_batching(self):
+        # Batching does not change the result.
+        decoding_options = self._decoding_options(nnlm_weight=0.0,
+                                                  linear_interpolation=True,
+                                                  max_batch_size=3,
+                                                  frontier_batching=True)
+        decoder, _, paths = self._decode_paths(decoding_options)
+        self.assertListEqual(paths, self.all_paths)
+        # All the recurrent states have been released.
+        self.assertEqual(len(decoder._states), 0)
+
+    def test_decode_array_lattice(self):
+        # A lattice that has already been converted into array form gives the
+        # same result.
+        decoding_options = self._decoding_options(nnlm_weight=0.0,
+                                                  linear_interpolation=True)
+        _, tokens, _ = self._decode_paths(decoding_options)
+        decoder = LatticeDecoder(self.lattice_network, decoding_options)
+        array_tokens = decoder.decode(ArrayLattice(self.lattice))
+        paths = [' '.join(token.history_words(self.lattice_vocabulary))
+                 for token in array_tokens]
+        self.assertListEqual(paths, self.all_paths)
+        for token, array_token in zip(tokens, array_tokens):
+            self.assertAlmostEqual(token.total_logprob,
+                                   array_token.total_logprob)
+
+    def test_decode_statistics(self):
+        decoding_options = self._decoding_options(nnlm_weight=0.0,
+                                                  linear_interpolation=True,
+                                                  max_batch_size=3)
+        decoder, _, _ = self._decode_paths(decoding_options)
+        stats = decoder.stats
+        self.assertEqual(stats.num_nodes, len(self.lattice.nodes))
+        self.assertEqual(stats.num_links, len(self.lattice.links))
+        self.assertGreater(stats.tokens_created, 0)
+        self.assertGreater(stats.nn_calls, 0)
+        self.assertEqual(sum(stats.batch_sizes.values()), stats.nn_calls)
+        self.assertLessEqual(stats.nn_time, stats.decode_time)
+
+    def test_free_tokens(self):
+        decoding_options = self._decoding_options(nnlm_weight=0.0,
+                                                  linear_interpolation=True)
+        decoder, _, _ = self._decode_paths(decoding_options)
+        # The tokens of the processed nodes have been freed.
+        self.assertFalse(any(decoder._tokens))
+        self.assertGreaterEqual(decoder.peak_tokens, len(self.all_paths))
+        self.assertEqual(decoder.peak_state_bytes,
+                         decoder._states.peak_size *
+                         decoder._states.state_bytes())
+        self.assertGreater(decoder.peak_state_bytes, 0)
+
+    def test_decode_cache(self):
+        # Caching the NNLM results does not change the result.
+        decoding_options = self._decoding_options(nnlm_weight=0.0,
+                                                  linear_interpolation=True,
+                                                  cache_size=5)
+        decoder, tokens, paths = self._decode_paths(decoding_options)
+        self.assertListEqual(paths, self.all_paths)
+        self.assertAlmostEqual(tokens[0].nn_lm_logprob, math.log(0.1) * 4)
+        tokens = decoder.decode(self.lattice)
+        paths = [' '.join(token.history_words(self.lattice_vocabulary))
+                 for token in tokens]
+        self.assertListEqual(paths, self.all_paths)
+        self.assertGreater(decoder._cache.hits, 0)
+        # Only the cache refers to recurrent states.
+        self.assertLessEqual(len(decoder._states), 5)
+
+    def test_early_pruning(self):
+        # Pruning before propagating the tokens through the network doesn't
+        # change the result.
+        decoding_options = self._decoding_options(nnlm_weight=0.0,
+                                                  linear_interpolation=True,
+                                                  beam=100)
+        _, _, paths = self._decode_paths(decoding_options)
+        decoding_options['early_pruning'] = True
+        decoder, _, early_pruning_paths = self._decode_paths(decoding_options)
+        self.assertEqual(early_pruning_paths[0], paths[0])
+
+    def test_decoding_budget(self):
+        # When the budget is exceeded, pruning is tightened, and the tokens
+        # still reach the final node.
+        decoding_options = self._decoding_options(nnlm_weight=0.0,
+                                                  linear_interpolation=True,
+                                                  max_nnlm_evaluations=20)
+        decoder, tokens, _ = self._decode_paths(decoding_options)
+        self.assertEqual(decoder.budget_status, 'tightened')
+        self.assertGreater(len(tokens), 0)
+        self.assertLess(len(tokens), len(self.all_paths))
+        self.assertEqual(len(decoder._states), 0)
+
+        # When twice the budget is exceeded, the best path is computed from
+        # the lattice scores.
+        decoding_options['max_nnlm_evaluations'] = 1
+        decoder, tokens, paths = self._decode_paths(decoding_options)
+        self.assertEqual(decoder.budget_status, 'fallback')
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(len(decoder._states), 0)
+        decoding_options['max_nnlm_evaluations'] = None
+        decoder, lattice_tokens, lattice_paths = \
+            self._decode_paths(decoding_options)
+        self.assertIsNone(decoder.budget_status)
+        self.assertEqual(paths[0], lattice_paths[0])
+        self.assertAlmostEqual(tokens[0].total_logprob,
+                               lattice_tokens[0].total_logprob, places=4)
+
+    def test_rescored_lattice(self):
+        # The rescored lattice contains the paths of the final tokens with the
+        # same scores.
+        decoding_options = self._decoding_options(nnlm_weight=0.5,
+                                                  linear_interpolation=True,
+                                                  build_lattice=True)
+        decoder, tokens, _ = self._decode_paths(decoding_options)
+        rescored_lattice = decoder.rescored_lattice(tokens)
+        lattice_file = io.StringIO()
+        rescored_lattice.write(lattice_file)
+        lattice_file.seek(0)
+        rescored_lattice = SLFLattice(lattice_file)
+        lm_scale = rescored_lattice.lm_scale
+        best_scores = dict()
+        stack = [(rescored_lattice.initial_node, (), 0.0)]
+        while stack:
+            node, words, score = stack.pop()
+            if node is rescored_lattice.final_node:
+                best_scores[words] = max(best_scores.get(words, -numpy.inf),
+                                         score)
+            for link in node.out_links:
+                new_words = words
+                if not link.word.startswith('!'):
+                    new_words = words + (link.word,)
+                new_score = score + link.ac_logprob + \
+                            link.lm_logprob * lm_scale
+                stack.append((link.end_node, new_words, new_score))
+        self.assertEqual(len(best_scores), len(tokens))
+        for token in tokens:
+            words = tuple(token.history_words(self.lattice_vocabulary)[1:-1])
+            self.assertAlmostEqual(
+                best_scores[words],
+                token.ac_logprob + token.lm_logprob * lm_scale,
+                places=2)
+
+    def test_frontiers(self):
+        decoder = DummyLatticeDecoder()
+        lattice = Lattice()
+        lattice.nodes = [Lattice.Node(id) for id in range(5)]
+        lattice.add_link(lattice.nodes[0], lattice.nodes[1])
+        lattice.add_link(lattice.nodes[0], lattice.nodes[2])
+        lattice.add_link(lattice.nodes[1], lattice.nodes[3])
+        lattice.add_link(lattice.nodes[2], lattice.nodes[3])
+        lattice.add_link(lattice.nodes[0], lattice.nodes[3])
+        lattice.add_link(lattice.nodes[3], lattice.nodes[4])
+        lattice.add_link(lattice.nodes[1], lattice.nodes[4])
+        lattice.initial_node = lattice.nodes[0]
+        lattice.final_node = lattice.nodes[4]
+        frontiers = decoder._frontiers(ArrayLattice(lattice))
+        self.assertEqual(len(frontiers), 4)
+        self.assertEqual(frontiers[0], [0])
+        self.assertCountEqual(frontiers[1], [1, 2])
+        self.assertEqual(frontiers[2], [3])
+        self.assertEqual(frontiers[3], [4])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+from theanolm.scoring.latticeprefetcher import LatticePrefetcher
+from theanolm.scoring.slflattice import SLFLattice
+
+class TestLatticePrefetcher(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        self.lattice_path = os.path.join(script_path, 'lattice.slf')
+
+    def tearDown(self):
+        pass
+
+    def read_lattice(self, path):
+        with open(path, 'r') as lattice_file:
+            return SLFLattice(lattice_file)
+
+    def test_iter(self):
+        paths = [self.lattice_path] * 5
+        prefetcher = LatticePrefetcher(paths, self.read_lattice, 2)
+        results = list(prefetcher)
+        self.assertEqual(len(results), 5)
+        for path, lattice in results:
+            self.assertEqual(path, self.lattice_path)
+            self.assertEqual(len(lattice.nodes), 24)
+        self.assertEqual(prefetcher.num_lattices, 5)
+        self.assertLessEqual(prefetcher.mean_queue_depth(), 2)
+        self.assertGreaterEqual(prefetcher.stall_time, 0.0)
+
+        with self.assertRaises(ValueError):
+            LatticePrefetcher(paths, self.read_lattice, 0)
+
+    def test_errors(self):
+        paths = [self.lattice_path, 'nonexistent.slf', self.lattice_path]
+        prefetcher = LatticePrefetcher(paths, self.read_lattice, 1)
+        iterator = iter(prefetcher)
+        path, lattice = next(iterator)
+        self.assertEqual(len(lattice.nodes), 24)
+        with self.assertRaises(IOError):
+            next(iterator)
+        self.assertFalse(prefetcher._thread.is_alive())
+
+    def test_close(self):
+        paths = [self.lattice_path] * 10
+        prefetcher = LatticePrefetcher(paths, self.read_lattice, 1)
+        for path, lattice in prefetcher:
+            break
+        self.assertFalse(prefetcher._thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
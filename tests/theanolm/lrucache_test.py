@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from theanolm.scoring.lrucache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_put(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.put('a', 1))
+        self.assertIsNone(cache.put('b', 2))
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is now the least recently used item.
+        self.assertEqual(cache.put('c', 3), 2)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 2)
+
+        self.assertEqual(cache.put('a', 4), 1)
+        self.assertEqual(cache.put('d', 5), 3)
+        self.assertEqual(cache.get('a'), 4)
+        self.assertFalse('c' in cache)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.misses, 0)
+
+        with self.assertRaises(ValueError):
+            LRUCache(0)
+
+if __name__ == '__main__':
+    unittest.main()
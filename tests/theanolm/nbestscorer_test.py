@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import numpy
+from numpy.testing import assert_almost_equal
+import theano
+from theano import tensor
+from theanolm import Vocabulary, Network
+from theanolm.scoring import NBestScorer, TextScorer
+from tests.theanolm.randomnetwork import random_networks
+
+class DummyNetwork(object):
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.input_word_ids = tensor.matrix('input_word_ids', dtype='int64')
+        self.input_class_ids = tensor.matrix('input_class_ids', dtype='int64')
+        self.target_class_ids = tensor.matrix('target_class_ids', dtype='int64')
+        self.is_training = tensor.scalar('is_training', dtype='int8')
+        self.recurrent_state_input = [tensor.tensor3('recurrent_state_1', dtype=theano.config.floatX)]
+        self.recurrent_state_output = [self.recurrent_state_input[0] + 1]
+        self.recurrent_state_size = [3]
+        self.mode = Network.Mode(minibatch=False)
+
+    def target_probs(self):
+        # The probability depends on the time step through the state, so that
+        # passing the state from a node to its children is tested.
+        result = self.target_class_ids.astype(theano.config.floatX) / 20
+        result += self.input_word_ids.astype(theano.config.floatX) / 40
+        result += self.recurrent_state_input[0][:, :, 0] / 100
+        return result
+
+    def target_logprobs(self):
+        return tensor.log(self.target_probs())
+
+class TestNBestScorer(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        vocabulary_path = os.path.join(script_path, 'vocabulary.txt')
+        with open(vocabulary_path) as vocabulary_file:
+            self.vocabulary = Vocabulary.from_file(vocabulary_file, 'words')
+        self.dummy_network = DummyNetwork(self.vocabulary)
+
+    def tearDown(self):
+        pass
+
+    def _reference_logprob(self, sequence, ignore_unk=False, unk_penalty=None):
+        unk_id = self.vocabulary.word_to_id['<unk>']
+        result = 0.0
+        for time, (input_id, target_id) in enumerate(zip(sequence[:-1],
+                                                         sequence[1:])):
+            if target_id == unk_id:
+                if ignore_unk:
+                    continue
+                if not unk_penalty is None:
+                    result += unk_penalty
+                    continue
+            target_class_id = self.vocabulary.word_id_to_class_id[target_id]
+            prob = target_class_id / 20 + input_id / 40 + time / 100
+            prob *= self.vocabulary.get_word_prob(target_id)
+            result += numpy.log(prob)
+        return result
+
+    def test_score_sequences(self):
+        unk_id = self.vocabulary.word_to_id['<unk>']
+        sequences = [numpy.array([1, 2, 3, 4, 5, 6]),
+                     numpy.array([1, 2, 3, 7, 8]),
+                     numpy.array([1, 2, 3, 4, 5, 6]),
+                     numpy.array([1, 2, unk_id, 8]),
+                     numpy.array([1, 9])]
+        for ignore_unk, unk_penalty in [(False, None), (True, None),
+                                        (False, -5)]:
+            scorer = NBestScorer(self.dummy_network, ignore_unk, unk_penalty,
+                                 max_batch_size=2)
+            logprobs = scorer.score_sequences(sequences)
+            self.assertEqual(len(logprobs), len(sequences))
+            for sequence, logprob in zip(sequences, logprobs):
+                correct = self._reference_logprob(sequence, ignore_unk,
+                                                  unk_penalty)
+                self.assertAlmostEqual(logprob, correct, places=4)
+            # The shared prefixes are evaluated only once.
+            self.assertEqual(scorer.num_predictions, 5 + 4 + 5 + 3 + 1)
+            self.assertEqual(scorer.num_evaluations, 10)
+
+        self.assertEqual(scorer.score_sequences([]), [])
+
+    def test_real_network(self):
+        network, step_network = random_networks(
+            self.vocabulary, ['lstm'],
+            [Network.Mode(), Network.Mode(minibatch=False)])
+        with self.assertRaises(ValueError):
+            NBestScorer(network)
+
+        sequences = [numpy.array([10, 0, 1, 2, 3, 11]),
+                     numpy.array([10, 0, 1, 4, 11]),
+                     numpy.array([10, 5, 11])]
+        nbest_scorer = NBestScorer(step_network)
+        text_scorer = TextScorer(network)
+        assert_almost_equal(nbest_scorer.score_sequences(sequences),
+                            text_scorer.score_sequences(sequences),
+                            decimal=4)
+
+if __name__ == '__main__':
+    unittest.main()
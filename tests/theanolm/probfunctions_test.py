@@ -3,6 +3,7 @@
 
 import unittest
 import math
+import numpy
 from theanolm.probfunctions import *
 
 class TestProbFunctions(unittest.TestCase):
@@ -32,6 +33,20 @@ class TestProbFunctions(unittest.TestCase):
             interpolate_linear(-1001, -1002, 0.25),
             -1001.64263,  # ln(0.25 * exp(-1001) + 0.75 * exp(-1002))
             places=4)
+        self.assertEqual(
+            interpolate_linear(float('-inf'), float('-inf'), 0.5),
+            float('-inf'))
+        self.assertAlmostEqual(
+            interpolate_linear(-100000.0, -100000.0, 0.25),
+            -100000.0,
+            places=2)
+        result = interpolate_linear(numpy.log([0.2, 0.3, 0.0]),
+                                    numpy.log([0.3, 0.0, 0.5]),
+                                    0.25)
+        self.assertEqual(len(result), 3)
+        self.assertAlmostEqual(result[0], math.log(0.25 * 0.2 + 0.75 * 0.3))
+        self.assertAlmostEqual(result[1], math.log(0.25 * 0.3))
+        self.assertAlmostEqual(result[2], math.log(0.75 * 0.5))
 
     def test_interpolate_loglinear(self):
         self.assertEqual(
@@ -49,6 +64,11 @@ class TestProbFunctions(unittest.TestCase):
         self.assertEqual(
             interpolate_loglinear(-1001.0, float('-inf'), 1.0, 0.0),
             -1001.0)
+        result = interpolate_loglinear(numpy.array([-1001.0, float('-inf')]),
+                                       numpy.array([-1002.0, -1002.0]),
+                                       0.0, 1.0)
+        self.assertEqual(result[0], -1002.0)
+        self.assertEqual(result[1], -1002.0)
 
 if __name__ == '__main__':
     unittest.main()
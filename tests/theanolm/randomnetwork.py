@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import numpy
+from theanolm import Architecture, Network
+
+def random_networks(vocabulary, layer_types, modes):
+    """Creates networks that share an architecture and random weights.
+
+    The architecture consists of a projection layer of size 4, hidden layers
+    of size 3, and a softmax output layer. The weights are drawn from a normal
+    distribution with a large standard deviation, so that the hidden layers,
+    including the recurrent state, have a clear effect on the output.
+
+    :type vocabulary: Vocabulary
+    :param vocabulary: vocabulary of the networks
+
+    :type layer_types: list of strs
+    :param layer_types: type of each hidden layer, e.g. "lstm"
+
+    :type modes: list of Network.Modes
+    :param modes: creates one network in each mode
+
+    :rtype: list of Networks
+    :returns: a network for each mode, with identical weights
+    """
+
+    description = 'input type=class name=class_input\n' \
+                  'layer type=projection name=projection_layer ' \
+                  'input=class_input size=4\n'
+    input_name = 'projection_layer'
+    for index, layer_type in enumerate(layer_types):
+        layer_name = 'hidden_layer_{}'.format(index + 1)
+        description += 'layer type={} name={} input={} size=3\n'.format(
+            layer_type, layer_name, input_name)
+        input_name = layer_name
+    description += 'layer type=softmax name=output_layer input={}\n'.format(
+        input_name)
+    architecture = Architecture.from_description(io.StringIO(description))
+
+    networks = [Network(architecture, vocabulary, mode=mode)
+                for mode in modes]
+    variables = [network.get_variables() for network in networks]
+    random = numpy.random.RandomState(1)
+    for path, variable in variables[0].items():
+        value = random.normal(scale=2.0, size=variable.get_value().shape)
+        value = value.astype(variable.dtype)
+        for network_variables in variables:
+            network_variables[path].set_value(value)
+    return networks
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import numpy
+from numpy.testing import assert_almost_equal
+import theano
+from theano import tensor
+from theanolm import Vocabulary, Network
+from tests.theanolm.randomnetwork import random_networks
+
+class TestSoftmaxLayer(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        vocabulary_path = os.path.join(script_path, 'vocabulary.txt')
+        with open(vocabulary_path) as vocabulary_file:
+            self.vocabulary = Vocabulary.from_file(vocabulary_file, 'words')
+
+    def tearDown(self):
+        pass
+
+    def test_target_logprobs(self):
+        # The vocabulary does not divide evenly into chunks of 5 classes.
+        num_classes = self.vocabulary.num_classes()
+        self.assertNotEqual(num_classes % 5, 0)
+        network, = random_networks(self.vocabulary, ['tanh'],
+                                   [Network.Mode(output_chunk_size=5)])
+
+        function = theano.function(
+            [network.input_class_ids, network.target_class_ids],
+            [network.target_logprobs(), tensor.log(network.target_probs())],
+            givens=[(network.is_training, numpy.int8(0))],
+            on_unused_input='ignore')
+        random = numpy.random.RandomState(1)
+        input_class_ids = random.randint(num_classes, size=(6, 3))
+        target_class_ids = random.randint(num_classes, size=(6, 3))
+        logprobs, correct = function(input_class_ids, target_class_ids)
+        self.assertEqual(logprobs.shape, (6, 3))
+        assert_almost_equal(logprobs, correct, decimal=4)
+
+if __name__ == '__main__':
+    unittest.main()
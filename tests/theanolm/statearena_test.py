@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy
+from numpy.testing import assert_equal
+import theano
+from theanolm.scoring.statearena import StateArena
+
+class TestStateArena(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_store_gather(self):
+        arena = StateArena([2, 3], initial_capacity=2)
+        layer1 = numpy.arange(6).reshape(1, 3, 2).astype(theano.config.floatX)
+        layer2 = numpy.arange(9).reshape(1, 3, 3).astype(theano.config.floatX)
+        handles = arena.store([layer1, layer2])
+        self.assertEqual(len(handles), 3)
+        self.assertEqual(len(arena), 3)
+
+        state = arena.gather([handles[2], handles[0]])
+        assert_equal(state[0], layer1[:,[2, 0],:])
+        assert_equal(state[1], layer2[:,[2, 0],:])
+        assert_equal(arena.get(handles[1]).get(1), layer2[:,1:2,:])
+
+        initial_state = arena.initial_state()
+        assert_equal(arena.get(initial_state).get(0),
+                     numpy.zeros((1, 1, 2)).astype(theano.config.floatX))
+        # The existing states were preserved when the arena grew.
+        assert_equal(arena.gather(handles)[0], layer1)
+
+    def test_reference_counts(self):
+        arena = StateArena([2], initial_capacity=4)
+        state = numpy.ones((1, 2, 2)).astype(theano.config.floatX)
+        handles = arena.store([state])
+        arena.retain([handles[0], handles[0]])
+        arena.release([handles[0], handles[1]])
+        self.assertEqual(len(arena), 1)
+        arena.release([handles[0]])
+        self.assertEqual(len(arena), 1)
+        arena.release([handles[0]])
+        self.assertEqual(len(arena), 0)
+        with self.assertRaises(RuntimeError):
+            arena.release([handles[0]])
+
+    def test_reuse(self):
+        arena = StateArena([2], initial_capacity=2)
+        state = numpy.ones((1, 2, 2)).astype(theano.config.floatX)
+        handles = arena.store([state])
+        arena.release(handles)
+        new_handles = arena.store([state * 2])
+        self.assertSetEqual(set(handles), set(new_handles))
+        assert_equal(arena.gather(new_handles)[0], state * 2)
+
+    def test_peak_size(self):
+        arena = StateArena([2, 3], initial_capacity=2)
+        state1 = numpy.ones((1, 3, 2)).astype(theano.config.floatX)
+        state2 = numpy.ones((1, 3, 3)).astype(theano.config.floatX)
+        handles = arena.store([state1, state2])
+        arena.release(handles[:2])
+        self.assertEqual(len(arena), 1)
+        self.assertEqual(arena.peak_size, 3)
+        arena.reset_peak()
+        self.assertEqual(arena.peak_size, 1)
+        self.assertEqual(arena.state_bytes(), 5 * state1.itemsize)
+
+if __name__ == '__main__':
+    unittest.main()
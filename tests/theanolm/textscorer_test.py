@@ -5,8 +5,9 @@ import unittest
 import os
 import numpy
 from theano import tensor
-from theanolm import Vocabulary
+from theanolm import Vocabulary, Network
 from theanolm.scoring import TextScorer
+from tests.theanolm.randomnetwork import random_networks
 from numpy.testing import assert_almost_equal
 
 class DummyNetwork(object):
@@ -17,10 +18,14 @@ class DummyNetwork(object):
         self.target_class_ids = tensor.matrix('target_class_ids', dtype='int64')
         self.mask = tensor.matrix('mask', dtype='int64')
         self.is_training = tensor.scalar('is_training', dtype='int8')
+        self.mode = Network.Mode()
 
     def target_probs(self):
         return self.target_class_ids.astype('float32') / 5
 
+    def target_logprobs(self):
+        return tensor.log(self.target_probs())
+
 class TestTextScorer(unittest.TestCase):
     def setUp(self):
         script_path = os.path.dirname(os.path.realpath(__file__))
@@ -111,5 +116,37 @@ class TestTextScorer(unittest.TestCase):
         correct = numpy.log(correct).sum() - 5
         self.assertAlmostEqual(logprob, correct, places=5)
 
+    def test_score_sequences(self):
+        # The scores of sequences of different lengths in one mini-batch match
+        # the scores computed one sequence at a time.
+        for ignore_unk, unk_penalty in [(False, None), (True, None),
+                                        (False, -5)]:
+            scorer = TextScorer(self.dummy_network, ignore_unk, unk_penalty)
+            sequences = [numpy.arange(1, 7), numpy.arange(2, 5),
+                         numpy.arange(3, 11)]
+            sequences[2][3] = self.vocabulary.word_to_id['<unk>']
+            logprobs = scorer.score_sequences(sequences)
+            self.assertEqual(len(logprobs), 3)
+            for sequence, logprob in zip(sequences, logprobs):
+                class_ids, membership_probs = \
+                    self.vocabulary.get_class_memberships(sequence)
+                correct = scorer.score_sequence(sequence, class_ids,
+                                                membership_probs)
+                self.assertAlmostEqual(logprob, correct, places=4)
+
+    def test_score_long_sequences(self):
+        # Scoring in chunks carries the recurrent states of both LSTM and GRU
+        # layers over, giving the same result as scoring in one mini-batch.
+        network, = random_networks(self.vocabulary, ['lstm', 'gru'],
+                                   [Network.Mode(stateful=True)])
+        scorer = TextScorer(network)
+        sequences = [numpy.array([10, 0, 1, 2, 3, 4, 5, 6, 7, 8, 11]),
+                     numpy.array([10, 3, 11]),
+                     numpy.array([10, 9, 8, 7, 6, 5, 11])]
+        correct = scorer.score_sequences(sequences)
+        for chunk_length in [1, 3, 20]:
+            logprobs = scorer.score_long_sequences(sequences, chunk_length)
+            assert_almost_equal(logprobs, correct, decimal=4)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy
+from theanolm.scoring.latticedecoder import LatticeDecoder
+from theanolm.scoring.timeframe import TimeFrame
+
+class TestTimeFrame(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _tokens(self, scores):
+        result = []
+        for recombination_hash, total_logprob in scores:
+            token = LatticeDecoder.Token()
+            token.recombination_hash = recombination_hash
+            token.total_logprob = total_logprob
+            result.append(token)
+        return result
+
+    def test_add_tokens(self):
+        frame = TimeFrame()
+        frame.add_node(1)
+        frame.add_node(2)
+        frame.add_tokens(1, self._tokens([(1, -20.0), (2, -30.0)]))
+        frame.add_tokens(1, self._tokens([(1, -25.0), (2, -10.0)]))
+        frame.add_tokens(3, self._tokens([(1, -5.0)]))
+        self.assertDictEqual(frame.node_scores(1), {1: -20.0, 2: -10.0})
+        self.assertDictEqual(frame.node_scores(2), {})
+        self.assertEqual(frame.num_pending, 2)
+
+        # The score buffer grows when needed.
+        frame.add_tokens(2, self._tokens([(hash, -float(hash))
+                                          for hash in range(100)]))
+        self.assertEqual(frame.num_pending, 102)
+        self.assertEqual(frame.node_scores(2)[99], -99.0)
+
+    def test_limit(self):
+        frame = TimeFrame()
+        for node_id in range(4):
+            frame.add_node(node_id)
+        frame.add_tokens(0, self._tokens([(1, -10.0), (2, -40.0)]))
+        frame.add_tokens(1, self._tokens([(1, -20.0), (2, -30.0)]))
+        frame.add_tokens(2, self._tokens([(1, -50.0)]))
+        frame.add_tokens(3, self._tokens([(1, -60.0)]))
+
+        # Nodes that are not in the frame are not limited.
+        self.assertEqual(frame.limit(5, numpy.array([-1.0, -2.0]), 3), 2)
+        # The best three tokens are -10, -20, and -30.
+        self.assertEqual(frame.limit(0, numpy.array([-10.0, -40.0]), 3), 1)
+        self.assertEqual(frame.num_kept, 1)
+        self.assertEqual(frame.num_pending, 4)
+        self.assertEqual(frame.limit(1, numpy.array([-20.0, -30.0]), 3), 2)
+        # The frame is full, but at least one token is kept at each node.
+        self.assertEqual(frame.limit(2, numpy.array([-50.0]), 3), 1)
+        self.assertEqual(frame.num_kept, 4)
+        self.assertEqual(frame.num_pending, 1)
+        # A node that has already been pruned is not limited.
+        self.assertEqual(frame.limit(0, numpy.array([-10.0, -40.0]), 3), 2)
+
+    def test_limit_fits(self):
+        # No selection is needed when all the tokens fit in the frame.
+        frame = TimeFrame()
+        frame.add_node(0)
+        frame.add_node(1)
+        frame.add_tokens(0, self._tokens([(1, -10.0), (2, -40.0)]))
+        frame.add_tokens(1, self._tokens([(1, -20.0)]))
+        self.assertEqual(frame.limit(0, numpy.array([-10.0, -40.0]), 3), 2)
+        self.assertEqual(frame.limit(1, numpy.array([-20.0]), 3), 1)
+        self.assertEqual(frame.num_kept, 3)
+        self.assertEqual(frame.num_pending, 0)
+
+if __name__ == '__main__':
+    unittest.main()
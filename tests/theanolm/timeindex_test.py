@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy
+from theanolm.scoring.timeindex import TimeIndex
+
+class TestTimeIndex(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_best_logprob(self):
+        # Node 6 is not in the topological order.
+        times = [0.0, 2.0, 1.0, None, 3.0, 4.0, 0.0]
+        index = TimeIndex(list(range(6)), times)
+        self.assertEqual(index.best_logprob(0), -numpy.inf)
+        index.update(0, -10.0)
+        index.update(2, -20.0)
+        index.update(4, -30.0)
+        index.update(4, -40.0)
+        self.assertEqual(index.best_logprob(0), -10.0)
+        # Search starts from node 1, which is the first node at time >= 1.0.
+        self.assertEqual(index.best_logprob(2), -20.0)
+        self.assertEqual(index.best_logprob(1), -20.0)
+        # Search starts from the node itself.
+        self.assertEqual(index.best_logprob(3), -30.0)
+        self.assertEqual(index.best_logprob(5), -numpy.inf)
+        index.update(5, -5.0)
+        self.assertEqual(index.best_logprob(0), -5.0)
+        self.assertEqual(index.best_logprob(4), -5.0)
+
+        # Nodes that are not in the index are ignored.
+        times[6] = None
+        index.update(6, 0.0)
+        self.assertEqual(index.best_logprob(0), -5.0)
+        self.assertEqual(index.best_logprob(6), -numpy.inf)
+
+    def test_linear_search(self):
+        # Compare to the linear search that the decoder used to do.
+        random = numpy.random.RandomState(1)
+        num_nodes = 200
+        times = []
+        for _ in range(num_nodes):
+            if random.rand() < 0.1:
+                times.append(None)
+            else:
+                times.append(float(random.randint(50)))
+        logprobs = [None] * num_nodes
+        index = TimeIndex(list(range(num_nodes)), times)
+        for _ in range(1000):
+            node_id = random.randint(num_nodes)
+            logprob = -random.rand() * 100
+            index.update(node_id, logprob)
+            if (logprobs[node_id] is None) or (logprob > logprobs[node_id]):
+                logprobs[node_id] = logprob
+
+            node_id = random.randint(num_nodes)
+            if times[node_id] is None:
+                time_begin = node_id
+            else:
+                for time_begin, time in enumerate(times):
+                    if (not time is None) and (time >= times[node_id]):
+                        break
+            expected = max([x for x in logprobs[time_begin:] if not x is None],
+                           default=-numpy.inf)
+            self.assertEqual(index.best_logprob(node_id), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from theanolm.scoring.wordhistory import WordHistory
+
+class TestWordHistory(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_from_words(self):
+        self.assertIsNone(WordHistory.from_words([]))
+        history = WordHistory.from_words([1, 2, 'x'])
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history.word, 'x')
+        self.assertSequenceEqual(history.last_words(), (1, 2, 'x'))
+
+    def test_append(self):
+        history1 = WordHistory.from_words([1, 2])
+        history2 = history1.append(3)
+        history3 = history1.append(4)
+        self.assertSequenceEqual(history1.last_words(), (1, 2))
+        self.assertSequenceEqual(history2.last_words(), (1, 2, 3))
+        self.assertSequenceEqual(history3.last_words(), (1, 2, 4))
+        self.assertIs(history2.previous, history3.previous)
+
+    def test_last_words(self):
+        history = WordHistory.from_words([1, 2, 3, 4])
+        self.assertSequenceEqual(history.last_words(2), (3, 4))
+        self.assertSequenceEqual(history.last_words(10), (1, 2, 3, 4))
+        self.assertSequenceEqual(history.last_words(0), ())
+
+    def test_hash(self):
+        history1 = WordHistory.from_words([1, 12, 203, 3004])
+        history2 = WordHistory.from_words([2, 12, 203, 3004])
+        history3 = WordHistory.from_words([1, 12]).append(203).append(3004)
+        self.assertNotEqual(history1.hash(), history2.hash())
+        self.assertEqual(history1.hash(), history3.hash())
+        self.assertNotEqual(history1.hash(4), history2.hash(4))
+        self.assertEqual(history1.hash(3), history2.hash(3))
+        self.assertEqual(history1.hash(3), history2.hash(3))
+        self.assertNotEqual(history1.hash(4), history2.hash(4))
+
+    def test_equality(self):
+        history1 = WordHistory.from_words([1, 12, 203, 3004])
+        history2 = WordHistory.from_words([2, 12, 203, 3004])
+        history3 = WordHistory.from_words([1, 12]).append(203).append(3004)
+        history4 = history3.previous.append(3004)
+        self.assertNotEqual(history1, history2)
+        self.assertEqual(history1, history3)
+        self.assertEqual(history3, history4)
+        self.assertNotEqual(history1, history1.previous)
+        self.assertNotEqual(history1, (1, 12, 203, 3004))
+        cache = {history1: 'x'}
+        self.assertEqual(cache.get(history3), 'x')
+        self.assertIsNone(cache.get(history2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import tempfile
+from theanolm.workqueue import WorkQueue
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.queue_dir = os.path.join(self.temp_dir.name, 'queue')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _read_results(self, num_items):
+        result = []
+        for index in range(num_items):
+            path = os.path.join(self.queue_dir, '{:08d}.done'.format(index))
+            try:
+                with open(path, 'r') as marker_file:
+                    result.append(marker_file.read())
+            except FileNotFoundError:
+                result.append(None)
+        return result
+
+    def test_iter(self):
+        items = ['a', 'b', 'c', 'd']
+        queue = WorkQueue(self.queue_dir, items, [2, 0, 3, 1])
+        claimed = []
+        for index, item in queue:
+            self.assertEqual(items[index], item)
+            claimed.append(item)
+            queue.complete(index, item.upper())
+        self.assertListEqual(claimed, ['c', 'a', 'd', 'b'])
+        self.assertListEqual(self._read_results(4), ['A', 'B', 'C', 'D'])
+
+        # A restarted job skips the completed items.
+        queue = WorkQueue(self.queue_dir, items)
+        self.assertListEqual(list(queue), [])
+
+    def test_resume(self):
+        items = ['a', 'b', 'c']
+        queue = WorkQueue(self.queue_dir, items)
+        for index, item in queue:
+            queue.complete(index, item)
+            break
+        self.assertListEqual(self._read_results(3), ['a', None, None])
+        queue = WorkQueue(self.queue_dir, items)
+        self.assertListEqual([item for _, item in queue], ['b', 'c'])
+
+    def test_locking(self):
+        items = ['a', 'b', 'c']
+        queue1 = WorkQueue(self.queue_dir, items)
+        queue2 = WorkQueue(self.queue_dir, items)
+        iterator1 = iter(queue1)
+        index, item = next(iterator1)
+        self.assertEqual(item, 'a')
+        # The other job cannot claim an item that is locked, and does not wait
+        # for it before the other items have been processed. The first job
+        # completes its item while the other job is processing the last item.
+        claimed = []
+        for index2, item2 in queue2:
+            claimed.append(item2)
+            queue2.complete(index2, item2)
+            if item2 == 'c':
+                queue1.complete(index, item)
+        self.assertListEqual(claimed, ['b', 'c'])
+        self.assertListEqual(list(iterator1), [])
+        self.assertListEqual(self._read_results(3), ['a', 'b', 'c'])
+    def test_dead_job(self):
+        items = ['a', 'b', 'c']
+        queue1 = WorkQueue(self.queue_dir, items)
+        queue2 = WorkQueue(self.queue_dir, items, poll_interval=0.01)
+        iterator1 = iter(queue1)
+        index, item = next(iterator1)
+        self.assertEqual(item, 'a')
+        # The first job dies while the other job is processing the last item,
+        # without completing its item. The lock is released, and the other job
+        # retakes the item.
+        claimed = []
+        for index2, item2 in queue2:
+            claimed.append(item2)
+            queue2.complete(index2, item2)
+            if item2 == 'c':
+                iterator1.close()
+        self.assertListEqual(claimed, ['b', 'c', 'a'])
+        self.assertListEqual(self._read_results(3), ['a', 'b', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
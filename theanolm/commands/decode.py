@@ -3,14 +3,19 @@
 
 import sys
 import os
+import time
+import json
 import logging
 import subprocess
+import multiprocessing
 import numpy
 import h5py
 import theano
 from theanolm import Vocabulary, Architecture, Network
-from theanolm.scoring import LatticeDecoder, SLFLattice
+from theanolm.scoring import LatticeDecoder, SLFLattice, ArrayLattice, \
+                             LatticePrefetcher
 from theanolm.filetypes import TextFileType
+from theanolm.workqueue import WorkQueue
 
 def add_arguments(parser):
     argument_group = parser.add_argument_group("files")
@@ -30,6 +35,11 @@ def add_arguments(parser):
         '--output-file', metavar='FILE', type=TextFileType('w'), default='-',
         help='where to write the best paths through the lattices (default '
              'stdout, will be compressed if the name ends in ".gz")')
+    argument_group.add_argument(
+        '--lattice-output-dir', metavar='DIR', type=str, default=None,
+        help='write also a rescored lattice of each utterance into DIR, named '
+             'by the utterance ID, containing the paths that were not pruned, '
+             'with the interpolated LM scores')
     argument_group.add_argument(
         '--num-jobs', metavar='J', type=int, default=1,
         help='divide the set of lattice files into J distinct batches, and '
@@ -38,6 +48,27 @@ def add_arguments(parser):
         '--job', metavar='I', type=int, default=0,
         help='the index of the batch that this job should process, between 0 '
              'and J-1')
+    argument_group.add_argument(
+        '--work-queue', metavar='DIR', type=str, default=None,
+        help='instead of dividing the lattices statically with --num-jobs, '
+             'claim lattices one at a time, largest first, using lock files in '
+             'DIR, which has to be on a file system shared by all the jobs; '
+             'the output of each lattice is also written to DIR, and lattices '
+             'that have already been decoded are skipped, so failed jobs can '
+             'be restarted; the lattices claimed by a job that has died are '
+             'retaken by the other jobs')
+    argument_group.add_argument(
+        '--workers', metavar='N', type=int, default=1,
+        help='decode the lattices in N processes that share the network '
+             'compiled by this process; the lattices are handed out to the '
+             'workers largest first, and the output is written in the original '
+             'order (default 1, requires a platform that supports fork)')
+    argument_group.add_argument(
+        '--prefetch', metavar='N', type=int, default=0,
+        help='read and parse up to N lattices in a background thread while '
+             'the previous lattices are being decoded (default 0, meaning that '
+             'the lattices are read when needed; only with --workers 1 and '
+             'without --work-queue)')
 
     argument_group = parser.add_argument_group("decoding")
     argument_group.add_argument(
@@ -86,6 +117,11 @@ def add_arguments(parser):
         '--max-tokens-per-node', metavar='T', type=int, default=None,
         help="keep only at most T tokens at each node when decoding a lattice "
              "(default is no limit)")
+    argument_group.add_argument(
+        '--max-tokens-per-frame', metavar='T', type=int, default=None,
+        help="keep only at most T tokens in total at the nodes that have the "
+             "same time, but at least one token at each node (default is no "
+             "limit)")
     argument_group.add_argument(
         '--beam', metavar='B', type=float, default=None,
         help="prune tokens whose log probability is at least B smaller than "
@@ -96,6 +132,49 @@ def add_arguments(parser):
         help="keep only the best token, when at least O previous words are "
              "identical (default is to recombine tokens only if the entire "
              "word history matches)")
+    argument_group.add_argument(
+        '--posterior-threshold', metavar='P', type=float, default=None,
+        help="before decoding, remove the lattice links whose posterior "
+             "probability, computed from the lattice scores, is less than P "
+             "(default is no posterior pruning)")
+    argument_group.add_argument(
+        '--merge-equivalent-nodes', action="store_true",
+        help="before decoding, merge lattice nodes that have the same words on "
+             "the links from the same nodes or to the same nodes, keeping the "
+             "best of the resulting parallel links")
+    argument_group.add_argument(
+        '--early-pruning', action="store_true",
+        help="with --beam, drop tokens that would fall outside the beam even "
+             "if the neural network predicted the next word with probability "
+             "1, before propagating them through the network")
+    argument_group.add_argument(
+        '--max-nnlm-evaluations', metavar='N', type=int, default=None,
+        help="limit the number of tokens propagated through the neural "
+             "network per lattice to N; after that the beam and the maximum "
+             "number of tokens per node are halved at every step, and after 2N "
+             "the best path is selected using the lattice scores only (default "
+             "is no limit)")
+    argument_group.add_argument(
+        '--max-decoding-time', metavar='SECONDS', type=float, default=None,
+        help="limit the wall-clock time used for decoding a lattice to SECONDS "
+             "in the same way as --max-nnlm-evaluations (default is no limit)")
+
+    argument_group = parser.add_argument_group("batching")
+    argument_group.add_argument(
+        '--max-batch-size', metavar='N', type=int, default=None,
+        help="propagate at most N tokens through the neural network in one "
+             "call (default is no limit)")
+    argument_group.add_argument(
+        '--frontier-batching', action="store_true",
+        help="collect the tokens of all the nodes whose predecessors have been "
+             "processed into the same neural network batch, instead of "
+             "processing one node at a time")
+    argument_group.add_argument(
+        '--cache-size', metavar='N', type=int, default=None,
+        help="save the neural network outputs of the N most recently used "
+             "(history, word) pairs, so that they don't have to be recomputed; "
+             "if --recombination-order is given, only that many previous words "
+             "are used as the history (default is no caching)")
 
     argument_group = parser.add_argument_group("logging and debugging")
     argument_group.add_argument(
@@ -105,6 +184,13 @@ def add_arguments(parser):
         '--log-level', metavar='LEVEL', type=str, default='info',
         help='minimum level of events to log, one of "debug", "info", "warn" '
              '(default "info")')
+    argument_group.add_argument(
+        '--stats-file', metavar='FILE', type=TextFileType('w'), default=None,
+        help='write statistics of decoding each lattice to FILE, one JSON '
+             'object per line, in the order of the lattice list (number of '
+             'nodes and links, tokens created, recombined, and pruned, neural '
+             'network calls and batch sizes, cache hits, and the time spent in '
+             'parsing, the neural network, and Python code)')
     argument_group.add_argument(
         '--debug', action="store_true",
         help='enables debugging Theano errors')
@@ -169,8 +255,16 @@ def decode(args):
         'unk_penalty': unk_penalty,
         'linear_interpolation': args.linear_interpolation,
         'max_tokens_per_node': args.max_tokens_per_node,
+        'max_tokens_per_frame': args.max_tokens_per_frame,
         'beam': args.beam,
-        'recombination_order': args.recombination_order
+        'recombination_order': args.recombination_order,
+        'max_batch_size': args.max_batch_size,
+        'frontier_batching': args.frontier_batching,
+        'cache_size': args.cache_size,
+        'early_pruning': args.early_pruning,
+        'max_nnlm_evaluations': args.max_nnlm_evaluations,
+        'max_decoding_time': args.max_decoding_time,
+        'build_lattice': not args.lattice_output_dir is None
     }
     logging.debug("DECODING OPTIONS")
     for option_name, option_value in decoding_options.items():
@@ -194,32 +288,304 @@ def decode(args):
     if (args.job < 0) or (args.job > args.num_jobs - 1):
         print("Invalid job specified:", args.job)
         sys.exit(1)
-    lattices = lattices[args.job::args.num_jobs]
+    if args.workers < 1:
+        print("Invalid number of workers specified:", args.workers)
+        sys.exit(1)
+    if args.prefetch < 0:
+        print("Invalid prefetch queue depth specified:", args.prefetch)
+        sys.exit(1)
+    if (args.prefetch > 0) and (args.workers > 1):
+        print("--prefetch cannot be used with --workers.")
+        sys.exit(1)
+    if not args.lattice_output_dir is None:
+        os.makedirs(args.lattice_output_dir, exist_ok=True)
+    if not args.work_queue is None:
+        if (args.num_jobs > 1) or (args.workers > 1):
+            print("--work-queue cannot be used with --num-jobs or --workers.")
+            sys.exit(1)
+        if args.prefetch != 0:
+            print("--work-queue cannot be used with --prefetch.")
+            sys.exit(1)
+    else:
+        lattices = lattices[args.job::args.num_jobs]
 
-    file_type = TextFileType('r')
-    for index, path in enumerate(lattices):
-        logging.info("Reading word lattice: %s", path)
-        lattice_file = file_type(path)
-        lattice = SLFLattice(lattice_file)
+    global _decoding_context
+    _decoding_context = {
+        'decoder': decoder,
+        'vocabulary': vocabulary,
+        'log_scale': log_scale,
+        'wi_penalty': wi_penalty,
+        'num_lattices': len(lattices),
+        'args': args
+    }
+    tasks = list(enumerate(lattices))
+    over_budget = []
+    if not args.work_queue is None:
+        # Every job computes the same order, so the largest lattices are
+        # claimed first.
+        order = sorted(range(len(lattices)),
+                       key=lambda index: _lattice_size(lattices[index]),
+                       reverse=True)
+        work_queue = WorkQueue(args.work_queue, lattices, order)
+        for task in work_queue:
+            index, lines, budget_status, stats = _decode_lattice(task)
+            _write_result(args, lines, stats)
+            args.output_file.flush()
+            work_queue.complete(index, ''.join(line + "\n" for line in lines))
+            if not budget_status is None:
+                over_budget.append(budget_status)
+        _log_over_budget(over_budget)
+        return
 
-        if not lattice.utterance_id is None:
-            utterance_id = lattice.utterance_id
+    if args.workers == 1:
+        if args.prefetch > 0:
+            prefetcher = LatticePrefetcher(lattices, _read_lattice,
+                                           args.prefetch)
+            results = (_decode_parsed_lattice(index, *result)
+                       for index, (_, result) in enumerate(prefetcher))
         else:
-            utterance_id = os.path.basename(lattice_file.name)
-        logging.info("Utterance `%s' -- %d/%d of job %d",
-                     utterance_id,
-                     index + 1,
-                     len(lattices),
-                     args.job)
-        tokens = decoder.decode(lattice)
-
-        for index in range(min(args.n_best, len(tokens))):
-            line = format_token(tokens[index],
-                                utterance_id,
-                                vocabulary,
-                                log_scale,
-                                args.output)
-            args.output_file.write(line + "\n")
+            prefetcher = None
+            results = (_decode_lattice(task) for task in tasks)
+        for _, lines, budget_status, stats in results:
+            _write_result(args, lines, stats)
+            if not budget_status is None:
+                over_budget.append(budget_status)
+        if not prefetcher is None:
+            logging.info("Lattice prefetching: waited %.2f s for %d of %d "
+                         "lattices, mean queue depth %.2f",
+                         prefetcher.stall_time,
+                         prefetcher.num_stalls,
+                         prefetcher.num_lattices,
+                         prefetcher.mean_queue_depth())
+        _log_over_budget(over_budget)
+        return
+
+    # Start with the largest lattices, so that the workers won't be waiting for
+    # a single large lattice at the end. The workers are forked after the
+    # network has been compiled, so they don't have to compile it again.
+    tasks.sort(key=lambda task: _lattice_size(task[1]), reverse=True)
+    # Buffered output would be flushed again by each worker.
+    sys.stdout.flush()
+    args.output_file.flush()
+    if not args.stats_file is None:
+        args.stats_file.flush()
+    context = multiprocessing.get_context('fork')
+    with context.Pool(args.workers) as pool:
+        # Write the results in the original order, as soon as all the previous
+        # lattices have been decoded.
+        finished = dict()
+        next_index = 0
+        for index, lines, budget_status, stats in \
+            pool.imap_unordered(_decode_lattice, tasks):
+            finished[index] = (lines, stats)
+            if not budget_status is None:
+                over_budget.append(budget_status)
+            while next_index in finished:
+                _write_result(args, *finished.pop(next_index))
+                next_index += 1
+    over_budget.sort()
+    _log_over_budget(over_budget)
+
+# The decoder and output options. Worker processes inherit them when they are
+# forked.
+_decoding_context = None
+
+def _decode_lattice(task):
+    """Reads and decodes a lattice and formats the n-best output lines.
+
+    Uses the decoder and output options from ``_decoding_context``.
+
+    :type task: tuple
+    :param task: index of the lattice in the lattice list and path to the
+                 lattice file
+
+    :rtype: tuple
+    :returns: the result of ``_decode_parsed_lattice()``
+    """
+
+    index, path = task
+    return _decode_parsed_lattice(index, *_read_lattice(path))
+
+def _read_lattice(path):
+    """Reads a lattice file and converts it into array form for decoding.
+
+    If the lattice doesn't specify an utterance ID, the file name is used as
+    the utterance ID. Posterior pruning and merging of equivalent nodes are
+    performed before the conversion, according to the options in
+    ``_decoding_context``.
+
+    :type path: str
+    :param path: path to an SLF lattice file
+
+    :rtype: tuple
+    :returns: the lattice read from the file, and the time in seconds used for
+              reading and preparing it
+    """
+
+    args = _decoding_context['args']
+
+    logging.info("Reading word lattice: %s", path)
+    start_time = time.time()
+    lattice_file = TextFileType('r')(path)
+    lattice = SLFLattice(lattice_file)
+    if lattice.utterance_id is None:
+        lattice.utterance_id = os.path.basename(lattice_file.name)
+    if not args.posterior_threshold is None:
+        num_links = len(lattice.links)
+        lattice.prune_by_posterior(args.posterior_threshold,
+                                   args.lm_scale,
+                                   _decoding_context['wi_penalty'])
+        logging.debug("Posterior pruning: %d -> %d links",
+                      num_links,
+                      len(lattice.links))
+    if args.merge_equivalent_nodes:
+        num_nodes = len(lattice.nodes)
+        lattice.merge_equivalent_nodes(args.lm_scale)
+        logging.debug("Merging equivalent nodes: %d -> %d nodes",
+                      num_nodes,
+                      len(lattice.nodes))
+    lattice = ArrayLattice(lattice)
+    return lattice, time.time() - start_time
+
+def _decode_parsed_lattice(index, lattice, parse_time):
+    """Decodes a lattice that has been read, and formats the n-best output
+    lines.
+
+    Uses the decoder and output options from ``_decoding_context``.
+
+    :type index: int
+    :param index: index of the lattice in the lattice list
+
+    :type lattice: ArrayLattice
+    :param lattice: the lattice to be decoded
+
+    :type parse_time: float
+    :param parse_time: time in seconds used for reading and preparing the
+                       lattice
+
+    :rtype: tuple
+    :returns: the index of the lattice; a list of output lines; ``None``, or a
+              tuple of the index, utterance ID, and budget status of the
+              decoder, if the decoding budget was exceeded; and ``None``, or a
+              dictionary of decoding statistics, if ``--stats-file`` was given
+    """
+
+    decoder = _decoding_context['decoder']
+    vocabulary = _decoding_context['vocabulary']
+    log_scale = _decoding_context['log_scale']
+    args = _decoding_context['args']
+
+    utterance_id = lattice.utterance_id
+    logging.info("Utterance `%s' -- %d/%d of job %d",
+                 utterance_id,
+                 index + 1,
+                 _decoding_context['num_lattices'],
+                 args.job)
+    tokens = decoder.decode(lattice)
+    if not args.lattice_output_dir is None:
+        rescored_lattice = decoder.rescored_lattice(tokens)
+        lattice_path = os.path.join(args.lattice_output_dir,
+                                    _lattice_file_name(utterance_id))
+        with TextFileType('w')(lattice_path) as lattice_file:
+            rescored_lattice.write(lattice_file, args.log_base)
+    if decoder.budget_status is None:
+        budget_status = None
+    else:
+        logging.warning("Utterance `%s' exceeded the decoding budget (%s).",
+                        utterance_id,
+                        decoder.budget_status)
+        budget_status = (index, utterance_id, decoder.budget_status)
+
+    if args.stats_file is None:
+        stats = None
+    else:
+        stats = {'utterance_id': utterance_id, 'parse_time': parse_time}
+        stats.update(decoder.stats.to_dict())
+
+    lines = []
+    for token in tokens[:args.n_best]:
+        lines.append(format_token(token,
+                                  utterance_id,
+                                  vocabulary,
+                                  log_scale,
+                                  args.output))
+    return index, lines, budget_status, stats
+
+def _lattice_file_name(utterance_id):
+    """Returns the name of the file where the rescored lattice of an utterance
+    is written.
+
+    The utterance ID in an SLF lattice is often a path. Only the last component
+    of the path is used, so that the file is always written in the output
+    directory.
+
+    :type utterance_id: str
+    :param utterance_id: utterance ID of the lattice
+
+    :rtype: str
+    :returns: a file name without a directory
+    """
+
+    if not os.path.altsep is None:
+        utterance_id = utterance_id.replace(os.path.altsep, os.sep)
+    file_name = os.path.basename(utterance_id.rstrip(os.sep))
+    if not file_name:
+        file_name = utterance_id.replace(os.sep, '_')
+    return file_name + '.slf.gz'
+
+def _write_result(args, lines, stats):
+    """Writes the output lines of a lattice, and its statistics if
+    ``--stats-file`` was given.
+
+    :type args: argparse.Namespace
+    :param args: the command line arguments
+
+    :type lines: list of strs
+    :param lines: the output lines of a lattice
+
+    :type stats: dict
+    :param stats: decoding statistics of the lattice, or ``None``
+    """
+
+    for line in lines:
+        args.output_file.write(line + "\n")
+    if not stats is None:
+        args.stats_file.write(json.dumps(stats, sort_keys=True) + "\n")
+
+def _log_over_budget(over_budget):
+    """Logs the utterances that exceeded the decoding budget.
+
+    :type over_budget: list of tuples
+    :param over_budget: index, utterance ID, and budget status of each
+                        utterance that exceeded the budget
+    """
+
+    if not over_budget:
+        return
+    num_fallback = sum(1 for _, _, status in over_budget
+                       if status == 'fallback')
+    logging.info("%d utterances exceeded the decoding budget, %d of which were "
+                 "decoded using the lattice scores only:",
+                 len(over_budget),
+                 num_fallback)
+    for _, utterance_id, status in over_budget:
+        logging.info("  %s (%s)", utterance_id, status)
+
+def _lattice_size(path):
+    """Returns the size of a lattice file, as an estimate of how long it takes
+    to decode the lattice.
+
+    :type path: str
+    :param path: path to a lattice file
+
+    :rtype: int
+    :returns: the size of the file in bytes, or 0 if it cannot be read
+    """
+
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
 def format_token(token, utterance_id, vocabulary, log_scale, format):
     """Formats an output line from a token and an utterance ID.
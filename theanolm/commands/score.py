@@ -9,7 +9,7 @@ import h5py
 import theano
 from theanolm import Vocabulary, Architecture, Network
 from theanolm.parsing import LinearBatchIterator, utterance_from_line
-from theanolm.scoring import TextScorer
+from theanolm.scoring import TextScorer, NBestScorer
 from theanolm.filetypes import TextFileType
 
 def add_arguments(parser):
@@ -30,7 +30,7 @@ def add_arguments(parser):
     argument_group.add_argument(
         '--output', metavar='DETAIL', type=str, default='perplexity',
         help='what to output, one of "perplexity", "utterance-scores", '
-             '"word-scores" (default "perplexity")')
+             '"nbest-scores", "word-scores" (default "perplexity")')
     argument_group.add_argument(
         '--log-base', metavar='B', type=int, default=None,
         help='convert output log probabilities to base B (default is the '
@@ -40,6 +40,13 @@ def add_arguments(parser):
         help="if LOGPROB is zero, do not include <unk> tokens in perplexity "
              "computation; otherwise use constant LOGPROB as <unk> token score "
              "(default is to use the network to predict <unk> probability)")
+    argument_group.add_argument(
+        '--batch-size', metavar='N', type=int, default=16,
+        help='compute the probabilities of N sentences in one mini-batch; '
+             'with --output utterance-scores, the sentences are grouped by '
+             'length and the scores are written in the original order; with '
+             '--output nbest-scores, at most N arcs of the prefix tree are '
+             'evaluated in one call (default 16)')
 
 def score(args):
     with h5py.File(args.model_path, 'r') as state:
@@ -55,6 +62,13 @@ def score(args):
         print("Restoring neural network state.")
         sys.stdout.flush()
         network.set_state(state)
+        if args.output == 'nbest-scores':
+            # The prefix tree is scored one time step at a time.
+            print("Building single-step neural network.")
+            sys.stdout.flush()
+            step_network = Network(architecture, vocabulary,
+                                   mode=Network.Mode(minibatch=False))
+            step_network.set_state(state)
 
     print("Building text scorer.")
     sys.stdout.flush()
@@ -69,25 +83,38 @@ def score(args):
         unk_penalty = args.unk_penalty
     scorer = TextScorer(network, ignore_unk, unk_penalty)
 
+    if args.batch_size < 1:
+        print("Invalid batch size specified:", args.batch_size)
+        sys.exit(1)
+
     print("Scoring text.")
     if args.output == 'perplexity':
         _score_text(args.input_file, vocabulary, scorer, args.output_file,
-                    args.log_base, False)
+                    args.log_base, False, args.batch_size)
     elif args.output == 'word-scores':
         _score_text(args.input_file, vocabulary, scorer, args.output_file,
-                    args.log_base, True)
+                    args.log_base, True, args.batch_size)
     elif args.output == 'utterance-scores':
         _score_utterances(args.input_file, vocabulary, scorer, args.output_file,
-                          args.log_base)
+                          args.log_base, args.batch_size)
+    elif args.output == 'nbest-scores':
+        nbest_scorer = NBestScorer(step_network, ignore_unk, unk_penalty,
+                                   max_batch_size=args.batch_size)
+        _score_nbest(args.input_file, vocabulary, nbest_scorer,
+                     args.output_file, args.log_base)
     else:
         print("Invalid output format requested:", args.output)
         sys.exit(1)
 
 def _score_text(input_file, vocabulary, scorer, output_file,
-                log_base=None, word_level=False):
+                log_base=None, word_level=False, batch_size=16):
     """Reads text from ``input_file``, computes perplexity using
     ``scorer``, and writes to ``output_file``.
 
+    The sentences are sorted by length in windows of
+    ``LinearBatchIterator.default_sort_window`` mini-batches, to reduce padding.
+    Word-level statistics are written in the original order.
+
     :type input_file: file object
     :param input_file: a file that contains the input sentences in SRILM n-best
                        format
@@ -109,13 +136,17 @@ def _score_text(input_file, vocabulary, scorer, output_file,
 
     :type word_level: bool
     :param word_level: if set to True, also writes word-level statistics
+
+    :type batch_size: int
+    :param batch_size: number of sentences in one mini-batch
     """
 
     validation_iter = \
         LinearBatchIterator(input_file,
                             vocabulary,
-                            batch_size=16,
-                            max_sequence_length=None)
+                            batch_size=batch_size,
+                            max_sequence_length=None,
+                            sort_window=LinearBatchIterator.default_sort_window)
     log_scale = 1.0 if log_base is None else numpy.log(log_base)
     unk_id = vocabulary.word_to_id['<unk>']
 
@@ -124,6 +155,9 @@ def _score_text(input_file, vocabulary, scorer, output_file,
     num_words = 0
     num_unks = 0
     num_probs = 0
+    # Word-level statistics of the sentences that cannot be written yet,
+    # because a sentence that precedes them in the input has not been scored.
+    pending_output = dict()
     for word_ids, _, mask in validation_iter:
         class_ids, membership_probs = vocabulary.get_class_memberships(word_ids)
         logprobs = scorer.score_batch(word_ids, class_ids, membership_probs,
@@ -143,7 +177,8 @@ def _score_text(input_file, vocabulary, scorer, output_file,
 
             seq_logprobs = [x / log_scale for x in seq_logprobs]
             seq_words = vocabulary.id_to_word[seq_word_ids]
-            output_file.write("# Sentence {0}\n".format(num_sentences))
+            sentence_index = validation_iter.sequence_indices[seq_index]
+            seq_output = ["# Sentence {0}\n".format(sentence_index + 1)]
 
             # In case some word IDs are ignored, seq_word_ids may contain more
             # items than seq_logprobs.
@@ -158,19 +193,29 @@ def _score_text(input_file, vocabulary, scorer, output_file,
                 predicted = seq_words[word_index + 1]
 
                 if scorer.unk_ignored() and word_id == unk_id:
-                    output_file.write("p({0} | {1}) is not predicted\n".format(
+                    seq_output.append("p({0} | {1}) is not predicted\n".format(
                         predicted, history))
                 else:
                     logprob = seq_logprobs[logprob_index]
                     logprob_index += 1
-                    output_file.write("log(p({0} | {1})) = {2}\n".format(
+                    seq_output.append("log(p({0} | {1})) = {2}\n".format(
                         predicted, history, logprob))
             assert logprob_index == len(seq_logprobs)
 
             # seq_logprob is in natural base.
-            output_file.write("Sentence perplexity: {0}\n\n".format(
+            seq_output.append("Sentence perplexity: {0}\n\n".format(
                 numpy.exp(-seq_logprob / len(seq_logprobs))))
+            pending_output[sentence_index] = ''.join(seq_output)
+
+        next_index = num_sentences - len(pending_output)
+        while next_index in pending_output:
+            output_file.write(pending_output.pop(next_index))
+            next_index += 1
 
+    assert not pending_output
+
+    print("Padding ratio of the mini-batches: {0:.3f}".format(
+        validation_iter.padding_ratio()))
     output_file.write("Number of sentences: {0}\n".format(num_sentences))
     output_file.write("Number of words: {0}\n".format(num_words))
     output_file.write("Number of out-of-vocabulary words: {0}\n".format(num_unks))
@@ -186,7 +231,7 @@ def _score_text(input_file, vocabulary, scorer, output_file,
         output_file.write("Perplexity: {0}\n".format(perplexity))
 
 def _score_utterances(input_file, vocabulary, scorer, output_file,
-                      log_base=None):
+                      log_base=None, batch_size=16):
     """Reads utterances from ``input_file``, computes LM scores using
     ``scorer``, and writes one score per line to ``output_file``.
 
@@ -195,6 +240,11 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
     Empty lines will be ignored, instead of interpreting them as the empty
     sentence ``<s> </s>``.
 
+    The utterances are read in chunks of
+    ``LinearBatchIterator.default_sort_window`` mini-batches. Each chunk is
+    sorted by length before dividing it into mini-batches, so that there's
+    little padding, and the scores are written in the original order.
+
     :type input_file: file object
     :param input_file: a file that contains the input sentences in SRILM n-best
                        format
@@ -213,6 +263,9 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
     :type log_base: int
     :param log_base: if set to other than None, convert log probabilities to
                      this base
+
+    :type batch_size: int
+    :param batch_size: number of sentences in one mini-batch
     """
 
     log_scale = 1.0 if log_base is None else numpy.log(log_base)
@@ -220,7 +273,9 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
     unk_id = vocabulary.word_to_id['<unk>']
     num_words = 0
     num_unks = 0
-    for line_num, line in enumerate(input_file):
+    num_scored = 0
+    chunk = []
+    for line in input_file:
         words = utterance_from_line(line)
         if not words:
             continue
@@ -228,18 +283,15 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
         word_ids = vocabulary.words_to_ids(words)
         num_words += word_ids.size
         num_unks += numpy.count_nonzero(word_ids == unk_id)
-        class_ids = [vocabulary.word_id_to_class_id[word_id]
-                     for word_id in word_ids]
-        probs = [vocabulary.get_word_prob(word_id)
-                 for word_id in word_ids]
-
-        lm_score = scorer.score_sequence(word_ids, class_ids, probs)
-        lm_score /= log_scale
-        output_file.write(str(lm_score) + '\n')
-
-        if (line_num + 1) % 1000 == 0:
-            print("{0} sentences scored.".format(line_num + 1))
-        sys.stdout.flush()
+        chunk.append(word_ids)
+        if len(chunk) >= batch_size * LinearBatchIterator.default_sort_window:
+            _score_chunk(chunk, scorer, output_file, log_scale, batch_size)
+            num_scored += len(chunk)
+            chunk = []
+            print("{0} sentences scored.".format(num_scored))
+            sys.stdout.flush()
+    if chunk:
+        _score_chunk(chunk, scorer, output_file, log_scale, batch_size)
 
     if num_words == 0:
         print("The input file contains no words.")
@@ -247,3 +299,106 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
         print("{0} words processed, including start-of-sentence and "
               "end-of-sentence tags, and {1} ({2:.1f} %) out-of-vocabulary "
               "words".format(num_words, num_unks, num_unks / num_words))
+
+def _score_chunk(sequences, scorer, output_file, log_scale, batch_size):
+    """Computes the LM scores of a list of word sequences in mini-batches of
+    sequences of similar length, and writes them in the original order.
+
+    :type sequences: list of ndarrays
+    :param sequences: a vector of word IDs for each sequence
+
+    :type scorer: TextScorer
+    :param scorer: a text scorer for rescoring the input sentences
+
+    :type output_file: file object
+    :param output_file: a file where to write the scores
+
+    :type log_scale: float
+    :param log_scale: divide log probabilities by this number to convert the log
+                      base
+
+    :type batch_size: int
+    :param batch_size: number of sequences in one mini-batch
+    """
+
+    order = sorted(range(len(sequences)),
+                   key=lambda index: len(sequences[index]))
+    scores = [None] * len(sequences)
+    for start in range(0, len(order), batch_size):
+        batch_indices = order[start:start + batch_size]
+        batch_scores = scorer.score_sequences(
+            [sequences[index] for index in batch_indices])
+        for index, lm_score in zip(batch_indices, batch_scores):
+            scores[index] = lm_score
+    for lm_score in scores:
+        output_file.write(str(lm_score / log_scale) + '\n')
+
+def _score_nbest(input_file, vocabulary, scorer, output_file, log_base=None):
+    """Reads n-best hypotheses from ``input_file``, computes LM scores using
+    ``scorer``, and writes one score per line to ``output_file``.
+
+    Each line starts with an utterance ID, followed by the words of the
+    hypothesis. The consecutive lines that have the same utterance ID are
+    scored together, so that the prefixes they share are evaluated only once.
+    Start-of-sentence and end-of-sentece tags (``<s>`` and ``</s>``) will be
+    inserted at the beginning and the end of each hypothesis, if they're
+    missing. A line that contains only the utterance ID is interpreted as the
+    empty sentence ``<s> </s>``. Empty lines will be ignored.
+
+    :type input_file: file object
+    :param input_file: a file that contains an utterance ID and a hypothesis on
+                       each line
+
+    :type vocabulary: Vocabulary
+    :param vocabulary: vocabulary that provides mapping between words and word
+                       IDs
+
+    :type scorer: NBestScorer
+    :param scorer: an n-best scorer for rescoring the input sentences
+
+    :type output_file: file object
+    :param output_file: a file where to write the scores
+
+    :type log_base: int
+    :param log_base: if set to other than None, convert log probabilities to
+                     this base
+    """
+
+    log_scale = 1.0 if log_base is None else numpy.log(log_base)
+
+    def write_scores(sequences):
+        for lm_score in scorer.score_sequences(sequences):
+            output_file.write(str(lm_score / log_scale) + '\n')
+
+    num_utterances = 0
+    utterance_id = None
+    sequences = []
+    for line in input_file:
+        fields = line.split(maxsplit=1)
+        if not fields:
+            continue
+        if fields[0] != utterance_id:
+            if sequences:
+                write_scores(sequences)
+                num_utterances += 1
+                if num_utterances % 100 == 0:
+                    print("{0} utterances scored.".format(num_utterances))
+                    sys.stdout.flush()
+            utterance_id = fields[0]
+            sequences = []
+        if len(fields) > 1:
+            words = utterance_from_line(fields[1])
+        else:
+            words = ['<s>', '</s>']
+        sequences.append(vocabulary.words_to_ids(words))
+    if sequences:
+        write_scores(sequences)
+        num_utterances += 1
+
+    print("{0} utterances scored.".format(num_utterances))
+    if scorer.num_predictions > 0:
+        print("Evaluated the neural network {0} times for {1} predicted words "
+              "({2:.1f} %).".format(
+                  scorer.num_evaluations,
+                  scorer.num_predictions,
+                  scorer.num_evaluations / scorer.num_predictions * 100))
@@ -347,7 +347,8 @@ def train(args):
                 LinearBatchIterator(validation_mmap,
                                     vocabulary,
                                     batch_size=args.batch_size,
-                                    max_sequence_length=None)
+                                    max_sequence_length=None,
+                                    sort_window=LinearBatchIterator.default_sort_window)
             trainer.set_validation(validation_iter, scorer)
         else:
             print("Cross-validation will not be performed.")
@@ -78,8 +78,13 @@ class GRULayer(BasicLayer):
         if self._network.mode.minibatch:
             sequences = [self._network.mask, layer_input_preact]
             non_sequences = [hidden_state_weights]
-            initial_hidden_state = tensor.zeros(
-                (num_sequences, self.output_size), dtype=theano.config.floatX)
+            if self._network.mode.stateful:
+                state_input = self._network.recurrent_state_input
+                initial_hidden_state = state_input[self.hidden_state_index][0]
+            else:
+                initial_hidden_state = tensor.zeros(
+                    (num_sequences, self.output_size),
+                    dtype=theano.config.floatX)
 
             hidden_state_output, _ = theano.scan(
                 self._create_time_step,
@@ -92,6 +97,10 @@ class GRULayer(BasicLayer):
                 strict=True)
 
             self.output = hidden_state_output
+            if self._network.mode.stateful:
+                # Keep the time step axis with size 1.
+                state_output = self._network.recurrent_state_output
+                state_output[self.hidden_state_index] = hidden_state_output[-1:]
         else:
             hidden_state_input = \
                 self._network.recurrent_state_input[self.hidden_state_index]
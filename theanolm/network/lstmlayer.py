@@ -82,10 +82,17 @@ class LSTMLayer(BasicLayer):
         if self._network.mode.minibatch:
             sequences = [self._network.mask, layer_input_preact]
             non_sequences = [hidden_state_weights]
-            initial_cell_state = tensor.zeros(
-                (num_sequences, self.output_size), dtype=theano.config.floatX)
-            initial_hidden_state = tensor.zeros(
-                (num_sequences, self.output_size), dtype=theano.config.floatX)
+            if self._network.mode.stateful:
+                state_input = self._network.recurrent_state_input
+                initial_cell_state = state_input[self.cell_state_index][0]
+                initial_hidden_state = state_input[self.hidden_state_index][0]
+            else:
+                initial_cell_state = tensor.zeros(
+                    (num_sequences, self.output_size),
+                    dtype=theano.config.floatX)
+                initial_hidden_state = tensor.zeros(
+                    (num_sequences, self.output_size),
+                    dtype=theano.config.floatX)
 
             state_outputs, _ = theano.scan(
                 self._create_time_step,
@@ -98,6 +105,11 @@ class LSTMLayer(BasicLayer):
                 strict=True)
 
             self.output = state_outputs[1]
+            if self._network.mode.stateful:
+                # Keep the time step axis with size 1.
+                state_output = self._network.recurrent_state_output
+                state_output[self.cell_state_index] = state_outputs[0][-1:]
+                state_output[self.hidden_state_index] = state_outputs[1][-1:]
         else:
             cell_state_input = \
                 self._network.recurrent_state_input[self.cell_state_index]
@@ -65,10 +65,22 @@ class Network(object):
                            steps. The output is a matrix with one less time
                            steps containing the probabilities of the words at
                            the next time step.
+          - ``stateful``: In mini-batch mode, read the initial recurrent states
+                          from ``recurrent_state_input`` and write the states
+                          after the last time step to
+                          ``recurrent_state_output``, so that long sequences
+                          can be processed in consecutive chunks.
+          - ``output_chunk_size``: Number of output classes that are processed
+                                   at a time, when computing the target log
+                                   probabilities without the full softmax
+                                   output.
         """
-        def __init__(self, minibatch=True, nce=False):
+        def __init__(self, minibatch=True, nce=False, stateful=False,
+                     output_chunk_size=8192):
             self.minibatch = minibatch
             self.nce = nce
+            self.stateful = stateful
+            self.output_chunk_size = output_chunk_size
 
     def __init__(self, architecture, vocabulary, class_prior_probs=None,
                  noise_dampening=1.0, mode=None, default_device=None,
@@ -337,6 +349,23 @@ class Network(object):
             raise RuntimeError("The final layer is not an output layer.")
         return self.output_layer.target_probs
 
+    def target_logprobs(self):
+        """Returns the output log probabilities for the predicted words.
+
+        Can be used only when target_class_ids is given. If the output layer
+        can compute the log probabilities of the target words directly, the
+        probabilities of the whole vocabulary are not needed, which saves
+        memory with large vocabularies.
+
+        :rtype: TensorVariable
+        :returns: a symbolic 2-dimensional matrix that contains the target word
+                  log probability for each time step and each sequence
+        """
+
+        if hasattr(self.output_layer, 'target_logprobs'):
+            return self.output_layer.target_logprobs
+        return tensor.log(self.target_probs())
+
     def unnormalized_logprobs(self):
         """Returns the unnormalized log probabilities for the predicted words.
 
@@ -70,9 +70,62 @@ class SoftmaxLayer(SamplingOutputLayer):
         # Compute unnormalized output and noise samples for NCE.
         self.unnormalized_logprobs = \
             self._get_unnormalized_logprobs(layer_input)
+        self.target_logprobs = \
+            self.unnormalized_logprobs - self._get_log_normalizer(layer_input)
         self.sample, self.sample_logprobs = \
             self._get_sample_tensors(layer_input)
         self.seqshared_sample, self.seqshared_sample_logprobs = \
             self._get_seqshared_sample_tensors(layer_input)
         self.shared_sample, self.shared_sample_logprobs = \
             self._get_shared_sample_tensors(layer_input)
+
+    def _get_log_normalizer(self, layer_input):
+        """Creates a tensor variable that computes the logarithm of the softmax
+        normalizer, without creating the preactivations of the whole vocabulary
+        at once.
+
+        The output classes are processed in chunks of ``output_chunk_size``
+        classes, given in the network mode. The log-sum-exp of the
+        preactivations is accumulated from one chunk to the next, keeping track
+        of the maximum preactivation for numerical stability. Memory usage does
+        not depend on the vocabulary size.
+
+        :type layer_input: TensorVariable
+        :param layer_input: a 3-dimensional tensor that contains the input
+                            vector for each time step in each sequence
+
+        :rtype: TensorVariable
+        :returns: a 2-dimensional tensor that contains the log normalizer for
+                  each time step and sequence
+        """
+
+        num_time_steps = layer_input.shape[0]
+        num_sequences = layer_input.shape[1]
+        layer_input = layer_input.reshape([num_time_steps * num_sequences,
+                                           layer_input.shape[2]])
+        weight = self.params[self._param_path('input/W')]
+        bias = self.params[self._param_path('input/b')]
+        chunk_size = self._network.mode.output_chunk_size
+        chunk_starts = numpy.arange(0, self.output_size, chunk_size,
+                                    dtype='int64')
+
+        def add_chunk(start, running_max, running_sum):
+            preact = tensor.dot(layer_input, weight[:, start:start + chunk_size])
+            preact += bias[start:start + chunk_size]
+            new_max = tensor.maximum(running_max, preact.max(axis=1))
+            running_sum *= tensor.exp(running_max - new_max)
+            running_sum += tensor.exp(preact - new_max[:, None]).sum(axis=1)
+            return new_max, running_sum
+
+        # The target preactivations are used as the initial maximum, because
+        # -inf would produce NaNs.
+        initial_max = self.unnormalized_logprobs.flatten()
+        initial_sum = tensor.zeros_like(initial_max)
+        (running_max, running_sum), _ = theano.scan(
+            add_chunk,
+            sequences=[chunk_starts],
+            outputs_info=[initial_max, initial_sum],
+            name='softmax_normalizer_chunks',
+            profile=self._profile)
+        result = running_max[-1] + tensor.log(running_sum[-1])
+        return result.reshape([num_time_steps, num_sequences])
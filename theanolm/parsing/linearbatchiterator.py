@@ -1,17 +1,31 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import numpy
 from theanolm.parsing.batchiterator import BatchIterator
 
 class LinearBatchIterator(BatchIterator):
     """Iterator for Reading Mini-Batches from a Single File in a Linear Order
+
+    If ``sort_window`` is given, the iterator reads that many mini-batches worth
+    of sentences at a time, sorts them by length, and divides them into
+    mini-batches, so that there's less padding in the mini-batches. The
+    original index of every sequence in the last mini-batch is available in
+    ``sequence_indices``, so that the caller can restore the original order.
+    ``padding_ratio()`` tells the fraction of the mini-batch elements that
+    were padding during the last pass over the data.
     """
 
+    # Number of mini-batches that are sorted at a time, when sorting is used
+    # for scoring and validation.
+    default_sort_window = 64
+
     def __init__(self,
                  input_files,
                  vocabulary,
                  batch_size=1,
-                 max_sequence_length=None):
+                 max_sequence_length=None,
+                 sort_window=None):
         """Constructs an iterator for reading mini-batches from given file or
         memory map.
 
@@ -29,6 +43,10 @@ class LinearBatchIterator(BatchIterator):
         :type max_sequence_length: int
         :param max_sequence_length: if not None, limit to sequences shorter than
                                     this
+
+        :type sort_window: int
+        :param sort_window: if not None, sort this many mini-batches worth of
+                            sequences by length at a time
         """
 
         if isinstance(input_files, (list, tuple)):
@@ -38,6 +56,13 @@ class LinearBatchIterator(BatchIterator):
                                  "least one input file.")
         else:
             self._input_files = [input_files]
+        self._sort_window = sort_window
+        # Original index of each sequence in the last mini-batch.
+        self.sequence_indices = []
+        # Number of words and number of elements including padding in the
+        # mini-batches of the last pass.
+        self.num_words = 0
+        self.num_elements = 0
         self._reset()
 
         super().__init__(vocabulary, batch_size, max_sequence_length)
@@ -53,6 +78,78 @@ class LinearBatchIterator(BatchIterator):
         self._file_id = 0
         self._input_file = self._input_files[self._file_id]
         self._input_file.seek(0)
+        # Sorted mini-batches that have not been returned yet, and the number
+        # of sequences read since the beginning of the file.
+        self._sorted_batches = []
+        self._num_read = 0
+        self._num_returned = 0
+
+    def __next__(self):
+        """Returns the next mini-batch read from the file.
+
+        If ``sort_window`` was given, the mini-batches are created from
+        sequences of similar length. Sets ``sequence_indices`` to the original
+        indices of the sequences in the returned mini-batch.
+
+        :rtype: tuple of ndarrays
+        :returns: word ID, file ID, and mask matrix
+        """
+
+        if self._sort_window is None:
+            word_ids, file_ids, mask = super().__next__()
+            first_index = self._num_returned
+            self.sequence_indices = list(range(first_index,
+                                               first_index + mask.shape[1]))
+        else:
+            if not self._sorted_batches:
+                self._read_window()
+            if not self._sorted_batches:
+                self._reset()
+                raise StopIteration
+            self.sequence_indices, sequences = self._sorted_batches.pop(0)
+            word_ids, file_ids, mask = self._prepare_batch(sequences)
+
+        if self._num_returned == 0:
+            self.num_words = 0
+            self.num_elements = 0
+        self._num_returned += mask.shape[1]
+        self.num_words += numpy.count_nonzero(mask)
+        self.num_elements += mask.size
+        return word_ids, file_ids, mask
+
+    def padding_ratio(self):
+        """Returns the fraction of mini-batch elements that were past the
+        sequence ends during the last pass over the data.
+
+        :rtype: float
+        :returns: number of padding elements divided by the total number of
+                  elements
+        """
+
+        if self.num_elements == 0:
+            return 0.0
+        return 1.0 - self.num_words / self.num_elements
+
+    def _read_window(self):
+        """Reads ``sort_window`` mini-batches worth of sequences, sorts them by
+        length, and divides them into mini-batches.
+        """
+
+        indexed_sequences = []
+        while len(indexed_sequences) < self.batch_size * self._sort_window:
+            sequence = self._read_sequence()
+            if sequence is None:
+                break
+            if len(sequence) < 2:
+                continue
+            indexed_sequences.append((self._num_read, sequence))
+            self._num_read += 1
+
+        indexed_sequences.sort(key=lambda x: len(x[1]))
+        for start in range(0, len(indexed_sequences), self.batch_size):
+            batch = indexed_sequences[start:start + self.batch_size]
+            self._sorted_batches.append(([index for index, _ in batch],
+                                         [sequence for _, sequence in batch]))
 
     def _readline(self):
         """Reads the next input line.
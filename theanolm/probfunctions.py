@@ -3,53 +3,44 @@
 
 import numpy
 import theano
-from decimal import *
 
 logprob_type = numpy.dtype(theano.config.floatX).type
 
 def interpolate_linear(logprob1, logprob2, weight1):
     """Performs linear interpolation of two probabilities.
 
-    If a probability is so small that it will be rounded to zero, uses the
-    decimal library. If a weight is zero, the corresponding log probability will
-    be ignored. Otherwise if the log probability was ``-inf``, multiplication
-    would result in a ``nan``.
+    The computation is performed in the log domain using ``numpy.logaddexp()``,
+    so that it won't underflow even if the probabilities are very small. If a
+    weight is zero, the corresponding log probability will be ignored. The
+    input log probabilities may also be arrays, in which case the interpolation
+    is performed elementwise.
 
-    :type logprob1: logprob_type
+    :type logprob1: logprob_type or numpy.ndarray
     :param logprob1: logarithm of first input probability
 
-    :type logprob2: logprob_type
+    :type logprob2: logprob_type or numpy.ndarray
     :param logprob2: logarithm of second input probability
 
     :type weight1: logprob_type
     :param weight1: interpolation weight for the first probability
 
-    :rtype: logprob_type
+    :rtype: logprob_type or numpy.ndarray
     :returns: logarithm of the weighted sum of the input probabilities
     """
 
-    prob1 = numpy.exp(numpy.float64(logprob1))
-    prob2 = numpy.exp(numpy.float64(logprob2))
-    if (prob1 > 0) and (prob2 > 0):
-        weight2 = 1.0 - weight1
-        prob = weight1 * prob1
-        prob += weight2 * prob2
-        return logprob_type(numpy.log(prob))
+    weight1 = numpy.float64(weight1)
+    weight2 = 1.0 - weight1
+    logprob1 = numpy.asarray(logprob1, dtype='float64')
+    logprob2 = numpy.asarray(logprob2, dtype='float64')
+    # log(0) = -inf, and adding a finite or -inf log probability to it gives
+    # -inf, which will be ignored by logaddexp().
+    with numpy.errstate(divide='ignore'):
+        result = numpy.logaddexp(numpy.log(weight1) + logprob1,
+                                 numpy.log(weight2) + logprob2)
+    if result.ndim == 0:
+        return logprob_type(result)
     else:
-        # An exp() resulted in an underflow (or -inf logprob). Use the decimal
-        # library.
-        getcontext().prec = 16
-        d_weight1 = Decimal(weight1)
-        d_weight2 = Decimal(1.0) - d_weight1
-        d_logprob1 = Decimal(logprob1)
-        d_logprob2 = Decimal(logprob2)
-        d_zero = Decimal(0.0)
-        d_prob = d_zero
-        if d_weight1 != d_zero:
-            d_prob += d_weight1 * d_logprob1.exp()
-        if d_weight2 != d_zero:
-            d_prob += d_weight2 * d_logprob2.exp()
-        return logprob_type(d_prob.ln())
+        return result.astype(logprob_type)
 
 def interpolate_loglinear(logprob1, logprob2, prior1, prior2):
     """Performs log-linear interpolation of two probabilities.
@@ -59,7 +50,7 @@ def interpolate_loglinear(logprob1, logprob2, prior1, prior2):
 
     If a prior is zero, the corresponding log probability will be ignored.
     Otherwise if the log probability was ``-inf``, multiplication would result
-    in a ``nan``.
+    in a ``nan``. The input log probabilities may also be arrays.
 
     :type logprob1: logprob_type
     :param logprob1: first input log probability
@@ -82,5 +73,5 @@ def interpolate_loglinear(logprob1, logprob2, prior1, prior2):
         result += prior1 * logprob1;
     if prior2 != 0:
         result += prior2 * logprob2;
-    assert not numpy.isnan(result)
+    assert not numpy.any(numpy.isnan(result))
     return result
@@ -1,3 +1,7 @@
 from theanolm.scoring.textscorer import TextScorer
+from theanolm.scoring.nbestscorer import NBestScorer
 from theanolm.scoring.latticedecoder import LatticeDecoder
 from theanolm.scoring.slflattice import SLFLattice
+from theanolm.scoring.arraylattice import ArrayLattice
+from theanolm.scoring.latticeprefetcher import LatticePrefetcher
+from theanolm.scoring.decodingstatistics import DecodingStatistics
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import logging
+import numpy
+from theanolm.exceptions import InputError
+from theanolm.probfunctions import logprob_type
+from theanolm.scoring.lattice import topological_sort_key
+
+class ArrayLattice(object):
+    """Array-Backed Word Lattice
+
+    A compact, read-only representation of a word lattice. The attributes of the
+    links are stored in numpy arrays that are sorted by the start node. The
+    outgoing links of node ``i`` are the links from ``out_offsets[i]`` to
+    ``out_offsets[i+1]``. Words are stored as indices to the ``words`` list.
+    Missing values are represented by NaN in the time and log probability
+    arrays and by -1 in the word array.
+
+    The nodes are sorted topologically when the object is created. Holding a
+    large number of lattices in this form takes much less memory than holding
+    ``Lattice`` objects. The decoder traverses the lattice using the node and
+    link indices, so a lattice is converted into this form right after it has
+    been read, and the ``Lattice`` object can be freed.
+    """
+
+    def __init__(self, lattice):
+        """Creates the arrays from the nodes and links of a lattice.
+
+        :type lattice: Lattice
+        :param lattice: a lattice to be converted
+        """
+
+        self.utterance_id = lattice.utterance_id
+        self.lm_scale = lattice.lm_scale
+        self.wi_penalty = lattice.wi_penalty
+        self.initial_node_id = lattice.initial_node.id
+        self.final_node_id = lattice.final_node.id
+
+        num_nodes = len(lattice.nodes)
+        self.node_times = numpy.array(
+            [numpy.nan if node.time is None else node.time
+             for node in lattice.nodes],
+            dtype='float64')
+
+        # A stable sort keeps the outgoing links of each node in the original
+        # order.
+        links = sorted(lattice.links, key=lambda link: link.start_node.id)
+        self.link_starts = numpy.array(
+            [link.start_node.id for link in links], dtype='int32')
+        self.link_ends = numpy.array(
+            [link.end_node.id for link in links], dtype='int32')
+
+        self.words = []
+        word_to_index = dict()
+        link_words = []
+        for link in links:
+            if link.word is None:
+                link_words.append(-1)
+                continue
+            index = word_to_index.get(link.word)
+            if index is None:
+                index = len(self.words)
+                word_to_index[link.word] = index
+                self.words.append(link.word)
+            link_words.append(index)
+        self.link_words = numpy.array(link_words, dtype='int32')
+
+        self.link_ac_logprobs = numpy.array(
+            [numpy.nan if link.ac_logprob is None else link.ac_logprob
+             for link in links],
+            dtype=logprob_type)
+        self.link_lm_logprobs = numpy.array(
+            [numpy.nan if link.lm_logprob is None else link.lm_logprob
+             for link in links],
+            dtype=logprob_type)
+
+        num_out_links = numpy.bincount(self.link_starts, minlength=num_nodes)
+        self.out_offsets = numpy.zeros(num_nodes + 1, dtype='int64')
+        numpy.cumsum(num_out_links, out=self.out_offsets[1:])
+
+        self.sorted_node_ids = self._sort_nodes()
+
+    def num_nodes(self):
+        """Returns the number of nodes in the lattice.
+
+        :rtype: int
+        :returns: the number of nodes
+        """
+
+        return len(self.node_times)
+
+    def num_links(self):
+        """Returns the number of links in the lattice.
+
+        :rtype: int
+        :returns: the number of links
+        """
+
+        return len(self.link_starts)
+
+    def out_links(self, node_id):
+        """Returns the indices of the outgoing links of a node.
+
+        :type node_id: int
+        :param node_id: ID of a node
+
+        :rtype: range
+        :returns: indices to the link arrays
+        """
+
+        return range(self.out_offsets[node_id], self.out_offsets[node_id + 1])
+
+    def node_time(self, node_id):
+        """Returns the time of a node.
+
+        :type node_id: int
+        :param node_id: ID of a node
+
+        :rtype: float
+        :returns: the time of the node, or ``None`` if the node has no time
+        """
+
+        time = self.node_times[node_id]
+        return None if numpy.isnan(time) else float(time)
+
+    def _sort_nodes(self):
+        """Sorts nodes topologically, then by time.
+
+        Uses the same order as ``Lattice.sorted_nodes()``.
+
+        :rtype: numpy.ndarray
+        :returns: the node IDs in sorted order
+        """
+
+        times = [None if numpy.isnan(time) else time
+                 for time in self.node_times.tolist()]
+        link_ends = self.link_ends.tolist()
+        offsets = self.out_offsets.tolist()
+        in_degrees = numpy.bincount(self.link_ends,
+                                    minlength=self.num_nodes()).tolist()
+
+        result = []
+        node_id = self.initial_node_id
+        node_queue = [(topological_sort_key(times[node_id], 0), node_id)]
+        counter = 1
+        while node_queue:
+            _, node_id = heapq.heappop(node_queue)
+            result.append(node_id)
+            for next_id in link_ends[offsets[node_id]:offsets[node_id + 1]]:
+                in_degrees[next_id] -= 1
+                if in_degrees[next_id] == 0:
+                    key = topological_sort_key(times[next_id], counter)
+                    heapq.heappush(node_queue, (key, next_id))
+                    counter += 1
+                elif in_degrees[next_id] < 0:
+                    raise InputError("Word lattice contains a cycle.")
+
+        if len(result) < self.num_nodes():
+            logging.warning("Word lattice contains unreachable nodes.")
+        return numpy.array(result, dtype='int32')
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+
+class DecodingStatistics(object):
+    """Statistics of Decoding a Lattice
+
+    Counters that the lattice decoder updates while decoding a lattice. They
+    tell where the time is spent and how effective the pruning is, so that the
+    lattices and settings that drive the decoding cost can be found. The
+    statistics are reset at the beginning of each lattice.
+
+    The sizes of the neural network batches are collected in a histogram, whose
+    bins are the powers of two. A batch of N tokens is counted in the smallest
+    bin that is at least N.
+    """
+
+    def __init__(self):
+        """Constructs zero statistics.
+        """
+
+        self.reset()
+
+    def reset(self, num_nodes=0, num_links=0):
+        """Sets all the counters to zero.
+
+        :type num_nodes: int
+        :param num_nodes: number of nodes in the lattice to be decoded
+
+        :type num_links: int
+        :param num_links: number of links in the lattice to be decoded
+        """
+
+        self.num_nodes = num_nodes
+        self.num_links = num_links
+        self.tokens_created = 0
+        self.tokens_recombined = 0
+        self.tokens_pruned = 0
+        self.tokens_early_pruned = 0
+        self.nn_calls = 0
+        self.nn_evaluations = 0
+        self.batch_sizes = dict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.peak_tokens = 0
+        self.peak_state_bytes = 0
+        self.budget_status = None
+        self.nn_time = 0.0
+        self.decode_time = 0.0
+
+    def add_nn_call(self, batch_size, elapsed_time):
+        """Records a call to the neural network.
+
+        :type batch_size: int
+        :param batch_size: number of tokens in the batch
+
+        :type elapsed_time: float
+        :param elapsed_time: time in seconds spent in the call
+        """
+
+        self.nn_calls += 1
+        self.nn_evaluations += batch_size
+        self.nn_time += elapsed_time
+        bin = 1 if batch_size <= 1 else 2 ** math.ceil(math.log2(batch_size))
+        self.batch_sizes[bin] = self.batch_sizes.get(bin, 0) + 1
+
+    def to_dict(self):
+        """Returns the statistics in a dictionary that can be serialized to
+        JSON.
+
+        The time that was not spent in the neural network is reported as Python
+        overhead.
+
+        :rtype: dict
+        :returns: a mapping from the statistic names to values
+        """
+
+        return {
+            'nodes': self.num_nodes,
+            'links': self.num_links,
+            'tokens_created': self.tokens_created,
+            'tokens_recombined': self.tokens_recombined,
+            'tokens_pruned': self.tokens_pruned,
+            'tokens_early_pruned': self.tokens_early_pruned,
+            'nn_calls': self.nn_calls,
+            'nn_evaluations': self.nn_evaluations,
+            'batch_sizes': {str(bin): count
+                            for bin, count in sorted(self.batch_sizes.items())},
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'peak_tokens': self.peak_tokens,
+            'peak_state_bytes': self.peak_state_bytes,
+            'budget_status': self.budget_status,
+            'decode_time': self.decode_time,
+            'nn_time': self.nn_time,
+            'python_time': max(self.decode_time - self.nn_time, 0.0)
+        }
@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 
 from abc import ABCMeta, abstractmethod
+import heapq
 import logging
+import numpy
 from theanolm.exceptions import InputError
 
 class Lattice(object):
@@ -91,24 +93,28 @@ class Lattice(object):
         Returns a list which contains the nodes in sorted order. Uses the Kahn's
         algorithm to sort the nodes topologically, but always picks the node
         from the queue that has the lowest time stamp, if the nodes contain time
-        stamps.
+        stamps. Nodes without a time stamp are picked last, and of the nodes
+        with equal time stamps, the one that was added to the queue last is
+        picked first. The queue is a heap, so sorting takes O(N log N) time.
         """
 
         result = []
-        # A queue of nodes to be visited next:
-        node_queue = [self.initial_node]
+        # A heap of nodes to be visited next. The counter breaks ties.
+        initial_key = topological_sort_key(self.initial_node.time, 0)
+        node_queue = [(initial_key, self.initial_node)]
+        counter = 1
         # The number of incoming links not traversed yet:
         in_degrees = [len(node.in_links) for node in self.nodes]
         while node_queue:
-            node = node_queue.pop()
+            _, node = heapq.heappop(node_queue)
             result.append(node)
             for link in node.out_links:
                 next_node = link.end_node
                 in_degrees[next_node.id] -= 1
                 if in_degrees[next_node.id] == 0:
-                    node_queue.append(next_node)
-                    node_queue.sort(key=lambda x: (x.time is None, x.time),
-                                    reverse=True)
+                    key = topological_sort_key(next_node.time, counter)
+                    heapq.heappush(node_queue, (key, next_node))
+                    counter += 1
                 elif in_degrees[next_node.id] < 0:
                     raise InputError("Word lattice contains a cycle.")
 
@@ -119,7 +125,322 @@ class Lattice(object):
 
         return result
 
-    def _add_link(self, start_node, end_node):
+    def prune_by_posterior(self, min_posterior, lm_scale=None,
+                           wi_penalty=None):
+        """Removes links whose posterior probability is low, and nodes that are
+        not on any path from the initial node to the final node.
+
+        The posterior probabilities are computed using the forward-backward
+        algorithm from the acoustic and LM scores of the lattice. Like in SRILM,
+        the total log probabilities are divided by the LM scale, so that the
+        posteriors are not dominated by the acoustic scores. The links of the
+        best path are always kept, so that the final node remains reachable.
+
+        :type min_posterior: float
+        :param min_posterior: remove links whose posterior probability is lower
+                              than this
+
+        :type lm_scale: float
+        :param lm_scale: scale LM log probabilities by this factor; if ``None``,
+                         uses the LM scale of the lattice, or 1.0 if the lattice
+                         doesn't specify it
+
+        :type wi_penalty: float
+        :param wi_penalty: add this value to the log probability of each word;
+                           if ``None``, uses the word insertion penalty of the
+                           lattice, or 0.0 if the lattice doesn't specify it
+
+        :rtype: int
+        :returns: the number of links that were removed
+        """
+
+        if lm_scale is None:
+            lm_scale = 1.0 if self.lm_scale is None else self.lm_scale
+        if wi_penalty is None:
+            wi_penalty = 0.0 if self.wi_penalty is None else self.wi_penalty
+
+        sorted_nodes = self.sorted_nodes()
+        scores = dict()
+        for link in self.links:
+            score = 0.0
+            if not link.ac_logprob is None:
+                score += link.ac_logprob
+            if not link.lm_logprob is None:
+                score += link.lm_logprob * lm_scale
+            if (not link.word is None) and (not link.word.startswith('!')):
+                score += wi_penalty
+            if lm_scale > 0:
+                score /= lm_scale
+            scores[id(link)] = score
+
+        # Forward and backward log probabilities, and the best path score from
+        # the initial node, of each node.
+        num_nodes = len(self.nodes)
+        forward = [-numpy.inf] * num_nodes
+        best = [-numpy.inf] * num_nodes
+        best_link = [None] * num_nodes
+        forward[self.initial_node.id] = 0.0
+        best[self.initial_node.id] = 0.0
+        for node in sorted_nodes:
+            for link in node.out_links:
+                end_id = link.end_node.id
+                score = scores[id(link)]
+                forward[end_id] = numpy.logaddexp(forward[end_id],
+                                                  forward[node.id] + score)
+                if best[node.id] + score > best[end_id]:
+                    best[end_id] = best[node.id] + score
+                    best_link[end_id] = link
+        backward = [-numpy.inf] * num_nodes
+        backward[self.final_node.id] = 0.0
+        for node in reversed(sorted_nodes):
+            for link in node.out_links:
+                backward[node.id] = numpy.logaddexp(
+                    backward[node.id],
+                    scores[id(link)] + backward[link.end_node.id])
+
+        total_logprob = forward[self.final_node.id]
+        if total_logprob == -numpy.inf:
+            raise InputError("Could not reach the final node of word lattice.")
+
+        keep = set()
+        node = self.final_node
+        while not best_link[node.id] is None:
+            keep.add(id(best_link[node.id]))
+            node = best_link[node.id].start_node
+        min_logprob = numpy.log(min_posterior) if min_posterior > 0 \
+                      else -numpy.inf
+        for link in self.links:
+            logprob = forward[link.start_node.id] + scores[id(link)] + \
+                      backward[link.end_node.id] - total_logprob
+            if logprob >= min_logprob:
+                keep.add(id(link))
+
+        num_links = len(self.links)
+        self._remove_links([link for link in self.links
+                            if not id(link) in keep])
+        return num_links - len(self.links)
+
+    def merge_equivalent_nodes(self, lm_scale=None):
+        """Reduces the lattice by merging nodes that are equivalent with regard
+        to the word sequences.
+
+        Two nodes are merged if they have the same words on the incoming links
+        from the same nodes, or the same words on the outgoing links to the same
+        nodes. Then the set of word sequences in the lattice doesn't change.
+        After merging, the parallel links that have the same word are
+        redundant. Of those only the link with the best score is kept. Merging
+        is repeated forward and backward until no more nodes can be merged. The
+        time of a merged node is the earliest time of the original nodes.
+
+        :type lm_scale: float
+        :param lm_scale: scale LM log probabilities by this factor when
+                         selecting the best of parallel links; if ``None``,
+                         uses the LM scale of the lattice, or 1.0 if the lattice
+                         doesn't specify it
+
+        :rtype: int
+        :returns: the number of nodes that were removed
+        """
+
+        if lm_scale is None:
+            lm_scale = 1.0 if self.lm_scale is None else self.lm_scale
+
+        def score(link):
+            result = 0.0
+            if not link.ac_logprob is None:
+                result += link.ac_logprob
+            if not link.lm_logprob is None:
+                result += link.lm_logprob * lm_scale
+            return result
+
+        num_nodes = len(self.nodes)
+        removed_links = []
+        for node in self.nodes:
+            removed_links.extend(self._merge_parallel_links(node, score))
+        self._remove_links(removed_links)
+        while True:
+            merged = self._merge_nodes(True, score)
+            merged |= self._merge_nodes(False, score)
+            if not merged:
+                break
+        return num_nodes - len(self.nodes)
+
+    def _merge_nodes(self, by_predecessors, score):
+        """Merges nodes that have identical incoming or outgoing links.
+
+        With ``by_predecessors`` set, the nodes are processed in topological
+        order, so that the predecessors of a node have been merged before the
+        node is compared to other nodes. Otherwise the nodes are processed in
+        reverse order. The merged nodes are removed and the remaining nodes
+        are renumbered.
+
+        :type by_predecessors: bool
+        :param by_predecessors: if ``True``, compares the incoming links of the
+                                nodes, otherwise compares the outgoing links
+
+        :type score: function
+        :param score: a function that computes the score of a link
+
+        :rtype: bool
+        :returns: ``True`` if any nodes were merged, ``False`` otherwise
+        """
+
+        sorted_nodes = self.sorted_nodes()
+        if not by_predecessors:
+            sorted_nodes.reverse()
+
+        merged = False
+        removed_links = []
+        node_keys = dict()
+        for node in sorted_nodes:
+            if (node is self.initial_node) or (node is self.final_node):
+                continue
+            if by_predecessors:
+                key = frozenset((link.start_node.id, link.word)
+                                for link in node.in_links)
+            else:
+                key = frozenset((link.end_node.id, link.word)
+                                for link in node.out_links)
+            if not key in node_keys:
+                node_keys[key] = node
+                continue
+
+            target = node_keys[key]
+            for link in node.in_links:
+                link.end_node = target
+                target.in_links.append(link)
+            for link in node.out_links:
+                link.start_node = target
+                target.out_links.append(link)
+            node.in_links = []
+            node.out_links = []
+            if (target.time is None) or \
+               ((not node.time is None) and (node.time < target.time)):
+                target.time = node.time
+            removed_links.extend(self._merge_parallel_links(target, score))
+            merged = True
+
+        if merged:
+            self._remove_links(removed_links)
+        return merged
+
+    def _merge_parallel_links(self, node, score):
+        """Removes the outgoing links of a node that lead to the same node with
+        the same word, except the one with the best score.
+
+        Also incoming links that come from the same node with the same word are
+        merged.
+
+        :type node: Node
+        :param node: the node whose links will be merged
+
+        :type score: function
+        :param score: a function that computes the score of a link
+
+        :rtype: list of Links
+        :returns: the links that were removed
+        """
+
+        removed = []
+
+        best_links = dict()
+        for link in node.out_links:
+            key = (link.end_node.id, link.word)
+            best_link = best_links.get(key)
+            if best_link is None:
+                best_links[key] = link
+            elif score(link) > score(best_link):
+                best_links[key] = link
+                removed.append(best_link)
+            else:
+                removed.append(link)
+
+        best_links = dict()
+        for link in node.in_links:
+            key = (link.start_node.id, link.word)
+            best_link = best_links.get(key)
+            if best_link is None:
+                best_links[key] = link
+            elif score(link) > score(best_link):
+                best_links[key] = link
+                removed.append(best_link)
+            else:
+                removed.append(link)
+
+        for link in removed:
+            if link in link.start_node.out_links:
+                link.start_node.out_links.remove(link)
+            if link in link.end_node.in_links:
+                link.end_node.in_links.remove(link)
+        return removed
+
+    def _remove_links(self, links):
+        """Removes links from the lattice, and then removes the nodes that are
+        not on any path from the initial node to the final node.
+
+        The remaining nodes are renumbered, so that the ID of a node is its
+        index in the node list.
+
+        :type links: list of Links
+        :param links: the links to be removed
+        """
+
+        removed = set(id(link) for link in links)
+        links = [link for link in self.links if not id(link) in removed]
+        for node in self.nodes:
+            node.out_links = []
+            node.in_links = []
+        for link in links:
+            link.start_node.out_links.append(link)
+            link.end_node.in_links.append(link)
+
+        # Find the nodes that are reachable from the initial node and the nodes
+        # from which the final node is reachable.
+        forward = { self.initial_node.id }
+        stack = [self.initial_node]
+        while stack:
+            for link in stack.pop().out_links:
+                if not link.end_node.id in forward:
+                    forward.add(link.end_node.id)
+                    stack.append(link.end_node)
+        backward = { self.final_node.id }
+        stack = [self.final_node]
+        while stack:
+            for link in stack.pop().in_links:
+                if not link.start_node.id in backward:
+                    backward.add(link.start_node.id)
+                    stack.append(link.start_node)
+        keep = forward & backward
+
+        self.links = [link for link in links
+                      if (link.start_node.id in keep) and
+                         (link.end_node.id in keep)]
+        self.nodes = [node for node in self.nodes if node.id in keep]
+        for node in self.nodes:
+            node.out_links = []
+            node.in_links = []
+        for link in self.links:
+            link.start_node.out_links.append(link)
+            link.end_node.in_links.append(link)
+        for new_id, node in enumerate(self.nodes):
+            node.id = new_id
+
+    def add_node(self, time=None):
+        """Adds a node to the end of the node list.
+
+        :type time: float
+        :param time: time of the new node, or ``None``
+
+        :rtype: Node
+        :returns: the created node
+        """
+
+        node = self.Node(len(self.nodes))
+        node.time = time
+        self.nodes.append(node)
+        return node
+
+    def add_link(self, start_node, end_node):
         """Adds a link between two nodes.
 
         :type start_node: int
@@ -137,3 +458,22 @@ class Lattice(object):
         start_node.out_links.append(link)
         end_node.in_links.append(link)
         return link
+
+def topological_sort_key(time, counter):
+    """Creates a key for the topological sort queue.
+
+    :type time: float
+    :param time: time stamp of a node, or ``None``
+
+    :type counter: int
+    :param counter: number of nodes added to the queue before this node
+
+    :rtype: tuple
+    :returns: a key that orders nodes by time, nodes without time last, and
+              nodes with equal time in reverse order of insertion
+    """
+
+    if time is None:
+        return (True, 0.0, -counter)
+    else:
+        return (False, time, -counter)
@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from copy import deepcopy
+from collections import OrderedDict
 import math
 import logging
+import time
 import numpy
-import theano
-from theano import tensor
-from theanolm.network import RecurrentState
+from theanolm.exceptions import InputError
 from theanolm.probfunctions import *
+from theanolm.scoring.arraylattice import ArrayLattice
+from theanolm.scoring.decodingstatistics import DecodingStatistics
+from theanolm.scoring.lrucache import LRUCache
+from theanolm.scoring.slflattice import SLFLattice
+from theanolm.scoring.statearena import StateArena
+from theanolm.scoring.stepfunction import create_step_function
+from theanolm.scoring.timeframe import TimeFrame
+from theanolm.scoring.timeindex import TimeIndex
+from theanolm.scoring.wordhistory import WordHistory
 
 class LatticeDecoder(object):
     """Word Lattice Decoding Using a Neural Network Language Model
@@ -18,12 +26,28 @@ class LatticeDecoder(object):
         """Decoding Token
 
         A token represents a partial path through a word lattice. The decoder
-        propagates a set of tokens through the lattice by
+        propagates a set of tokens through the lattice by creating a copy of
+        each token for every outgoing link of a node.
+
+        Tokens are created in large numbers, so the attributes are stored in
+        slots. The word history is a ``WordHistory`` object that is shared with
+        the token that this token was copied from, so copying a token doesn't
+        copy the history.
+
+        When the decoder builds a rescored lattice, ``back_links`` contains a
+        (token, link, lm_logprob) tuple for each token that was propagated or
+        recombined into this token, where ``link`` is the index of the lattice
+        link and ``lm_logprob`` is the interpolated LM log probability of the
+        link. ``None`` in place of a link means the end of the sentence.
         """
 
+        __slots__ = ('_history', 'state', 'ac_logprob', 'lat_lm_logprob',
+                     'nn_lm_logprob', 'lm_logprob', 'recombination_hash',
+                     'total_logprob', 'back_links')
+
         def __init__(self,
-                     history=[],
-                     state=[],
+                     history=(),
+                     state=None,
                      ac_logprob=logprob_type(0.0),
                      lat_lm_logprob=logprob_type(0.0),
                      nn_lm_logprob=logprob_type(0.0)):
@@ -36,12 +60,12 @@ class LatticeDecoder(object):
             New tokens will not have recombination hash and total log
             probability set.
 
-            :type history: list of ints
+            :type history: list of ints or WordHistory
             :param history: word IDs that the token has passed
 
-            :type state: RecurrentState
-            :param state: the state of the recurrent layers for a single
-                          sequence
+            :type state: int
+            :param state: a handle to the state of the recurrent layers in the
+                          ``StateArena`` of the decoder
 
             :type ac_logprob: logprob_type
             :param ac_logprob: sum of the acoustic log probabilities of the
@@ -56,23 +80,31 @@ class LatticeDecoder(object):
                                   lattice links
             """
 
-            self.history = history
+            if (history is None) or isinstance(history, WordHistory):
+                self._history = history
+            else:
+                self._history = WordHistory.from_words(history)
             self.state = state
             self.ac_logprob = ac_logprob
             self.lat_lm_logprob = lat_lm_logprob
             self.nn_lm_logprob = nn_lm_logprob
+            self.lm_logprob = None
             self.recombination_hash = None
             self.total_logprob = None
+            self.back_links = None
 
         @classmethod
         def copy(classname, token):
             """Creates a copy of a token.
 
-            The recurrent layer states will not be copied - a pointer will be
+            The recurrent layer states will not be copied - the handle will be
             copied instead. There's no need to copy the structure, since we
-            never modify the state of a token, but replace it if necessary.
+            never modify the state of a token, but replace it if necessary. The
+            caller is responsible for retaining the state for the new token.
+            The same applies to the word history.
 
-            Recombination hash and total log probability will not be copied.
+            Recombination hash, total log probability, and back links will not
+            be copied.
 
             :type token: LatticeDecoder.Token
             :param token: a token to copy
@@ -81,26 +113,106 @@ class LatticeDecoder(object):
             :returns: a copy of ``token``
             """
 
-            return classname(deepcopy(token.history),
+            return classname(token._history,
                              token.state,
                              token.ac_logprob,
                              token.lat_lm_logprob,
                              token.nn_lm_logprob)
 
+        @property
+        def history(self):
+            """The word IDs that the token has passed.
+
+            Creates a tuple of the entire history, so this should not be used
+            in the inner loop of the decoder.
+
+            :rtype: tuple of ints and strs
+            :returns: the words in the history of the token
+            """
+
+            if self._history is None:
+                return ()
+            return self._history.last_words()
+
+        @property
+        def word_history(self):
+            """The word history object of the token, which is shared with the
+            tokens that it has been copied from.
+
+            :rtype: WordHistory
+            :returns: the history, or ``None`` if the history is empty
+            """
+
+            return self._history
+
+        def history_length(self):
+            """Returns the number of words in the history.
+
+            :rtype: int
+            :returns: the number of words that the token has passed
+            """
+
+            if self._history is None:
+                return 0
+            return len(self._history)
+
+        def last_words(self, count):
+            """Returns the last words in the history.
+
+            :type count: int
+            :param count: number of words to return, or ``None`` for the entire
+                          history
+
+            :rtype: tuple of ints and strs
+            :returns: at most ``count`` last words in the history
+            """
+
+            if self._history is None:
+                return ()
+            return self._history.last_words(count)
+
+        def last_word(self):
+            """Returns the last word in the history.
+
+            :rtype: int or str
+            :returns: the last word that the token has passed
+            """
+
+            return self._history.word
+
+        def append_word(self, word):
+            """Appends a word to the history of the token.
+
+            The history object is not modified, since it may be shared with
+            other tokens. A new history is created that points to the old one.
+
+            :type word: int or str
+            :param word: word ID or OOV word as text
+            """
+
+            if self._history is None:
+                self._history = WordHistory(word)
+            else:
+                self._history = self._history.append(word)
+
         def recompute_hash(self, recombination_order):
             """Computes the hash that will be used to decide if two tokens
             should be recombined.
 
+            The hash of the last ``recombination_order`` words is cached in the
+            history object, so it's computed only once for the tokens that
+            share the history.
+
             :type recombination_order: int
             :param recombination_order: number of words to consider when
                 recombining tokens, or ``None`` for the entire history
             """
 
-            if recombination_order is None:
-                limited_history = self.history
+            if self._history is None:
+                self.recombination_hash = hash(())
             else:
-                limited_history = self.history[-recombination_order:]
-            self.recombination_hash = hash(tuple(limited_history))
+                self.recombination_hash = \
+                    self._history.hash(recombination_order)
 
         def recompute_total(self, nn_lm_weight, lm_scale, wi_penalty,
                             linear=False):
@@ -138,13 +250,16 @@ class LatticeDecoder(object):
                     nn_lm_weight, (1.0 - nn_lm_weight))
             self.total_logprob = self.ac_logprob
             self.total_logprob += self.lm_logprob * lm_scale
-            self.total_logprob += wi_penalty * len(self.history)
+            self.total_logprob += wi_penalty * self.history_length()
 
         def history_words(self, vocabulary):
             """Converts the word IDs in the history to words using
             ``vocabulary``. The history may contain also OOV words as text, so
             any ``str`` will be left untouched.
 
+            This is the only place where the list of words is constructed, so
+            it should be called only when writing the output.
+
             :type vocabulary: Vocabulary
             :param vocabulary: mapping from word IDs to words
 
@@ -231,6 +346,10 @@ class LatticeDecoder(object):
         max_tokens_per_node : int
           if set to other than None, leave only this many tokens at each node
 
+        max_tokens_per_frame : int
+          if set to other than None, leave only this many tokens in total at
+          the nodes that have the same time
+
         beam : float
           if set to other than None, prune tokens whose total log probability is
           further than this from the best token at each point in time
@@ -239,6 +358,46 @@ class LatticeDecoder(object):
           number of words to consider when deciding whether two tokens should be
           recombined, or ``None`` for the entire word history
 
+        max_batch_size : int
+          if set to other than None, limit the number of tokens that will be
+          processed by the neural network in a single call
+
+        frontier_batching : bool
+          if set to ``True``, collect the tokens of all the nodes whose
+          predecessors have been processed, and propagate them to the outgoing
+          links in one batch; otherwise nodes are processed one at a time
+
+        cache_size : int
+          if set to other than None, save the NNLM log probabilities and output
+          states of at most this many (history, target word) pairs, so that
+          they don't have to be recomputed; if ``recombination_order`` is set,
+          only that many previous words are used as the history
+
+        early_pruning : bool
+          if set to ``True`` and ``beam`` is set, drop the tokens whose total
+          log probability would fall outside the beam even if the neural
+          network gave the best possible probability, before propagating them
+          through the network
+
+        max_nnlm_evaluations : int
+          if set to other than None, the budget for the number of tokens that
+          are propagated through the neural network per lattice
+
+        max_decoding_time : float
+          if set to other than None, the budget for the wall-clock time in
+          seconds used for decoding a lattice
+
+        build_lattice : bool
+          if set to ``True``, the tokens are linked to the tokens that they
+          were created from, so that a rescored lattice can be created using
+          ``rescored_lattice()``
+
+        When the budget is exceeded, the decoder halves the beam and the maximum
+        number of tokens per node at every step. When twice the budget is
+        exceeded, the decoder gives up and returns the best path according to
+        the lattice scores only. ``budget_status`` tells whether either of
+        these happened.
+
         :type network: Network
         :param network: the neural network object
 
@@ -258,31 +417,56 @@ class LatticeDecoder(object):
         self._unk_penalty = decoding_options['unk_penalty']
         self._linear_interpolation = decoding_options['linear_interpolation']
         self._max_tokens_per_node = decoding_options['max_tokens_per_node']
+        self._max_tokens_per_frame = decoding_options['max_tokens_per_frame']
+        # The token scores of the nodes at each time.
+        self._frames = dict()
         self._beam = decoding_options['beam']
         if not self._beam is None:
             self._beam = logprob_type(self._beam)
         self._recombination_order = decoding_options['recombination_order']
+        self._max_batch_size = decoding_options['max_batch_size']
+        self._frontier_batching = decoding_options['frontier_batching']
+        self._early_pruning = decoding_options['early_pruning'] and \
+                              (not self._beam is None)
+        # The highest log probability that the NNLM contribution of a word
+        # can have.
+        if (not self._unk_penalty is None) and (self._unk_penalty > 0):
+            self._nn_logprob_bound = logprob_type(self._unk_penalty)
+        else:
+            self._nn_logprob_bound = logprob_type(0.0)
+        self._max_nnlm_evaluations = decoding_options['max_nnlm_evaluations']
+        self._max_decoding_time = decoding_options['max_decoding_time']
+        self._build_lattice = decoding_options['build_lattice']
+        # Number of tokens propagated through the neural network, and the time
+        # when decoding of the current lattice started.
+        self._num_nnlm_evaluations = 0
+        self._start_time = None
+        # Pruning limits that override the beam and maximum number of tokens
+        # when the budget has been exceeded.
+        self._tightened_beam = None
+        self._tightened_max_tokens = None
+        # None, "tightened", or "fallback", telling what happened in the last
+        # call to decode() because of the budget.
+        self.budget_status = None
+        # The largest number of tokens and the largest amount of memory used by
+        # the recurrent states at any point of the last call to decode().
+        self.peak_tokens = 0
+        self.peak_state_bytes = 0
+        # Statistics of the last call to decode().
+        self.stats = DecodingStatistics()
+        cache_size = decoding_options['cache_size']
+        if (cache_size is None) or (cache_size == 0):
+            self._cache = None
+        else:
+            self._cache = LRUCache(cache_size)
+        self._states = StateArena(network.recurrent_state_size)
 
         self._sos_id = self._vocabulary.word_to_id['<s>']
         self._eos_id = self._vocabulary.word_to_id['</s>']
         self._unk_id = self._vocabulary.word_to_id['<unk>']
 
-        inputs = [network.input_word_ids,
-                  network.input_class_ids,
-                  network.target_class_ids]
-        inputs.extend(network.recurrent_state_input)
-
-        outputs = [tensor.log(network.target_probs())]
-        outputs.extend(network.recurrent_state_output)
-
-        # Ignore unused input, because is_training is only used by dropout
-        # layer.
-        self.step_function = theano.function(
-            inputs,
-            outputs,
-            givens=[(network.is_training, numpy.int8(0))],
-            name='step_predictor',
-            on_unused_input='ignore')
+        self.step_function = create_step_function(network, 'step_predictor',
+                                                  profile)
 
     def decode(self, lattice):
         """Propagates tokens through given lattice and returns a list of tokens
@@ -290,15 +474,23 @@ class LatticeDecoder(object):
 
         Propagates tokens at a node to every outgoing link by creating a copy of
         each token and updating the language model scores according to the link.
+        The nodes and links are accessed by their indices in an
+        ``ArrayLattice``. A ``Lattice`` is converted into an ``ArrayLattice``
+        first. The lattice is kept until the next call, so that
+        ``rescored_lattice()`` can refer to its links.
 
-        :type lattice: Lattice
+        :type lattice: ArrayLattice or Lattice
         :param lattice: a word lattice to be decoded
 
         :rtype: list of LatticeDecoder.Tokens
         :returns: the final tokens sorted by total log probability in descending
-                  order
+                  order; their recurrent states have been released
         """
 
+        if not isinstance(lattice, ArrayLattice):
+            lattice = ArrayLattice(lattice)
+        self._init_lattice(lattice)
+
         if not self._lm_scale is None:
             lm_scale = logprob_type(self._lm_scale)
         elif not lattice.lm_scale is None:
@@ -313,53 +505,395 @@ class LatticeDecoder(object):
         else:
             wi_penalty = logprob_type(0.0)
 
-        self._tokens = [list() for _ in lattice.nodes]
-        initial_state = RecurrentState(self._network.recurrent_state_size)
+        self._num_nnlm_evaluations = 0
+        self._start_time = time.time()
+        self.stats.reset(lattice.num_nodes(), lattice.num_links())
+        if not self._cache is None:
+            self._cache_hits = self._cache.hits
+            self._cache_misses = self._cache.misses
+        self._tightened_beam = None
+        self._tightened_max_tokens = None
+        self.budget_status = None
+
+        self._tokens = [list() for _ in range(lattice.num_nodes())]
+        self._states.reset_peak()
+        initial_state = self._states.initial_state()
         initial_token = self.Token(history=[self._sos_id], state=initial_state)
         initial_token.recompute_hash(self._recombination_order)
         initial_token.recompute_total(self._nnlm_weight, lm_scale, wi_penalty,
                                       self._linear_interpolation)
-        self._tokens[lattice.initial_node.id].append(initial_token)
-        lattice.initial_node.best_logprob = initial_token.total_logprob
-
-        self._sorted_nodes = lattice.sorted_nodes()
+        self._tokens[lattice.initial_node_id].append(initial_token)
+
+        self._time_index = TimeIndex(self._sorted_node_ids, self._node_times)
+        self._init_frames()
+        self._best_logprobs = [None] * lattice.num_nodes()
+        self._update_best_logprob(lattice.initial_node_id,
+                                  initial_token.total_logprob)
+        if self._frontier_batching:
+            node_groups = self._frontiers(lattice)
+        else:
+            node_groups = ([node_id] for node_id in self._sorted_node_ids)
         nodes_processed = 0
-        for node in self._sorted_nodes:
-            node_tokens = self._tokens[node.id]
-            assert node_tokens
-            num_pruned_tokens = len(node_tokens)
-            self._prune(node)
-            node_tokens = self._tokens[node.id]
-            assert node_tokens
-            num_pruned_tokens -= len(node_tokens)
-
-            if node.id == lattice.final_node.id:
+        num_live_tokens = 1
+        self.peak_tokens = 1
+        for node_ids in node_groups:
+            budget_used = self._budget_used()
+            if budget_used >= 2.0:
+                logging.warning("Decoding budget exceeded. Using the best path "
+                                "according to the lattice scores.")
+                self.budget_status = 'fallback'
+                for node_tokens in self._tokens:
+                    self._release_tokens(node_tokens)
+                self._finish_statistics()
+                return [self._lattice_best_path(lattice, lm_scale, wi_penalty)]
+            elif budget_used >= 1.0:
+                self._tighten_pruning(node_ids)
+
+            num_tokens = 0
+            num_pruned_tokens = 0
+            for node_id in node_ids:
+                node_tokens = self._tokens[node_id]
+                assert node_tokens
+                num_pruned_tokens += len(node_tokens)
+                self._prune(node_id)
+                node_tokens = self._tokens[node_id]
+                assert node_tokens
+                num_pruned_tokens -= len(node_tokens)
+                num_tokens += len(node_tokens)
+            num_live_tokens -= num_pruned_tokens
+
+            if lattice.final_node_id in node_ids:
+                final_tokens = self._tokens[lattice.final_node_id]
                 new_tokens = self._propagate(
-                    node_tokens, None, lm_scale, wi_penalty)
+                    [(final_tokens, None)], lm_scale, wi_penalty)[0]
+                # The states are not needed after the final node, and the
+                # cache keeps only the states that it refers to.
+                for node_id in node_ids:
+                    self._free_tokens(node_id)
+                self._release_tokens(new_tokens)
+                self._finish_statistics()
+                if not self._cache is None:
+                    logging.debug("NNLM cache: %d items, %d hits, %d misses",
+                                  len(self._cache),
+                                  self.stats.cache_hits,
+                                  self.stats.cache_misses)
+                if self._early_pruning:
+                    logging.debug("Token expansions pruned before NNLM: %d",
+                                  self.stats.tokens_early_pruned)
                 return sorted(new_tokens,
                               key=lambda token: token.total_logprob,
                               reverse=True)
 
+            # Propagate the tokens to all the outgoing links at once, so that
+            # the neural network is evaluated in as large batches as possible.
+            expansions = [(self._tokens[node_id], link_id)
+                          for node_id in node_ids
+                          for link_id in lattice.out_links(node_id)]
+            new_tokens = self._propagate(expansions, lm_scale, wi_penalty)
             num_new_tokens = 0
-            for link in node.out_links:
-                new_tokens = self._propagate(
-                    node_tokens, link, lm_scale, wi_penalty)
-                self._tokens[link.end_node.id].extend(new_tokens)
-                num_new_tokens += len(new_tokens)
-
-            nodes_processed += 1
-            if nodes_processed % math.ceil(len(self._sorted_nodes) / 20) == 0:
-                logging.debug("[%d] (%.2f %%) -- tokens = %d +%d -%d",
-                              nodes_processed,
-                              nodes_processed / len(self._sorted_nodes) * 100,
-                              len(node_tokens),
-                              num_new_tokens,
-                              num_pruned_tokens)
+            for (_, link_id), link_tokens in zip(expansions, new_tokens):
+                end_node_id = self._link_ends[link_id]
+                self._tokens[end_node_id].extend(link_tokens)
+                self._add_frame_tokens(end_node_id, link_tokens)
+                num_new_tokens += len(link_tokens)
+            # The tokens at the processed nodes are not needed anymore.
+            num_live_tokens += num_new_tokens
+            self.peak_tokens = max(self.peak_tokens, num_live_tokens)
+            num_live_tokens -= num_tokens
+            for node_id in node_ids:
+                self._free_tokens(node_id)
+
+            num_sorted_nodes = len(self._sorted_node_ids)
+            progress_interval = math.ceil(num_sorted_nodes / 20)
+            for _ in node_ids:
+                nodes_processed += 1
+                if nodes_processed % progress_interval == 0:
+                    logging.debug("[%d] (%.2f %%) -- tokens = %d +%d -%d",
+                                  nodes_processed,
+                                  nodes_processed / num_sorted_nodes * 100,
+                                  num_tokens,
+                                  num_new_tokens,
+                                  num_pruned_tokens)
 
         raise InputError("Could not reach the final node of word lattice.")
 
-    def _propagate(self, tokens, link, lm_scale, wi_penalty):
-        """Propagates tokens to given link or to end of sentence.
+    def _init_lattice(self, lattice):
+        """Prepares the link attributes of a lattice for decoding.
+
+        The attributes that the decoder reads for every token expansion are
+        converted from the numpy arrays of the lattice into lists, which are
+        faster to index one element at a time. Missing log probabilities are
+        replaced by zeros, and the words are converted to vocabulary IDs. The
+        words that start with "!" are not predicted, and are represented by
+        ``None``. Out-of-vocabulary words are kept as strings.
+
+        :type lattice: ArrayLattice
+        :param lattice: the lattice that will be decoded
+        """
+
+        self._lattice = lattice
+        self._sorted_node_ids = lattice.sorted_node_ids.tolist()
+        self._node_times = [lattice.node_time(node_id)
+                            for node_id in range(lattice.num_nodes())]
+        self._link_ends = lattice.link_ends.tolist()
+        self._link_ac_logprobs = \
+            numpy.nan_to_num(lattice.link_ac_logprobs).tolist()
+        self._link_lm_logprobs = \
+            numpy.nan_to_num(lattice.link_lm_logprobs).tolist()
+        word_ids = []
+        for word in lattice.words:
+            if word.startswith('!'):
+                word_ids.append(None)
+            else:
+                word_ids.append(self._vocabulary.word_to_id.get(word, word))
+        self._link_words = [None if word < 0 else word_ids[word]
+                            for word in lattice.link_words.tolist()]
+
+    def _budget_used(self):
+        """Computes how large part of the decoding budget has been used.
+
+        :rtype: float
+        :returns: the number of NNLM evaluations or the elapsed time relative to
+                  the budget, whichever is larger, or 0 if there's no budget
+        """
+
+        result = 0.0
+        if not self._max_nnlm_evaluations is None:
+            result = max(result, self._num_nnlm_evaluations /
+                                 max(self._max_nnlm_evaluations, 1))
+        if not self._max_decoding_time is None:
+            elapsed_time = time.time() - self._start_time
+            result = max(result, elapsed_time /
+                                 max(self._max_decoding_time, 1e-6))
+        return result
+
+    def _tighten_pruning(self, node_ids):
+        """Halves the beam and the maximum number of tokens per node.
+
+        The first time this is called during a lattice, the limits are
+        initialized from the decoding options. If the maximum number of tokens
+        is not limited, the initial value is the largest number of tokens at the
+        given nodes.
+
+        :type node_ids: list of ints
+        :param node_ids: IDs of the nodes that will be processed next
+        """
+
+        if self.budget_status is None:
+            logging.warning("Decoding budget exceeded. Tightening pruning.")
+            self.budget_status = 'tightened'
+            self._tightened_beam = self._beam
+            if self._max_tokens_per_node is None:
+                self._tightened_max_tokens = max(len(self._tokens[node_id])
+                                                 for node_id in node_ids)
+            else:
+                self._tightened_max_tokens = self._max_tokens_per_node
+
+        if not self._tightened_beam is None:
+            self._tightened_beam /= 2
+        self._tightened_max_tokens = max(self._tightened_max_tokens // 2, 1)
+
+    def _lattice_best_path(self, lattice, lm_scale, wi_penalty):
+        """Finds the best path through a lattice without the neural network.
+
+        The total log probability of the returned token is computed using the
+        acoustic and LM log probabilities of the lattice only.
+
+        :type lattice: ArrayLattice
+        :param lattice: a word lattice
+
+        :type lm_scale: logprob_type
+        :param lm_scale: scale language model log probabilities by this factor
+
+        :type wi_penalty: logprob_type
+        :param wi_penalty: penalize word insertion by adding this value to the
+                           total log probability of the token
+
+        :rtype: LatticeDecoder.Token
+        :returns: a token that has passed the best path
+        """
+
+        initial_token = self.Token(history=[self._sos_id])
+        initial_token.recompute_total(0.0, lm_scale, wi_penalty)
+        best_tokens = { lattice.initial_node_id: initial_token }
+        for node_id in self._sorted_node_ids:
+            token = best_tokens.get(node_id)
+            if (token is None) or (node_id == lattice.final_node_id):
+                continue
+            for link_id in lattice.out_links(node_id):
+                new_token = self.Token.copy(token)
+                new_token.ac_logprob += self._link_ac_logprobs[link_id]
+                new_token.lat_lm_logprob += self._link_lm_logprobs[link_id]
+                word = self._link_words[link_id]
+                if not word is None:
+                    new_token.append_word(word)
+                new_token.recompute_total(0.0, lm_scale, wi_penalty)
+                if self._build_lattice:
+                    self._add_back_link(new_token, token, link_id)
+                end_node_id = self._link_ends[link_id]
+                old_token = best_tokens.get(end_node_id)
+                if (old_token is None) or \
+                   (new_token.total_logprob > old_token.total_logprob):
+                    best_tokens[end_node_id] = new_token
+
+        token = best_tokens.get(lattice.final_node_id)
+        if token is None:
+            raise InputError("Could not reach the final node of word lattice.")
+        final_token = self.Token.copy(token)
+        final_token.append_word(self._eos_id)
+        final_token.recompute_total(0.0, lm_scale, wi_penalty)
+        if self._build_lattice:
+            self._add_back_link(final_token, token, None)
+        return final_token
+
+    def rescored_lattice(self, tokens):
+        """Creates a lattice from the paths of the tokens that reached the end
+        of a lattice.
+
+        Requires that the decoder was constructed with the ``build_lattice``
+        option. Each node of the new lattice corresponds to a token that was
+        propagated to a node of the original lattice, and the links are
+        followed back from the final tokens. The tokens that were recombined
+        share the same node, so the lattice contains all the paths that were
+        not pruned, but the LM scores of a path may be computed from a
+        different history after a recombination. The LM log probabilities of
+        the links are the interpolated log probabilities that the decoder used.
+        The final tokens are connected to a single end node with ``!NULL``
+        links that carry the end of sentence log probabilities. The links of
+        the new lattice are taken from the lattice of the last call to
+        ``decode()``.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: the tokens returned by ``decode()``
+
+        :rtype: SLFLattice
+        :returns: a lattice whose nodes are sorted topologically
+        """
+
+        if not self._build_lattice:
+            raise RuntimeError("Lattice decoder was not constructed with the "
+                               "build_lattice option.")
+
+        lattice = self._lattice
+        result = SLFLattice(None)
+        result.utterance_id = lattice.utterance_id
+        result.lm_scale = lattice.lm_scale
+        result.wi_penalty = lattice.wi_penalty
+        if not self._lm_scale is None:
+            result.lm_scale = self._lm_scale
+        if not self._wi_penalty is None:
+            result.wi_penalty = self._wi_penalty
+
+        result.final_node = result.add_node(
+            lattice.node_time(lattice.final_node_id))
+        # Maps token IDs to the nodes of the new lattice. Final tokens map to
+        # the end node.
+        token_nodes = {id(token): result.final_node for token in tokens}
+        stack = list(tokens)
+        while stack:
+            token = stack.pop()
+            end_node = token_nodes[id(token)]
+            for from_token, link_id, lm_logprob in token.back_links or ():
+                start_node = token_nodes.get(id(from_token))
+                if start_node is None:
+                    if from_token.back_links:
+                        from_link_id = from_token.back_links[0][1]
+                        node_id = self._link_ends[from_link_id]
+                    else:
+                        node_id = lattice.initial_node_id
+                    time = lattice.node_time(node_id)
+                    start_node = result.add_node(time)
+                    token_nodes[id(from_token)] = start_node
+                    stack.append(from_token)
+                    if not from_token.back_links:
+                        result.initial_node = start_node
+                new_link = result.add_link(start_node, end_node)
+                new_link.lm_logprob = lm_logprob
+                if link_id is None:
+                    new_link.word = '!NULL'
+                    new_link.ac_logprob = logprob_type(0.0)
+                else:
+                    word = lattice.link_words[link_id]
+                    if word >= 0:
+                        new_link.word = lattice.words[word]
+                    ac_logprob = lattice.link_ac_logprobs[link_id]
+                    if not numpy.isnan(ac_logprob):
+                        new_link.ac_logprob = ac_logprob
+
+        # Number the nodes in topological order.
+        result.nodes = result.sorted_nodes()
+        for node_id, node in enumerate(result.nodes):
+            node.id = node_id
+        return result
+
+    def _add_back_link(self, new_token, token, link_id):
+        """Links a token to the token that it was propagated from.
+
+        :type new_token: LatticeDecoder.Token
+        :param new_token: a token whose log probabilities have been updated
+
+        :type token: LatticeDecoder.Token
+        :param token: the token that ``new_token`` was copied from
+
+        :type link_id: int
+        :param link_id: index of the link that the token was propagated to, or
+                        ``None`` for the end of the sentence
+        """
+
+        lm_logprob = new_token.lm_logprob - token.lm_logprob
+        new_token.back_links = [(token, link_id, lm_logprob)]
+
+    def _recombine_back_links(self, tokens):
+        """Moves the back links of the tokens that will be recombined to the
+        best token that has the same recombination hash.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: the tokens of a node in descending order of log
+                       probability
+        """
+
+        best_tokens = dict()
+        for token in tokens:
+            best_token = best_tokens.setdefault(token.recombination_hash, token)
+            if (not best_token is token) and token.back_links:
+                if best_token.back_links is None:
+                    best_token.back_links = []
+                best_token.back_links.extend(token.back_links)
+                token.back_links = None
+
+    def _frontiers(self, lattice):
+        """Divides the nodes into groups that can be processed in parallel.
+
+        The first group contains the nodes that don't have predecessors. Every
+        following group contains the nodes whose predecessors are all in the
+        previous groups. The nodes within a group are in topological order.
+
+        :type lattice: ArrayLattice
+        :param lattice: a word lattice
+
+        :rtype: list of lists of ints
+        :returns: the IDs of the nodes in each frontier, in the order in which
+                  the frontiers can be processed
+        """
+
+        # The level of a node is one more than the highest level of its
+        # predecessors. The predecessors are visited first in topological
+        # order.
+        link_ends = lattice.link_ends.tolist()
+        levels = dict()
+        result = []
+        for node_id in lattice.sorted_node_ids.tolist():
+            level = levels.get(node_id, 0)
+            while len(result) <= level:
+                result.append([])
+            result[level].append(node_id)
+            for link_id in lattice.out_links(node_id):
+                end_node_id = link_ends[link_id]
+                levels[end_node_id] = max(levels.get(end_node_id, 0), level + 1)
+        return result
+
+    def _propagate(self, expansions, lm_scale, wi_penalty):
+        """Propagates tokens to given links or to end of sentence.
 
         Lattices may contain !NULL, !ENTER, !EXIT, etc. nodes that model e.g.
         silence or sentence start or end, or for example when the topology is
@@ -367,16 +901,201 @@ class LatticeDecoder(object):
         language model scores. Then the function will update the acoustic and
         lattice LM score, but will not compute anything with the neural network.
 
-        Also updates ``best_logprob`` of the end node, so that beam pruning
+        ``expansions`` is a list of (tokens, link_id) pairs. The tokens are
+        copied to their links, and the target words of all the links are predicted
+        using as few calls to the neural network as possible, so that the
+        overhead of calling the network is not multiplied by the number of
+        links.
+
+        Also updates ``best_logprob`` of the end nodes, so that beam pruning
         threshold can be obtained efficiently.
 
+        :type expansions: list of tuples
+        :param expansions: a list of input tokens and the index of a link to
+                           propagate them to; ``None`` in place of a link
+                           updates the LM logprobs as if the tokens were
+                           propagated to an end of sentence
+
+        :type lm_scale: logprob_type
+        :param lm_scale: scale language model log probabilities by this factor
+
+        :type wi_penalty: logprob_type
+        :param wi_penalty: penalize word insertion by adding this value to the
+                           total log probability of the token
+
+        :rtype: list of lists of LatticeDecoder.Tokens
+        :returns: the propagated tokens for each element in ``expansions``
+        """
+
+        result = []
+        sources = []
+        nn_tokens = []
+        nn_target_words = []
+        copied_states = []
+        for tokens, link_id in expansions:
+            if self._early_pruning and (not link_id is None):
+                num_tokens = len(tokens)
+                tokens = self._prune_expansion(tokens, link_id, lm_scale,
+                                               wi_penalty)
+                self.stats.tokens_early_pruned += num_tokens - len(tokens)
+            new_tokens = [self.Token.copy(token) for token in tokens]
+            result.append(new_tokens)
+            sources.append(tokens)
+            copied_states.extend(token.state for token in tokens)
+
+            if link_id is None:
+                nn_tokens.extend(new_tokens)
+                nn_target_words.extend([self._eos_id] * len(new_tokens))
+                continue
+
+            ac_logprob = self._link_ac_logprobs[link_id]
+            lat_lm_logprob = self._link_lm_logprobs[link_id]
+            for token in new_tokens:
+                token.ac_logprob += ac_logprob
+                token.lat_lm_logprob += lat_lm_logprob
+            word = self._link_words[link_id]
+            if not word is None:
+                nn_tokens.extend(new_tokens)
+                nn_target_words.extend([word] * len(new_tokens))
+
+        self._states.retain(copied_states)
+        if nn_tokens:
+            self._append_words(nn_tokens, nn_target_words)
+
+        all_tokens = [token for new_tokens in result for token in new_tokens]
+        self._recompute_totals(all_tokens, lm_scale, wi_penalty)
+        self.stats.tokens_created += len(all_tokens)
+        for (_, link_id), tokens, new_tokens in zip(expansions, sources,
+                                                    result):
+            for token in new_tokens:
+                token.recompute_hash(self._recombination_order)
+            if self._build_lattice:
+                for token, new_token in zip(tokens, new_tokens):
+                    self._add_back_link(new_token, token, link_id)
+            if (not link_id is None) and new_tokens:
+                best_logprob = max(token.total_logprob for token in new_tokens)
+                self._update_best_logprob(self._link_ends[link_id],
+                                          best_logprob)
+
+        return result
+
+    def _recompute_totals(self, tokens, lm_scale, wi_penalty):
+        """Interpolates the LM log probabilities and computes the total log
+        probabilities of a list of tokens.
+
+        Computes the same values as ``Token.recompute_total()``, but using
+        vector operations on all the tokens at once.
+
         :type tokens: list of LatticeDecoder.Tokens
-        :param tokens: input tokens
+        :param tokens: tokens whose ``lm_logprob`` and ``total_logprob`` will
+                       be updated
+
+        :type lm_scale: logprob_type
+        :param lm_scale: scale language model log probabilities by this factor
+
+        :type wi_penalty: logprob_type
+        :param wi_penalty: penalize word insertion by adding this value to the
+                           total log probability of the token
+        """
+
+        if not tokens:
+            return
 
-        :type link: Lattice.Link
-        :param link: if other than ``None``, propagates the tokens to this link;
-                     if ``None``, just updates the LM logprobs as if the tokens
-                     were propagated to an end of sentence
+        ac_logprobs, lat_lm_logprobs, nn_lm_logprobs, lengths = \
+            self._score_arrays(tokens)
+        lm_logprobs, total_logprobs = self._total_logprobs(
+            ac_logprobs, lat_lm_logprobs, nn_lm_logprobs, lengths,
+            lm_scale, wi_penalty)
+        for token, lm_logprob, total_logprob in zip(tokens,
+                                                    lm_logprobs,
+                                                    total_logprobs):
+            token.lm_logprob = lm_logprob
+            token.total_logprob = total_logprob
+
+    def _score_arrays(self, tokens):
+        """Collects the log probabilities and history lengths of tokens into
+        arrays.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: a list of tokens
+
+        :rtype: tuple of numpy.ndarrays
+        :returns: the acoustic, lattice LM, and NNLM log probabilities, and
+                  the number of words in the history of each token
+        """
+
+        ac_logprobs = numpy.array([token.ac_logprob for token in tokens],
+                                  dtype=logprob_type)
+        lat_lm_logprobs = numpy.array([token.lat_lm_logprob
+                                       for token in tokens],
+                                      dtype=logprob_type)
+        nn_lm_logprobs = numpy.array([token.nn_lm_logprob
+                                      for token in tokens],
+                                     dtype=logprob_type)
+        lengths = numpy.array([token.history_length() for token in tokens],
+                              dtype=logprob_type)
+        return ac_logprobs, lat_lm_logprobs, nn_lm_logprobs, lengths
+
+    def _total_logprobs(self, ac_logprobs, lat_lm_logprobs, nn_lm_logprobs,
+                        lengths, lm_scale, wi_penalty):
+        """Interpolates LM log probabilities and computes total log
+        probabilities from arrays of token scores.
+
+        :type ac_logprobs: numpy.ndarray
+        :param ac_logprobs: acoustic log probabilities
+
+        :type lat_lm_logprobs: numpy.ndarray
+        :param lat_lm_logprobs: lattice LM log probabilities
+
+        :type nn_lm_logprobs: numpy.ndarray
+        :param nn_lm_logprobs: NNLM log probabilities
+
+        :type lengths: numpy.ndarray
+        :param lengths: number of words in the history of each token
+
+        :type lm_scale: logprob_type
+        :param lm_scale: scale language model log probabilities by this factor
+
+        :type wi_penalty: logprob_type
+        :param wi_penalty: penalize word insertion by adding this value to the
+                           total log probability of the token
+
+        :rtype: tuple of numpy.ndarrays
+        :returns: the interpolated LM log probabilities and the total log
+                  probabilities
+        """
+
+        if self._linear_interpolation:
+            lm_logprobs = interpolate_linear(
+                nn_lm_logprobs, lat_lm_logprobs,
+                self._nnlm_weight)
+        else:
+            lm_logprobs = interpolate_loglinear(
+                nn_lm_logprobs, lat_lm_logprobs,
+                self._nnlm_weight, (1.0 - self._nnlm_weight))
+        total_logprobs = ac_logprobs + lm_logprobs * lm_scale
+        total_logprobs += wi_penalty * lengths
+        return lm_logprobs, total_logprobs
+
+    def _prune_expansion(self, tokens, link_id, lm_scale, wi_penalty):
+        """Drops the tokens that would be pruned by the beam at the end node of
+        a link, before they are propagated through the neural network.
+
+        Computes an optimistic total log probability for each token, assuming
+        that the neural network will give the best possible log probability to
+        the word of the link (zero, or the <unk> penalty if it's higher).
+        Interpolation is monotonic, so the actual total log probability cannot
+        be higher. If the optimistic log probability is not higher than the
+        beam pruning threshold of the end node, the token would be pruned at the
+        end node anyway. The threshold can only get stricter when more tokens
+        are propagated. The best token is always kept, so that every node that
+        is reachable will receive at least one token.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: tokens to be propagated
+
+        :type link_id: int
+        :param link_id: index of the link where the tokens will be propagated
 
         :type lm_scale: logprob_type
         :param lm_scale: scale language model log probabilities by this factor
@@ -386,83 +1105,216 @@ class LatticeDecoder(object):
                            total log probability of the token
 
         :rtype: list of LatticeDecoder.Tokens
-        :returns: the propagated tokens
+        :returns: the tokens that may survive beam pruning at the end node
+        """
+
+        if len(tokens) <= 1:
+            return tokens
+
+        beam = self._beam
+        if not self._tightened_beam is None:
+            beam = self._tightened_beam
+        end_node_id = self._link_ends[link_id]
+        threshold = self._time_index.best_logprob(end_node_id) - beam
+        if threshold == -numpy.inf:
+            return tokens
+
+        ac_logprobs, lat_lm_logprobs, nn_lm_logprobs, lengths = \
+            self._score_arrays(tokens)
+        ac_logprobs += self._link_ac_logprobs[link_id]
+        lat_lm_logprobs += self._link_lm_logprobs[link_id]
+        if not self._link_words[link_id] is None:
+            nn_lm_logprobs += self._nn_logprob_bound
+            lengths += 1
+        _, total_logprobs = self._total_logprobs(
+            ac_logprobs, lat_lm_logprobs, nn_lm_logprobs, lengths,
+            lm_scale, wi_penalty)
+
+        keep = total_logprobs > threshold
+        keep[numpy.argmax(total_logprobs)] = True
+        return [token for token, keep_token in zip(tokens, keep)
+                if keep_token]
+
+    def _update_best_logprob(self, node_id, logprob):
+        """Updates the best log probability of the tokens at a node.
+
+        The time index is updated too, so that the beam pruning threshold can be
+        found in logarithmic time.
+
+        :type node_id: int
+        :param node_id: ID of the node where a token arrived
+
+        :type logprob: logprob_type
+        :param logprob: total log probability of the token
         """
 
-        new_tokens = [self.Token.copy(token) for token in tokens]
+        best_logprob = self._best_logprobs[node_id]
+        if (best_logprob is None) or (logprob > best_logprob):
+            self._best_logprobs[node_id] = logprob
+            self._time_index.update(node_id, logprob)
 
-        if link is None:
-            self._append_word(new_tokens, self._eos_id)
-        else:
-            for token in new_tokens:
-                if not link.ac_logprob is None:
-                    token.ac_logprob += link.ac_logprob
-                if not link.lm_logprob is None:
-                    token.lat_lm_logprob += link.lm_logprob
-            if not link.word.startswith('!'):
-                try:
-                    word = self._vocabulary.word_to_id[link.word]
-                except KeyError:
-                    word = link.word
-                self._append_word(new_tokens, word)
-
-        for token in new_tokens:
-            token.recompute_hash(self._recombination_order)
-            token.recompute_total(self._nnlm_weight, lm_scale, wi_penalty,
-                                  self._linear_interpolation)
-            if not link is None:
-                if (link.end_node.best_logprob is None) or \
-                   (token.total_logprob > link.end_node.best_logprob):
-                    link.end_node.best_logprob = token.total_logprob
-
-        return new_tokens
-
-    def _prune(self, node):
+    def _prune(self, node_id):
         """Prunes tokens from a node according to beam and the maximum number of
         tokens.
 
-        :type node: Lattice.Node
-        :param node: perform pruning on this node
+        :type node_id: int
+        :param node_id: perform pruning on the node with this ID
         """
 
-        new_tokens = dict()
-        for token in self._tokens[node.id]:
-            key = token.recombination_hash
-            if (not key in new_tokens) or \
-               (token.total_logprob > new_tokens[key].total_logprob):
-                new_tokens[key] = token
+        old_tokens = self._tokens[node_id]
+        logprobs = numpy.array([token.total_logprob for token in old_tokens],
+                               dtype=logprob_type)
+        hashes = numpy.array([token.recombination_hash
+                              for token in old_tokens],
+                             dtype='int64')
+
+        # Sort the tokens by descending log probability. A stable sort keeps
+        # the original order of tokens with equal log probability.
+        order = numpy.argsort(-logprobs, kind='mergesort')
+        if self._build_lattice:
+            self._recombine_back_links([old_tokens[index]
+                                        for index in order.tolist()])
+
+        # The first occurrence of each hash in the sorted order is the best
+        # token with that hash. Other tokens are recombined into it.
+        _, first_indices = numpy.unique(hashes[order], return_index=True)
+        first_indices.sort()
+        order = order[first_indices]
+        self.stats.tokens_recombined += len(old_tokens) - len(order)
+
+        beam = self._beam
+        max_tokens = self._max_tokens_per_node
+        if not self._tightened_max_tokens is None:
+            beam = self._tightened_beam
+            max_tokens = self._tightened_max_tokens
+
+        # Compare to the best probability at the same or later time. Keep at
+        # least one token.
+        if not beam is None:
+            best_logprob = self._time_index.best_logprob(node_id)
+            threshold = best_logprob - beam
+            num_tokens = numpy.count_nonzero(logprobs[order] > threshold)
+            order = order[:max(num_tokens, 1)]
 
-        # Sort the tokens by descending log probability.
-        new_tokens = sorted(new_tokens.values(),
-                            key=lambda token: token.total_logprob, reverse=True)
+        # Enforce limit on number of tokens at each node.
+        if not max_tokens is None:
+            order = order[:max_tokens]
+
+        # Enforce limit on number of tokens at each time frame.
+        if not self._max_tokens_per_frame is None:
+            order = order[:self._frame_limit(node_id, logprobs[order])]
+
+        new_tokens = [old_tokens[index] for index in order.tolist()]
+        self.stats.tokens_pruned += len(first_indices) - len(new_tokens)
+        if len(new_tokens) < len(old_tokens):
+            kept = numpy.zeros(len(old_tokens), dtype=bool)
+            kept[order] = True
+            self._release_tokens([old_tokens[index]
+                                  for index in numpy.flatnonzero(~kept)])
+        self._tokens[node_id] = new_tokens
+
+    def _init_frames(self):
+        """Creates the bookkeeping of time frames for pruning a lattice.
+
+        Each time is represented by a ``TimeFrame`` that contains the nodes that
+        have that time. Nodes without time don't belong to any frame.
+        """
 
-        # Compare to the best probability at the same or later time.
-        if not self._beam is None:
-            if node.time is None:
-                node_ids = [iter_node.id for iter_node in self._sorted_nodes]
-                time_begin = node_ids.index(node.id)
-            else:
-                for time_begin, iter_node in enumerate(self._sorted_nodes):
-                    if (not iter_node.time is None) and \
-                       (iter_node.time >= node.time):
-                        break
-            assert time_begin < len(self._sorted_nodes)
-
-            best_logprob = max(iter_node.best_logprob
-                               for iter_node in self._sorted_nodes[time_begin:]
-                               if not iter_node.best_logprob is None)
-            threshold = best_logprob - self._beam
-            token_index = len(new_tokens) - 1
-            while (token_index >= 1) and \
-                  (new_tokens[token_index].total_logprob <= threshold):
-                del new_tokens[token_index]
-                token_index -= 1
+        self._frames = dict()
+        if self._max_tokens_per_frame is None:
+            return
+        for node_id in self._sorted_node_ids:
+            time = self._node_times[node_id]
+            if not time is None:
+                frame = self._frames.get(time)
+                if frame is None:
+                    frame = TimeFrame()
+                    self._frames[time] = frame
+                frame.add_node(node_id)
+                frame.add_tokens(node_id, self._tokens[node_id])
+
+    def _add_frame_tokens(self, node_id, tokens):
+        """Adds the total log probabilities of new tokens at a node to the
+        scores of its time frame.
+
+        :type node_id: int
+        :param node_id: ID of the node where the tokens were added
 
-        # Enforce limit on number of tokens at each node.
-        if not self._max_tokens_per_node is None:
-            new_tokens[self._max_tokens_per_node:] = []
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: the new tokens
+        """
+
+        frame = self._frames.get(self._node_times[node_id])
+        if not frame is None:
+            frame.add_tokens(node_id, tokens)
+
+    def _frame_limit(self, node_id, logprobs):
+        """Computes how many tokens can be kept at a node without exceeding the
+        maximum number of tokens per time frame.
+
+        :type node_id: int
+        :param node_id: ID of the node that is being pruned
+
+        :type logprobs: numpy.ndarray
+        :param logprobs: total log probabilities of the tokens at the node, in
+                         descending order
+
+        :rtype: int
+        :returns: the number of best tokens to keep at the node
+        """
 
-        self._tokens[node.id] = new_tokens
+        frame = self._frames.get(self._node_times[node_id])
+        if frame is None:
+            return len(logprobs)
+        return frame.limit(node_id, logprobs, self._max_tokens_per_frame)
+
+    def _free_tokens(self, node_id):
+        """Frees the tokens at a node, after they have been propagated to the
+        outgoing links.
+
+        The recurrent states are released, and the token list is removed, so
+        that the word histories that are not shared with other tokens can be
+        garbage collected.
+
+        :type node_id: int
+        :param node_id: ID of a node that has been processed
+        """
+
+        self._release_tokens(self._tokens[node_id])
+        self._tokens[node_id] = []
+
+    def _finish_statistics(self):
+        """Computes the peak memory usage of the recurrent states and logs it
+        together with the peak number of tokens, and updates the rest of the
+        statistics that are collected at the end of a lattice.
+        """
+
+        self.peak_state_bytes = \
+            self._states.peak_size * self._states.state_bytes()
+        logging.debug("Peak number of tokens: %d, peak memory used by the "
+                      "recurrent states: %.1f MB",
+                      self.peak_tokens,
+                      self.peak_state_bytes / (1024 * 1024))
+
+        self.stats.peak_tokens = self.peak_tokens
+        self.stats.peak_state_bytes = self.peak_state_bytes
+        self.stats.budget_status = self.budget_status
+        self.stats.decode_time = time.time() - self._start_time
+        if not self._cache is None:
+            self.stats.cache_hits = self._cache.hits - self._cache_hits
+            self.stats.cache_misses = self._cache.misses - self._cache_misses
+
+    def _release_tokens(self, tokens):
+        """Releases the recurrent states of tokens that are not needed anymore.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: tokens whose states will be released
+        """
+
+        self._states.release([token.state for token in tokens
+                              if not token.state is None])
+        for token in tokens:
+            token.state = None
 
     def _append_word(self, tokens, target_word):
         """Appends a word to each of the given tokens, and updates their scores.
@@ -478,43 +1330,175 @@ class LatticeDecoder(object):
                             used in the resulting transcript
         """
 
-        def str_to_unk(self, word):
-            if isinstance(word, int):
-                return word
+        self._append_words(tokens, [target_word] * len(tokens))
+
+    def _append_words(self, tokens, target_words):
+        """Appends a word to each of the given tokens, and updates their scores.
+
+        The tokens may have different target words. The probabilities of all
+        the target words are computed in a single call to the step function,
+        unless the number of tokens exceeds the maximum batch size. If a cache
+        is used, the results that are found from the cache are not recomputed.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: input tokens
+
+        :type target_words: list of ints and strs
+        :param target_words: a word ID or word to be appended to the existing
+                             history of each input token; if not an integer,
+                             the word will be considered ``<unk>`` and the
+                             value will be taken literally as the word that
+                             will be used in the resulting transcript
+        """
+
+        if not tokens:
+            return
+
+        target_word_ids = [self._str_to_unk(word) for word in target_words]
+
+        # Look up the results of the tokens whose history and target word have
+        # been seen before. The rest are computed using the neural network, but
+        # each distinct history and target word only once. The new states are
+        # retained for the tokens as soon as they are found, so that they won't
+        # be freed if the cache evicts them.
+        old_states = [token.state for token in tokens]
+        results = [None] * len(tokens)
+        pending = OrderedDict()
+        for index, token in enumerate(tokens):
+            if self._cache is None:
+                key = index
             else:
-                return self._unk_id
+                key = self._cache_key(token, target_word_ids[index])
+                results[index] = self._cache.get(key)
+            if results[index] is None:
+                pending.setdefault(key, []).append(index)
+        self._states.retain([result[1] for result in results
+                             if not result is None])
+
+        pending_keys = list(pending.keys())
+        batch_size = len(pending_keys)
+        if not self._max_batch_size is None:
+            batch_size = min(batch_size, self._max_batch_size)
+        for start in range(0, len(pending_keys), max(batch_size, 1)):
+            batch_keys = pending_keys[start:start + batch_size]
+            batch_indices = [pending[key][0] for key in batch_keys]
+            batch_results = self._step(
+                [tokens[index] for index in batch_indices],
+                [target_word_ids[index] for index in batch_indices])
+            for key, result in zip(batch_keys, batch_results):
+                for index in pending[key]:
+                    results[index] = result
+                self._states.retain([result[1]] * len(pending[key]))
+                if not self._cache is None:
+                    self._states.retain([result[1]])
+                    evicted = self._cache.put(key, result)
+                    if not evicted is None:
+                        self._states.release([evicted[1]])
+            # The step function output is now owned by the tokens and the
+            # cache.
+            self._states.release([result[1] for result in batch_results])
+        self._states.release([state for state in old_states
+                              if not state is None])
 
-        input_word_ids = [[str_to_unk(self, token.history[-1])
+        for index, token in enumerate(tokens):
+            logprob, state = results[index]
+            token.append_word(target_words[index])
+            token.state = state
+
+            if target_word_ids[index] == self._unk_id:
+                if self._ignore_unk:
+                    continue
+                if not self._unk_penalty is None:
+                    token.nn_lm_logprob += self._unk_penalty
+                    continue
+            token.nn_lm_logprob += logprob
+
+    def _step(self, tokens, target_word_ids):
+        """Computes the NNLM log probabilities of target words and the output
+        recurrent states using one call to the step function.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: input tokens; the last word of the history of each token
+                       is the input word
+
+        :type target_word_ids: list of ints
+        :param target_word_ids: ID of the word to be predicted for each token
+
+        :rtype: list of tuples
+        :returns: the log probability of the target word (including the class
+                  membership probability) and a handle to the output state for
+                  each token; the caller owns one reference to each state
+        """
+
+        self._num_nnlm_evaluations += len(tokens)
+        input_word_ids = [[self._str_to_unk(token.last_word())
                            for token in tokens]]
         input_word_ids = numpy.asarray(input_word_ids).astype('int64')
-        input_class_ids, membership_probs = \
+        input_class_ids, _ = \
             self._vocabulary.get_class_memberships(input_word_ids)
-        recurrent_state = [token.state for token in tokens]
-        recurrent_state = RecurrentState.combine_sequences(recurrent_state)
-        target_word_id = str_to_unk(self, target_word)
-        target_class_ids = numpy.ones(shape=(1, len(tokens))).astype('int64')
-        target_class_ids *= self._vocabulary.word_id_to_class_id[target_word_id]
+        target_word_ids = numpy.asarray([target_word_ids]).astype('int64')
+        target_class_ids, membership_probs = \
+            self._vocabulary.get_class_memberships(target_word_ids)
+        recurrent_state = self._states.gather([token.state
+                                               for token in tokens])
+        start_time = time.time()
         step_result = self.step_function(input_word_ids,
                                          input_class_ids,
                                          target_class_ids,
-                                         *recurrent_state.get())
+                                         *recurrent_state)
+        self.stats.add_nn_call(len(tokens), time.time() - start_time)
         logprobs = step_result[0]
         # Add logprobs from the class membership of the predicted words.
         logprobs += numpy.log(membership_probs)
-        output_state = step_result[1:]
+        # Copy the output states to the arena, so that the output matrices
+        # can be freed.
+        output_states = self._states.store(step_result[1:])
+
+        # logprobs matrix contains only one time step.
+        return [(logprobs[0,index], int(output_states[index]))
+                for index in range(len(tokens))]
+
+    def _cache_key(self, token, target_word_id):
+        """Creates the key that is used to look up the NNLM log probability and
+        output state of a token from the cache.
+
+        The key consists of the history and the target word ID. If
+        ``recombination_order`` is set, only that many previous words are
+        included in the key, as the tokens whose limited history matches are
+        considered equivalent when recombining anyway. Otherwise the key
+        contains the ``WordHistory`` object of the token, which caches the hash
+        of the entire history, so that creating the key doesn't take time
+        proportional to the history length. Then OOV words in the history are
+        compared by their text, instead of treating them all as ``<unk>``.
+
+        :type token: LatticeDecoder.Token
+        :param token: a token whose history is used as the context
+
+        :type target_word_id: int
+        :param target_word_id: ID of the predicted word
+
+        :rtype: tuple
+        :returns: a hashable key for the cache
+        """
 
-        for index, token in enumerate(tokens):
-            token.history.append(target_word)
-            token.state = RecurrentState(self._network.recurrent_state_size)
-            # Slice the sequence that corresponds to this token.
-            token.state.set([layer_state[:,index:index+1]
-                             for layer_state in output_state])
+        if self._recombination_order is None:
+            return token.word_history, target_word_id
+        history = token.last_words(self._recombination_order)
+        history = tuple(self._str_to_unk(word) for word in history)
+        return history, target_word_id
 
-            if target_word_id == self._unk_id:
-                if self._ignore_unk:
-                    continue
-                if not self._unk_penalty is None:
-                    token.nn_lm_logprob += self._unk_penalty
-                    continue
-            # logprobs matrix contains only one time step.
-            token.nn_lm_logprob += logprobs[0,index]
+    def _str_to_unk(self, word):
+        """Converts an OOV word, that is saved in a token history as text, to
+        the ``<unk>`` word ID.
+
+        :type word: int or str
+        :param word: a word ID or an OOV word
+
+        :rtype: int
+        :returns: the word ID, or ``<unk>`` ID if ``word`` is not an integer
+        """
+
+        if isinstance(word, int):
+            return word
+        else:
+            return self._unk_id
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import queue
+
+class LatticePrefetcher(object):
+    """Background Lattice Reader
+
+    Reads and parses lattice files in a background thread while the previous
+    lattices are being decoded. At most ``depth`` parsed lattices are kept in a
+    queue, so that memory usage stays bounded. Reading compressed files from
+    networked storage spends most of the time waiting for I/O or in zlib, which
+    release the interpreter lock, so a thread is enough to hide the latency.
+
+    Iterating the object yields the results in the original order. An exception
+    raised while reading a file is raised again when its result is requested.
+    The time spent waiting for the background thread is accumulated in
+    ``stall_time``.
+    """
+
+    def __init__(self, paths, read_function, depth):
+        """Starts the background thread.
+
+        :type paths: list of strs
+        :param paths: paths to the lattice files
+
+        :type read_function: callable
+        :param read_function: a function that reads a lattice file, given its
+                              path
+
+        :type depth: int
+        :param depth: maximum number of lattices to read ahead
+        """
+
+        if depth < 1:
+            raise ValueError("Prefetch queue depth has to be positive.")
+
+        self.stall_time = 0.0
+        self.num_stalls = 0
+        self.total_queue_depth = 0
+        self.num_lattices = 0
+        self._paths = paths
+        self._read_function = read_function
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read_lattices,
+                                        daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        """Yields the lattices in the original order.
+
+        Tracks how long the caller has to wait for each lattice and how many
+        lattices were ready in the queue.
+
+        :rtype: generator
+        :returns: a generator of (path, lattice) tuples
+        """
+
+        try:
+            for path in self._paths:
+                self.total_queue_depth += self._queue.qsize()
+                start_time = time.time()
+                if self._queue.empty():
+                    self.num_stalls += 1
+                lattice, exception = self._queue.get()
+                self.stall_time += time.time() - start_time
+                self.num_lattices += 1
+                if not exception is None:
+                    raise exception
+                yield path, lattice
+        finally:
+            self.close()
+
+    def mean_queue_depth(self):
+        """Returns the average number of lattices that were ready in the queue
+        when the next lattice was requested.
+
+        :rtype: float
+        :returns: the mean queue depth
+        """
+
+        if self.num_lattices == 0:
+            return 0.0
+        return self.total_queue_depth / self.num_lattices
+
+    def close(self):
+        """Stops the background thread.
+
+        The thread may be blocked on a full queue, so the queue is emptied after
+        setting the stop flag.
+        """
+
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join(0.01)
+
+    def _read_lattices(self):
+        """Reads the lattices and puts them into the queue.
+
+        Runs in the background thread until all the lattices have been read or
+        ``close()`` is called.
+        """
+
+        for path in self._paths:
+            if self._stop.is_set():
+                return
+            try:
+                result = (self._read_function(path), None)
+            except Exception as exception:
+                result = (None, exception)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
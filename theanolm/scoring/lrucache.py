@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Least Recently Used Cache
+
+    A mapping with a bounded number of items. When the cache is full, inserting
+    a new item evicts the item that was accessed least recently. The number of
+    successful and unsuccessful lookups are counted in ``hits`` and ``misses``.
+    """
+
+    def __init__(self, max_size):
+        """Constructs an empty cache.
+
+        :type max_size: int
+        :param max_size: maximum number of items to keep in the cache
+        """
+
+        if max_size < 1:
+            raise ValueError("Cache size has to be at least one.")
+
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        """Returns the value of an item, or ``None`` if the key is not found.
+
+        A successful lookup marks the item as the most recently used.
+
+        :type key: hashable object
+        :param key: key of the item
+
+        :rtype: object
+        :returns: the cached value, or ``None`` if the key is not in the cache
+        """
+
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Inserts an item in the cache, evicting the least recently used item
+        if the cache is full.
+
+        :type key: hashable object
+        :param key: key of the item
+
+        :type value: object
+        :param value: value of the item
+
+        :rtype: object
+        :returns: the value that was removed from the cache, either the old
+                  value of ``key`` or the value of the evicted item, or
+                  ``None`` if nothing was removed
+        """
+
+        removed = None
+        if key in self._items:
+            self._items.move_to_end(key)
+            removed = self._items[key]
+        self._items[key] = value
+        if len(self._items) > self.max_size:
+            _, removed = self._items.popitem(last=False)
+        return removed
+
+    def clear(self):
+        """Removes all the items and resets the counters.
+        """
+
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        """Returns the number of items in the cache.
+
+        :rtype: int
+        :returns: the number of items in the cache
+        """
+
+        return len(self._items)
+
+    def __contains__(self, key):
+        """Tests if ``key`` is in the cache, without affecting the order of
+        the items or the counters.
+
+        :type key: hashable object
+        :param key: key of an item
+
+        :rtype: bool
+        :returns: ``True`` if the key is in the cache, ``False`` otherwise
+        """
+
+        return key in self._items
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy
+import theano
+from theanolm.exceptions import NumberError
+from theanolm.scoring.stepfunction import create_step_function
+
+class NBestScorer(object):
+    """N-best List Scoring Using a Prefix Tree
+
+    The hypotheses of one utterance in an n-best list typically share long
+    prefixes. Instead of scoring every hypothesis from the beginning, the
+    hypotheses are arranged in a prefix tree (trie), and the neural network is
+    evaluated once for each arc of the tree, using the single-step network and
+    passing the recurrent state from a node to its children. The arcs at the
+    same depth are evaluated in one batch. The score of a hypothesis is the sum
+    of the arc log probabilities along its path.
+    """
+
+    def __init__(self, network, ignore_unk=False, unk_penalty=None,
+                 max_batch_size=None, profile=False):
+        """Creates a Theano function that computes the output probabilities for
+        a single time step.
+
+        :type network: Network
+        :param network: the neural network object, created in single time step
+                        mode
+
+        :type ignore_unk: bool
+        :param ignore_unk: if set to True, <unk> tokens are excluded from
+                           the sentence scores
+
+        :type unk_penalty: float
+        :param unk_penalty: if set to othern than None, used as <unk> token
+                            score
+
+        :type max_batch_size: int
+        :param max_batch_size: if set to other than None, limit the number of
+                               arcs that will be processed by the neural
+                               network in a single call
+
+        :type profile: bool
+        :param profile: if set to True, creates a Theano profile object
+        """
+
+        if network.mode.minibatch:
+            raise ValueError("NBestScorer requires a network that has been "
+                             "created with Network.Mode(minibatch=False).")
+
+        self._ignore_unk = ignore_unk
+        self._unk_penalty = unk_penalty
+        self._max_batch_size = max_batch_size
+        self._vocabulary = network.vocabulary
+        self._unk_id = network.vocabulary.word_to_id['<unk>']
+        self._state_sizes = network.recurrent_state_size
+        # Number of arcs that were evaluated and number of words that were
+        # predicted since the object was created.
+        self.num_evaluations = 0
+        self.num_predictions = 0
+
+        self.step_function = create_step_function(network,
+                                                  'nbest_step_predictor',
+                                                  profile)
+
+    def score_sequences(self, sequences):
+        """Computes the log probabilities of word sequences that share
+        prefixes.
+
+        The first word of each sequence is not predicted, as it is normally the
+        sentence start tag ``<s>``.
+
+        :type sequences: list of ndarrays
+        :param sequences: a vector of word IDs for each sequence
+
+        :rtype: list of floats
+        :returns: log probability of each word sequence
+        """
+
+        if not sequences:
+            return []
+
+        levels, paths = self._build_trie(sequences)
+
+        # The total log probability and the recurrent state at each node of
+        # the previous level. The roots have zero state.
+        num_roots = len(levels[0])
+        node_logprobs = numpy.zeros(num_roots)
+        node_states = [numpy.zeros((1, num_roots, size)).astype(
+                           theano.config.floatX)
+                       for size in self._state_sizes]
+        level_logprobs = [node_logprobs]
+        for depth in range(1, len(levels)):
+            parents = numpy.array([parent for parent, _ in levels[depth]],
+                                  dtype='int64')
+            input_word_ids = numpy.array([levels[depth - 1][parent][1]
+                                          for parent in parents],
+                                         dtype='int64')
+            target_word_ids = numpy.array([word_id
+                                           for _, word_id in levels[depth]],
+                                          dtype='int64')
+            input_states = [state[:, parents, :] for state in node_states]
+            arc_logprobs, node_states = self._step(input_word_ids,
+                                                   target_word_ids,
+                                                   input_states)
+            node_logprobs = node_logprobs[parents] + arc_logprobs
+            level_logprobs.append(node_logprobs)
+
+        result = []
+        for path in paths:
+            depth = len(path) - 1
+            logprob = level_logprobs[depth][path[-1]]
+            if numpy.isnan(logprob):
+                raise NumberError("Log probability of a sequence is NaN.")
+            if numpy.isinf(logprob):
+                raise NumberError("Log probability of a sequence is +/- "
+                                  "infinity.")
+            self.num_predictions += depth
+            result.append(logprob)
+        return result
+
+    def _build_trie(self, sequences):
+        """Arranges word sequences in a prefix tree.
+
+        The tree is represented level by level. A node at depth ``d`` is a
+        ``(parent, word_id)`` tuple, where ``parent`` is the index of the parent
+        node at depth ``d - 1``, or ``None`` for the roots at depth 0.
+
+        :type sequences: list of ndarrays
+        :param sequences: a vector of word IDs for each sequence
+
+        :rtype: tuple of two lists
+        :returns: a list of nodes at each depth, and the index of the node at
+                  each depth for each sequence
+        """
+
+        levels = []
+        node_indices = []
+        paths = []
+        for sequence in sequences:
+            path = []
+            parent = None
+            for depth, word_id in enumerate(sequence):
+                if depth == len(levels):
+                    levels.append([])
+                    node_indices.append(dict())
+                key = (parent, int(word_id))
+                index = node_indices[depth].get(key)
+                if index is None:
+                    index = len(levels[depth])
+                    levels[depth].append(key)
+                    node_indices[depth][key] = index
+                path.append(index)
+                parent = index
+            paths.append(path)
+        return levels, paths
+
+    def _step(self, input_word_ids, target_word_ids, input_states):
+        """Computes the log probabilities of the arcs at one level of the tree
+        and the recurrent states of their child nodes.
+
+        If ``max_batch_size`` is set, the arcs are divided into several calls to
+        the step function.
+
+        :type input_word_ids: numpy.ndarray
+        :param input_word_ids: the word ID of the parent node of each arc
+
+        :type target_word_ids: numpy.ndarray
+        :param target_word_ids: the word ID of the child node of each arc
+
+        :type input_states: list of numpy.ndarrays
+        :param input_states: a (1, N, size) matrix of the parent node states
+                             for each recurrent layer
+
+        :rtype: tuple of a numpy.ndarray and a list of numpy.ndarrays
+        :returns: the log probability of each arc and a (1, N, size) matrix of
+                  the child node states for each recurrent layer
+        """
+
+        num_arcs = len(target_word_ids)
+        self.num_evaluations += num_arcs
+        if self._max_batch_size is None:
+            batch_size = num_arcs
+        else:
+            batch_size = self._max_batch_size
+
+        logprobs = []
+        output_states = [[] for _ in self._state_sizes]
+        for start in range(0, num_arcs, batch_size):
+            end = start + batch_size
+            batch_input_ids = input_word_ids[numpy.newaxis, start:end]
+            input_class_ids, _ = \
+                self._vocabulary.get_class_memberships(batch_input_ids)
+            batch_target_ids = target_word_ids[numpy.newaxis, start:end]
+            target_class_ids, membership_probs = \
+                self._vocabulary.get_class_memberships(batch_target_ids)
+            step_result = self.step_function(
+                batch_input_ids,
+                input_class_ids,
+                target_class_ids,
+                *[state[:, start:end, :] for state in input_states])
+            # Add logprobs from the class membership of the predicted words.
+            logprobs.append(step_result[0][0] + numpy.log(membership_probs[0]))
+            for layer_states, state in zip(output_states, step_result[1:]):
+                layer_states.append(state)
+        logprobs = numpy.concatenate(logprobs)
+        output_states = [numpy.concatenate(layer_states, axis=1)
+                         for layer_states in output_states]
+
+        unk_mask = target_word_ids == self._unk_id
+        if self._ignore_unk:
+            logprobs[unk_mask] = 0.0
+        elif not self._unk_penalty is None:
+            logprobs[unk_mask] = self._unk_penalty
+        return logprobs, output_states
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
 import numpy
 from shlex import shlex
 from theanolm.exceptions import InputError
@@ -10,9 +11,13 @@ from theanolm.scoring.lattice import Lattice
 class SLFLattice(Lattice):
     """SLF Format Word Lattice
 
-    A word lattice that can be read in SLF format.
+    A word lattice that can be read and written in SLF format.
     """
 
+    # A field is a sequence of unquoted characters and quoted strings, without
+    # whitespace outside the quotes.
+    _field_re = re.compile(r'(?:[^ \t\r\n"]+|"[^"]*")+')
+
     def __init__(self, lattice_file):
         """Reads an SLF lattice file.
 
@@ -100,6 +105,76 @@ class SLFLattice(Lattice):
                                  "in link {} or in the following node.".format(
                                  link.id))
 
+    def write(self, output_file, log_base=None):
+        """Writes the lattice in SLF format.
+
+        Node IDs are written as they are, so the nodes have to be numbered from
+        zero in the order of the node list. Missing log probabilities and times
+        are omitted.
+
+        :type output_file: file object
+        :param output_file: a file where to write the lattice
+
+        :type log_base: float
+        :param log_base: base of the log probabilities in the file (default is
+                         the natural logarithm)
+        """
+
+        if log_base is None:
+            log_scale = 1.0
+        else:
+            log_scale = numpy.log(log_base)
+
+        output_file.write("VERSION=1.1\n")
+        if not self.utterance_id is None:
+            output_file.write("UTTERANCE={}\n".format(
+                self._format_slf_value(self.utterance_id)))
+        if not log_base is None:
+            output_file.write("base={}\n".format(log_base))
+        if not self.lm_scale is None:
+            output_file.write("lmscale={}\n".format(self.lm_scale))
+        if not self.wi_penalty is None:
+            output_file.write("wdpenalty={}\n".format(
+                self.wi_penalty / log_scale))
+        output_file.write("start={}\n".format(self.initial_node.id))
+        output_file.write("end={}\n".format(self.final_node.id))
+        output_file.write("NODES={} LINKS={}\n".format(len(self.nodes),
+                                                       len(self.links)))
+
+        for node in self.nodes:
+            if node.time is None:
+                output_file.write("I={}\n".format(node.id))
+            else:
+                output_file.write("I={}\tt={}\n".format(node.id, node.time))
+
+        for link_id, link in enumerate(self.links):
+            fields = ["J={}".format(link_id),
+                      "S={}".format(link.start_node.id),
+                      "E={}".format(link.end_node.id)]
+            if not link.word is None:
+                fields.append("W={}".format(self._format_slf_value(link.word)))
+            if not link.ac_logprob is None:
+                fields.append("a={:.4f}".format(link.ac_logprob / log_scale))
+            if not link.lm_logprob is None:
+                fields.append("l={:.4f}".format(link.lm_logprob / log_scale))
+            output_file.write("\t".join(fields) + "\n")
+
+    def _format_slf_value(self, value):
+        """Quotes a field value if necessary.
+
+        :type value: str
+        :param value: a value to be written in an SLF field
+
+        :rtype: str
+        :returns: the value, in double quotes if it contains whitespace or
+                  special characters
+        """
+
+        if (value == '') or any(char in value for char in ' \t"\\#'):
+            return '"{}"'.format(value.replace('\\', '\\\\')
+                                      .replace('"', '\\"'))
+        return value
+
     def _read_slf_header(self, fields):
         """Reads SLF lattice header fields and saves them in member variables.
 
@@ -195,7 +270,7 @@ class SLFLattice(Lattice):
         if end_node is None:
             raise InputError("End node is not specified for link {}.".format(
                              link_id))
-        link = self._add_link(start_node, end_node)
+        link = self.add_link(start_node, end_node)
         link.word = word
         link.ac_logprob = ac_logprob
         link.lm_logprob = lm_logprob
@@ -208,6 +283,10 @@ class SLFLattice(Lattice):
         " the double quote must be escaped (\"). I'm not surprise if other
         implementations or the standard doesn't agree.
 
+        Most lines can be split using a regular expression. Lines that contain
+        escape characters, comments, or unbalanced quotes are parsed using
+        ``shlex``, which is an order of magnitude slower.
+
         :type line: str
         :param line: a line from an SLF file
 
@@ -216,6 +295,25 @@ class SLFLattice(Lattice):
                   marks removed
         """
 
+        if ('\\' in line) or ('#' in line) or (line.count('"') % 2 != 0):
+            return self._split_slf_line_shlex(line)
+
+        fields = self._field_re.findall(line)
+        if '"' in line:
+            fields = [field.replace('"', '') for field in fields]
+        return fields
+
+    def _split_slf_line_shlex(self, line):
+        """Parses a list of fields from an SLF lattice line using ``shlex``.
+
+        :type line: str
+        :param line: a line from an SLF file
+
+        :rtype: list of strs
+        :returns: list of fields found from the line, with possible quotation
+                  marks and escape characters removed
+        """
+
         lex = shlex(line, posix=True)
         lex.quotes = '"'
         lex.wordchars += "'"
@@ -250,23 +348,24 @@ class SLFLattice(Lattice):
         in the end nodes in forward lattices.
         """
 
+        # Traverse the lattice using an explicit stack, since recursion would
+        # exceed the recursion limit with large lattices.
         visited = { self.initial_node.id }
-
-        def visit_link(link):
-            end_node = link.end_node
-            if hasattr(end_node, 'word') and isinstance(end_node.word, str):
-                if link.word is None:
-                    link.word = end_node.word
-                else:
-                    raise InputError("SLF lattice contains words both in nodes "
-                                     "and links.")
-            if not end_node.id in visited:
-                visited.add(end_node.id)
-                for next_link in end_node.out_links:
-                    visit_link(next_link)
-
-        for link in self.initial_node.out_links:
-            visit_link(link)
+        stack = [self.initial_node]
+        while stack:
+            node = stack.pop()
+            for link in node.out_links:
+                end_node = link.end_node
+                if hasattr(end_node, 'word') and \
+                   isinstance(end_node.word, str):
+                    if link.word is None:
+                        link.word = end_node.word
+                    else:
+                        raise InputError("SLF lattice contains words both in "
+                                         "nodes and links.")
+                if not end_node.id in visited:
+                    visited.add(end_node.id)
+                    stack.append(end_node)
 
         for node in self.nodes:
             if hasattr(node, 'word'):
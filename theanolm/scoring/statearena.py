@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy
+import theano
+from theanolm.network import RecurrentState
+
+class StateArena(object):
+    """Storage for the Recurrent States of Decoding Tokens
+
+    Stores the states of all the live tokens in preallocated matrices, one for
+    each recurrent state variable. The rows of the matrices are referred to by
+    integer handles. The input of the step function is created by gathering the
+    rows of the given handles, and the output of the step function is copied
+    into free rows, so the tokens don't keep the output matrices of the step
+    function alive.
+
+    Each handle has a reference count. The row is returned to the free list
+    when the reference count drops to zero. The matrices grow when there are no
+    free rows left.
+    """
+
+    def __init__(self, sizes, initial_capacity=1024):
+        """Allocates the state matrices.
+
+        :type sizes: list of ints
+        :param sizes: size of each recurrent layer state
+
+        :type initial_capacity: int
+        :param initial_capacity: number of states to allocate initially
+        """
+
+        self.sizes = sizes
+        self._capacity = 0
+        self._blocks = [numpy.zeros((0, size)).astype(theano.config.floatX)
+                        for size in sizes]
+        self._ref_counts = numpy.zeros(0, dtype='int64')
+        self._free = []
+        self._grow(max(initial_capacity, 1))
+        # The largest number of live states since the last reset_peak().
+        self.peak_size = 0
+
+    def store(self, state_variables):
+        """Copies the states of a step function output into free rows.
+
+        :type state_variables: list of numpy.ndarrays
+        :param state_variables: a (1, N, size) matrix for each recurrent layer
+
+        :rtype: numpy.ndarray
+        :returns: a handle for each of the N sequences, with reference count
+                  one
+        """
+
+        num_sequences = state_variables[0].shape[1]
+        handles = self._allocate(num_sequences)
+        for block, state_variable in zip(self._blocks, state_variables):
+            block[handles] = state_variable[0]
+        return handles
+
+    def initial_state(self):
+        """Allocates a state that is initialized to zeros.
+
+        :rtype: int
+        :returns: a handle to the new state, with reference count one
+        """
+
+        handle = self._allocate(1)
+        for block in self._blocks:
+            block[handle] = 0
+        return int(handle[0])
+
+    def gather(self, handles):
+        """Creates the recurrent state input of the step function.
+
+        :type handles: list of ints
+        :param handles: a handle for each sequence in the mini-batch
+
+        :rtype: list of numpy.ndarrays
+        :returns: a (1, N, size) matrix for each recurrent layer
+        """
+
+        handles = numpy.asarray(handles, dtype='int64')
+        return [block[handles][numpy.newaxis] for block in self._blocks]
+
+    def get(self, handle):
+        """Returns a copy of a single state.
+
+        :type handle: int
+        :param handle: a handle to a live state
+
+        :rtype: RecurrentState
+        :returns: the state of the recurrent layers for a single sequence
+        """
+
+        state_variables = self.gather([handle])
+        return RecurrentState(self.sizes, 1, state_variables)
+
+    def retain(self, handles):
+        """Increments the reference counts of states.
+
+        :type handles: list of ints
+        :param handles: handles to live states; a handle may appear multiple
+                        times
+        """
+
+        if len(handles) > 0:
+            numpy.add.at(self._ref_counts, handles, 1)
+
+    def release(self, handles):
+        """Decrements the reference counts of states, and frees the states whose
+        reference count drops to zero.
+
+        :type handles: list of ints
+        :param handles: handles to live states; a handle may appear multiple
+                        times
+        """
+
+        if len(handles) == 0:
+            return
+        handles = numpy.unique(numpy.asarray(handles, dtype='int64'),
+                               return_counts=True)
+        handles, counts = handles
+        self._ref_counts[handles] -= counts
+        if numpy.any(self._ref_counts[handles] < 0):
+            raise RuntimeError("Recurrent state was released too many times.")
+        freed = handles[self._ref_counts[handles] == 0]
+        self._free.extend(freed.tolist())
+
+    def __len__(self):
+        """Returns the number of live states.
+
+        :rtype: int
+        :returns: the number of states whose reference count is nonzero
+        """
+
+        return self._capacity - len(self._free)
+
+    def state_bytes(self):
+        """Returns the memory used by the states of a single sequence.
+
+        :rtype: int
+        :returns: the number of bytes in one row of all the matrices
+        """
+
+        return sum(block.itemsize * block.shape[1] for block in self._blocks)
+
+    def reset_peak(self):
+        """Starts tracking the peak number of live states from the current
+        number.
+        """
+
+        self.peak_size = len(self)
+
+    def _allocate(self, count):
+        """Takes rows from the free list, growing the matrices if necessary.
+
+        :type count: int
+        :param count: number of rows to allocate
+
+        :rtype: numpy.ndarray
+        :returns: the allocated row indices, with reference count one
+        """
+
+        if count == 0:
+            return numpy.zeros(0, dtype='int64')
+        if len(self._free) < count:
+            self._grow(max(self._capacity * 2, self._capacity + count))
+        handles = numpy.asarray(self._free[-count:], dtype='int64')
+        del self._free[-count:]
+        self._ref_counts[handles] = 1
+        self.peak_size = max(self.peak_size, len(self))
+        return handles
+
+    def _grow(self, capacity):
+        """Reallocates the matrices with a larger number of rows.
+
+        :type capacity: int
+        :param capacity: the new number of rows
+        """
+
+        old_capacity = self._capacity
+        for index, block in enumerate(self._blocks):
+            new_block = numpy.zeros((capacity, block.shape[1]),
+                                    dtype=block.dtype)
+            new_block[:old_capacity] = block
+            self._blocks[index] = new_block
+        ref_counts = numpy.zeros(capacity, dtype='int64')
+        ref_counts[:old_capacity] = self._ref_counts
+        self._ref_counts = ref_counts
+        # Allocate the lowest indices first.
+        self._free.extend(range(capacity - 1, old_capacity - 1, -1))
+        self._capacity = capacity
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy
+import theano
+
+def create_step_function(network, name='step_predictor', profile=False):
+    """Creates a Theano function that computes the target word log
+    probabilities for a single time step.
+
+    The function takes as input the input word IDs, input class IDs, and
+    target class IDs of a (1, N) batch, and the recurrent state of each layer.
+    It returns the (1, N) target log probabilities, followed by the recurrent
+    state outputs. The log probabilities are computed using
+    ``network.target_logprobs()``, so that they won't underflow.
+
+    :type network: Network
+    :param network: the neural network object, created in single time step
+                    mode
+
+    :type name: str
+    :param name: name of the Theano function
+
+    :type profile: bool
+    :param profile: if set to True, creates a Theano profile object
+
+    :rtype: theano.compile.function_module.Function
+    :returns: the compiled step function
+    """
+
+    inputs = [network.input_word_ids,
+              network.input_class_ids,
+              network.target_class_ids]
+    inputs.extend(network.recurrent_state_input)
+
+    outputs = [network.target_logprobs()]
+    outputs.extend(network.recurrent_state_output)
+
+    # Ignore unused input, because is_training is only used by dropout layer.
+    return theano.function(
+        inputs,
+        outputs,
+        givens=[(network.is_training, numpy.int8(0))],
+        name=name,
+        on_unused_input='ignore',
+        profile=profile)
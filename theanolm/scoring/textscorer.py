@@ -6,6 +6,7 @@ import theano.tensor as tensor
 import numpy
 from theanolm.matrixfunctions import test_value
 from theanolm.exceptions import NumberError
+from theanolm.network import RecurrentState
 
 class TextScorer(object):
     """Text Scoring Using a Neural Network Language Model
@@ -34,6 +35,12 @@ class TextScorer(object):
         ``self._total_logprob_function()`` will return the total log probability
         of the predicted (unmasked) words and the number of those words.
 
+        If the network has been created in stateful mode, these functions start
+        from zero recurrent state, and a third function,
+        ``self._stateful_logprobs_function()``, is created. It takes the initial
+        recurrent states as additional arguments, and returns also the states
+        after the last time step.
+
         :type network: Network
         :param network: the neural network object
 
@@ -53,6 +60,9 @@ class TextScorer(object):
         self._unk_penalty = unk_penalty
         self._vocabulary = network.vocabulary
         self._unk_id = network.vocabulary.word_to_id['<unk>']
+        self._stateful = network.mode.stateful
+        if self._stateful:
+            self._state_sizes = network.recurrent_state_size
 
         # The functions take as input a mini-batch of word IDs and class IDs,
         # and slice input and target IDs for the network.
@@ -69,7 +79,7 @@ class TextScorer(object):
         membership_probs.tag.test_value = test_value(
             size=(100, 16), high=1.0)
 
-        logprobs = tensor.log(network.target_probs())
+        logprobs = network.target_logprobs()
         # Add logprobs from the class membership of the predicted word at each
         # time step of each sequence.
         logprobs += tensor.log(membership_probs)
@@ -87,28 +97,51 @@ class TextScorer(object):
             mask *= tensor.neq(target_word_ids, self._unk_id)
         logprobs *= tensor.cast(mask, theano.config.floatX)
 
+        givens = [(network.input_word_ids, batch_word_ids[:-1]),
+                  (network.input_class_ids, batch_class_ids[:-1]),
+                  (network.target_class_ids, batch_class_ids[1:]),
+                  (network.is_training, numpy.int8(0))]
+        if self._stateful:
+            # Without a state input, the sequences start from zero state.
+            num_sequences = batch_word_ids.shape[1]
+            zero_state_givens = \
+                [(state_input,
+                  tensor.zeros((1, num_sequences, size),
+                               dtype=theano.config.floatX))
+                 for state_input, size in zip(network.recurrent_state_input,
+                                              self._state_sizes)]
+        else:
+            zero_state_givens = []
+
         # Ignore unused input variables, because is_training is only used by
         # dropout layer.
         self._target_logprobs_function = theano.function(
             [batch_word_ids, batch_class_ids, membership_probs, network.mask],
             [logprobs, mask],
-            givens=[(network.input_word_ids, batch_word_ids[:-1]),
-                    (network.input_class_ids, batch_class_ids[:-1]),
-                    (network.target_class_ids, batch_class_ids[1:]),
-                    (network.is_training, numpy.int8(0))],
+            givens=givens + zero_state_givens,
             name='target_logprobs',
             on_unused_input='ignore',
             profile=profile)
         self._total_logprob_function = theano.function(
             [batch_word_ids, batch_class_ids, membership_probs, network.mask],
             [logprobs.sum(), mask.sum()],
-            givens=[(network.input_word_ids, batch_word_ids[:-1]),
-                    (network.input_class_ids, batch_class_ids[:-1]),
-                    (network.target_class_ids, batch_class_ids[1:]),
-                    (network.is_training, numpy.int8(0))],
+            givens=givens + zero_state_givens,
             name='total_logprob',
             on_unused_input='ignore',
             profile=profile)
+        if self._stateful:
+            inputs = [batch_word_ids, batch_class_ids, membership_probs,
+                      network.mask]
+            inputs.extend(network.recurrent_state_input)
+            outputs = [logprobs, mask]
+            outputs.extend(network.recurrent_state_output)
+            self._stateful_logprobs_function = theano.function(
+                inputs,
+                outputs,
+                givens=givens,
+                name='stateful_logprobs',
+                on_unused_input='ignore',
+                profile=profile)
 
     def score_batch(self, word_ids, class_ids, membership_probs, mask):
         """Computes the log probabilities predicted by the neural network for
@@ -241,6 +274,156 @@ class TextScorer(object):
 
         return logprob
 
+    def score_sequences(self, sequences):
+        """Computes the log probabilities of several word sequences using one
+        mini-batch.
+
+        The sequences are padded to the length of the longest sequence, so the
+        mini-batch is most efficient when the sequences are of similar length.
+        The padding repeats the last word of each sequence, so that the network
+        computes valid probabilities for the masked elements.
+
+        :type sequences: list of ndarrays
+        :param sequences: a vector of word IDs for each sequence
+
+        :rtype: list of floats
+        :returns: log probability of each word sequence
+        """
+
+        max_length = max(len(sequence) for sequence in sequences)
+        shape = (max_length, len(sequences))
+        word_ids = numpy.zeros(shape, numpy.int64)
+        mask = numpy.zeros(shape, numpy.int8)
+        for seq_index, sequence in enumerate(sequences):
+            word_ids[:len(sequence), seq_index] = sequence
+            word_ids[len(sequence):, seq_index] = sequence[-1]
+            mask[:len(sequence), seq_index] = 1
+        class_ids, membership_probs = \
+            self._vocabulary.get_class_memberships(word_ids)
+
+        result = []
+        for seq_logprobs in self.score_batch(word_ids, class_ids,
+                                             membership_probs, mask):
+            logprob = seq_logprobs.sum()
+            if numpy.isnan(logprob):
+                raise NumberError("Log probability of a sequence is NaN.")
+            if numpy.isinf(logprob):
+                raise NumberError("Log probability of a sequence is +/- "
+                                  "infinity.")
+            result.append(logprob)
+        return result
+
+    def score_chunk(self, word_ids, class_ids, membership_probs, mask, state):
+        """Computes the log probabilities predicted by the neural network for
+        the words in a mini-batch that continues the sequences of a previous
+        mini-batch.
+
+        The first time step of the mini-batch should be the last time step of
+        the previous mini-batch, as it is only used as input. Requires that the
+        network has been created in stateful mode.
+
+        :type word_ids: numpy.ndarray of an integer type
+        :param word_ids: a 2-dimensional matrix, indexed by time step and
+                         sequence, that contains the word IDs
+
+        :type class_ids: numpy.ndarray of an integer type
+        :param class_ids: a 2-dimensional matrix, indexed by time step and
+                          sequence, that contains the class IDs
+
+        :type membership_probs: numpy.ndarray of a floating point type
+        :param membership_probs: a 2-dimensional matrix, indexed by time step
+                                 and sequences, that contains the class
+                                 membership probabilities of the words
+
+        :type mask: numpy.ndarray of a floating point type
+        :param mask: a 2-dimensional matrix, indexed by time step and sequence,
+                     that masks out elements past the sequence ends
+
+        :type state: RecurrentState
+        :param state: the recurrent state of each sequence after the previous
+                      mini-batch, or zeros at the beginning of the sequences
+
+        :rtype: tuple of a list and a RecurrentState
+        :returns: logprob of each word in each sequence, and the recurrent state
+                  of each sequence after the last word that was used as input
+        """
+
+        if not self._stateful:
+            raise RuntimeError("TextScorer.score_chunk() requires a network in "
+                               "stateful mode.")
+
+        membership_probs = membership_probs.astype(theano.config.floatX)
+        outputs = self._stateful_logprobs_function(word_ids,
+                                                   class_ids,
+                                                   membership_probs[1:],
+                                                   mask[1:],
+                                                   *state.get())
+        logprobs = outputs[0]
+        mask = outputs[1]
+        result = []
+        for seq_index in range(logprobs.shape[1]):
+            seq_logprobs = logprobs[:,seq_index]
+            seq_mask = mask[:,seq_index]
+            seq_logprobs = seq_logprobs[seq_mask == 1]
+            result.append(seq_logprobs)
+        state = RecurrentState(self._state_sizes, logprobs.shape[1], outputs[2:])
+        return result, state
+
+    def score_long_sequences(self, sequences, chunk_length):
+        """Computes the log probabilities of word sequences that may be too long
+        to be processed in one mini-batch.
+
+        The sequences are processed in parallel, ``chunk_length`` predicted
+        words at a time, carrying the recurrent state from one chunk to the
+        next. The memory usage depends on ``chunk_length``, and not on the
+        length of the sequences, but the result is the same as if the sequences
+        were scored in one mini-batch. Requires that the network has been
+        created in stateful mode.
+
+        :type sequences: list of ndarrays
+        :param sequences: a vector of word IDs for each sequence
+
+        :type chunk_length: int
+        :param chunk_length: number of words to predict per chunk
+
+        :rtype: list of floats
+        :returns: log probability of each word sequence
+        """
+
+        num_sequences = len(sequences)
+        max_length = max(len(sequence) for sequence in sequences)
+        state = RecurrentState(self._state_sizes, num_sequences)
+        result = numpy.zeros(num_sequences)
+        for start in range(0, max_length - 1, chunk_length):
+            # Consecutive chunks overlap by one word, which is the target word
+            # in the previous chunk and the input word in the next chunk.
+            stop = min(start + chunk_length + 1, max_length)
+            shape = (stop - start, num_sequences)
+            word_ids = numpy.zeros(shape, numpy.int64)
+            mask = numpy.zeros(shape, numpy.int8)
+            for seq_index, sequence in enumerate(sequences):
+                chunk = sequence[start:stop]
+                # The padding repeats the last word of each sequence, so that
+                # the network computes valid probabilities for the masked
+                # elements.
+                word_ids[:, seq_index] = sequence[-1]
+                word_ids[:len(chunk), seq_index] = chunk
+                mask[:len(chunk), seq_index] = 1
+            class_ids, membership_probs = \
+                self._vocabulary.get_class_memberships(word_ids)
+            logprobs, state = self.score_chunk(word_ids, class_ids,
+                                               membership_probs, mask, state)
+            for seq_index, seq_logprobs in enumerate(logprobs):
+                result[seq_index] += seq_logprobs.sum()
+
+        for logprob in result:
+            if numpy.isnan(logprob):
+                raise NumberError("Log probability of a sequence is NaN.")
+            if numpy.isinf(logprob):
+                raise NumberError("Log probability of a sequence is +/- "
+                                  "infinity.")
+        return result.tolist()
+
     def unk_ignored(self):
         """Indicates whether the scorer ignores <unk> tokens.
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy
+from theanolm.probfunctions import logprob_type
+
+class TimeFrame(object):
+    """Token Scores of the Nodes at One Time
+
+    Keeps track of the tokens at the lattice nodes that have the same time, so
+    that the total number of tokens at the time frame can be limited. The frame
+    knows how many tokens have been kept at the nodes that have already been
+    pruned, and the scores of the tokens at the nodes that have not been pruned
+    yet.
+
+    The scores of a node are stored by recombination hash, so a token that will
+    be recombined into a better token at the same node doesn't take a share of
+    the frame. The scores are kept in a single buffer that grows as new tokens
+    arrive. A node maps its recombination hashes to positions in the buffer, so
+    a better score replaces the old one in place. When a node is pruned, its
+    scores are overwritten with ``-inf``, and the threshold is selected from
+    the buffer without rebuilding the scores of the other nodes.
+    """
+
+    def __init__(self):
+        """Creates a time frame without nodes.
+        """
+
+        self.num_kept = 0
+        self.num_pending = 0
+        self._nodes = dict()
+        self._scores = numpy.empty(16, dtype=logprob_type)
+        self._size = 0
+
+    def add_node(self, node_id):
+        """Adds a node to the frame. Only the tokens at the nodes that have been
+        added to the frame are counted.
+
+        :type node_id: int
+        :param node_id: ID of a node at the time of this frame
+        """
+
+        self._nodes[node_id] = dict()
+
+    def node_scores(self, node_id):
+        """Returns the scores of the tokens at a pending node.
+
+        :type node_id: int
+        :param node_id: ID of a node that has not been pruned yet
+
+        :rtype: dict
+        :returns: a mapping from recombination hashes to the best total log
+                  probability of the tokens with that hash
+        """
+
+        return {recombination_hash: self._scores[position]
+                for recombination_hash, position
+                in self._nodes[node_id].items()}
+
+    def add_tokens(self, node_id, tokens):
+        """Adds the total log probabilities of new tokens at a node.
+
+        Only the best score of each recombination hash is kept. Nodes that are
+        not pending are ignored.
+
+        :type node_id: int
+        :param node_id: ID of the node where the tokens were added
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: the new tokens
+        """
+
+        positions = self._nodes.get(node_id)
+        if positions is None:
+            return
+
+        for token in tokens:
+            position = positions.get(token.recombination_hash)
+            if position is None:
+                if self._size == len(self._scores):
+                    self._scores = numpy.resize(self._scores,
+                                                2 * len(self._scores))
+                positions[token.recombination_hash] = self._size
+                self._scores[self._size] = token.total_logprob
+                self._size += 1
+                self.num_pending += 1
+            elif token.total_logprob > self._scores[position]:
+                self._scores[position] = token.total_logprob
+
+    def limit(self, node_id, logprobs, max_tokens):
+        """Computes how many tokens can be kept at a node without exceeding the
+        maximum number of tokens in the frame, and marks the node as pruned.
+
+        The tokens at the node compete with the tokens at the pending nodes.
+        The tokens that have already been kept take their share of the limit.
+        If all the tokens fit in the frame, no selection is needed. Otherwise
+        the threshold is found using ``numpy.partition()``, without sorting
+        the frame. At least one token is always kept, so the number of tokens
+        in the frame may exceed ``max_tokens``, if the frame contains more
+        nodes than that.
+
+        :type node_id: int
+        :param node_id: ID of the node that is being pruned
+
+        :type logprobs: numpy.ndarray
+        :param logprobs: total log probabilities of the tokens at the node, in
+                         descending order
+
+        :type max_tokens: int
+        :param max_tokens: maximum number of tokens in the frame
+
+        :rtype: int
+        :returns: the number of best tokens to keep at the node
+        """
+
+        positions = self._nodes.pop(node_id, None)
+        if positions is None:
+            return len(logprobs)
+        if positions:
+            self.num_pending -= len(positions)
+            self._scores[list(positions.values())] = -numpy.inf
+
+        if self.num_kept + self.num_pending + len(logprobs) <= max_tokens:
+            result = len(logprobs)
+        else:
+            limit = max_tokens - self.num_kept
+            if limit <= 0:
+                result = 1
+            else:
+                candidates = numpy.concatenate([self._scores[:self._size],
+                                                logprobs[:limit]])
+                kth = len(candidates) - limit
+                threshold = numpy.partition(candidates, kth)[kth]
+                result = numpy.count_nonzero(logprobs >= threshold)
+                result = max(min(result, limit), 1)
+        self.num_kept += min(result, len(logprobs))
+        return result
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+import numpy
+
+class TimeIndex(object):
+    """Time Index of Lattice Nodes
+
+    Keeps track of the best token log probability at each node, and finds
+    efficiently the best log probability at a given time or later. The nodes
+    are indexed by their position in topological order. Beam pruning compares a
+    token to all the nodes starting from the first node whose time is the same
+    or greater than the time of the pruned node.
+
+    The position where the search starts is found using binary search from the
+    running maximum of the node times. The maximum log probability of the nodes
+    starting from a position is maintained in a Fenwick tree that is indexed in
+    reverse order. Because the best log probability of a node can only
+    increase, both updates and queries take O(log N) time.
+    """
+
+    def __init__(self, sorted_node_ids, node_times):
+        """Creates the index for given nodes. Initially none of the nodes has a
+        log probability.
+
+        :type sorted_node_ids: list of ints
+        :param sorted_node_ids: IDs of the lattice nodes in topological order
+
+        :type node_times: list of floats
+        :param node_times: the time of each node, indexed by node ID, or
+                           ``None`` for the nodes that have no time
+        """
+
+        self._num_nodes = len(sorted_node_ids)
+        self._node_times = node_times
+        self._positions = {node_id: position
+                           for position, node_id in enumerate(sorted_node_ids)}
+
+        # Running maximum of the node times. It's nondecreasing, so we can
+        # search it using bisect. Nodes without time don't affect it.
+        self._time_bounds = []
+        time_bound = -numpy.inf
+        for node_id in sorted_node_ids:
+            time = node_times[node_id]
+            if (not time is None) and (time > time_bound):
+                time_bound = time
+            self._time_bounds.append(time_bound)
+
+        self._tree = [-numpy.inf] * (self._num_nodes + 1)
+
+    def update(self, node_id, logprob):
+        """Informs the index about a token that arrived at a node.
+
+        Nodes that are not in the topological order (because they can be
+        reached only through an unreachable node) are ignored.
+
+        :type node_id: int
+        :param node_id: ID of the node where the token arrived
+
+        :type logprob: logprob_type
+        :param logprob: total log probability of the token
+        """
+
+        position = self._positions.get(node_id)
+        if position is None:
+            return
+        index = self._num_nodes - position
+        while index <= self._num_nodes:
+            if logprob > self._tree[index]:
+                self._tree[index] = logprob
+            index += index & -index
+
+    def best_logprob(self, node_id):
+        """Returns the best log probability of the nodes at the same or later
+        time than the given node.
+
+        If the node doesn't have a time stamp, the search starts from the node
+        itself. Otherwise the search starts from the first node in topological
+        order whose time is greater than or equal to the time of the node.
+
+        :type node_id: int
+        :param node_id: ID of a node whose time will be used
+
+        :rtype: logprob_type
+        :returns: the best log probability at the same or later time, or
+                  ``-inf`` if no tokens have arrived at those nodes
+        """
+
+        time = self._node_times[node_id]
+        if time is None:
+            position = self._positions.get(node_id)
+            if position is None:
+                return -numpy.inf
+        else:
+            position = bisect_left(self._time_bounds, time)
+            position = min(position, self._num_nodes - 1)
+
+        result = -numpy.inf
+        index = self._num_nodes - position
+        while index > 0:
+            if self._tree[index] > result:
+                result = self._tree[index]
+            index -= index & -index
+        return result
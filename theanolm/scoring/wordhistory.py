@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+class WordHistory(object):
+    """Word History of a Decoding Token
+
+    A persistent linked list of words. Each object stores the last word of the
+    history and a pointer to the history before that word. Appending a word
+    creates a new object without modifying the existing one, so the tokens that
+    have been propagated from the same token share the common prefix, and
+    propagating a token takes constant time and memory regardless of the
+    history length.
+
+    The hash of the whole history is computed incrementally when the object is
+    created. The hash of the last N words is computed on demand and cached, as
+    all the tokens in the decoder use the same N. Histories that contain the
+    same words are equal, so they can be used as dictionary keys. The
+    comparison stops at the first object that the histories share.
+    """
+
+    __slots__ = ('word', 'previous', '_length', '_full_hash', '_hash_order',
+                 '_hash')
+
+    def __init__(self, word, previous=None):
+        """Creates a history that contains ``word`` after ``previous``.
+
+        :type word: int or str
+        :param word: the last word of the history
+
+        :type previous: WordHistory
+        :param previous: the history before ``word``, or ``None`` if this is
+                         the first word
+        """
+
+        self.word = word
+        self.previous = previous
+        if previous is None:
+            self._length = 1
+            self._full_hash = hash((word,))
+        else:
+            self._length = previous._length + 1
+            self._full_hash = hash((previous._full_hash, word))
+        self._hash_order = None
+        self._hash = None
+
+    @classmethod
+    def from_words(classname, words):
+        """Creates a history from a sequence of words.
+
+        :type words: list of ints and strs
+        :param words: the words in the history, possibly empty
+
+        :rtype: WordHistory
+        :returns: the last element of the linked list, or ``None`` if
+                  ``words`` is empty
+        """
+
+        result = None
+        for word in words:
+            result = classname(word, result)
+        return result
+
+    def append(self, word):
+        """Creates a new history that contains the words in this history
+        followed by ``word``.
+
+        :type word: int or str
+        :param word: the word to append
+
+        :rtype: WordHistory
+        :returns: the new history
+        """
+
+        return WordHistory(word, self)
+
+    def last_words(self, count=None):
+        """Returns the last words of the history.
+
+        :type count: int
+        :param count: number of words to return, or ``None`` for the entire
+                      history
+
+        :rtype: tuple of ints and strs
+        :returns: at most ``count`` last words, in the original order
+        """
+
+        if count is None:
+            count = self._length
+        result = []
+        history = self
+        while (not history is None) and (len(result) < count):
+            result.append(history.word)
+            history = history.previous
+        result.reverse()
+        return tuple(result)
+
+    def hash(self, order=None):
+        """Returns a hash of the last words of the history.
+
+        :type order: int
+        :param order: number of words to include in the hash, or ``None`` for
+                      the entire history
+
+        :rtype: int
+        :returns: a hash value that is equal for equal histories
+        """
+
+        if order is None:
+            return self._full_hash
+        if self._hash_order != order:
+            self._hash = hash(self.last_words(order))
+            self._hash_order = order
+        return self._hash
+
+    def __eq__(self, other):
+        """Checks whether two histories contain the same words.
+
+        :type other: WordHistory
+        :param other: another history
+
+        :rtype: bool
+        :returns: ``True`` if the histories contain the same words
+        """
+
+        if not isinstance(other, WordHistory):
+            return NotImplemented
+        if (self._full_hash != other._full_hash) or \
+           (self._length != other._length):
+            return False
+        history1 = self
+        history2 = other
+        # Both histories have the same length, so they reach None at the same
+        # time.
+        while not history1 is history2:
+            if history1.word != history2.word:
+                return False
+            history1 = history1.previous
+            history2 = history2.previous
+        return True
+
+    def __hash__(self):
+        """Returns the hash of the entire history.
+
+        :rtype: int
+        :returns: a hash value that is equal for equal histories
+        """
+
+        return self._full_hash
+
+    def __len__(self):
+        """Returns the number of words in the history.
+
+        :rtype: int
+        :returns: the number of words in the history
+        """
+
+        return self._length
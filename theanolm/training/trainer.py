@@ -483,9 +483,11 @@ class Trainer(object):
 
         self._local_perplexities.append(perplexity)
         if len(self._local_perplexities) == 1:
-            logging.debug("[%d] First validation sample, perplexity %.2f.",
+            logging.debug("[%d] First validation sample, perplexity %.2f, "
+                          "padding ratio %.3f.",
                           self.update_number,
-                          perplexity)
+                          perplexity,
+                          self._validation_iter.padding_ratio())
 
         # The rest of the function will be executed only at and after the center
         # of sampling points.
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import fcntl
+
+class WorkQueue(object):
+    """Work Queue on a Shared File System
+
+    Distributes work items dynamically between jobs that may be running on
+    different machines, using lock files in a shared directory. Every job
+    creates the queue from the same list of items, and iterates through the
+    items in the same order. An item is claimed by taking an exclusive lock on
+    its lock file. When the item has been processed, its result is written to a
+    completion marker, and the lock is released. Items that have a completion
+    marker are skipped, so a restarted job continues from where it was left.
+
+    An item whose lock is held by another job is skipped at first. When there
+    are no unclaimed items left, the job returns to the skipped items that
+    don't have a completion marker yet, and polls their locks until they are
+    either completed or the lock can be taken. The locks are released by the
+    operating system if a job dies, so the items that a dead job was processing
+    are retaken by the jobs that are still running. This requires that
+    ``flock()`` works on the shared file system. The results can be collected
+    by concatenating the completion markers, whose names sort in the order of
+    the item list.
+    """
+
+    def __init__(self, directory, items, order=None, poll_interval=10.0):
+        """Creates the queue directory if it doesn't exist.
+
+        :type directory: str
+        :param directory: path to a directory that is shared by all the jobs
+
+        :type items: list of strs
+        :param items: the work items; has to be identical in all the jobs
+
+        :type order: list of ints
+        :param order: indices of the items in the order they should be
+                      processed (default is the order of ``items``)
+
+        :type poll_interval: float
+        :param poll_interval: seconds to wait before checking again the items
+                              that are locked by other jobs
+        """
+
+        self.directory = directory
+        self.items = items
+        if order is None:
+            self.order = list(range(len(items)))
+        else:
+            self.order = order
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def __iter__(self):
+        """Claims the items that haven't been processed by any job.
+
+        The lock of an item is held until the next item is requested or the
+        iteration ends, so the caller should call ``complete()`` before that.
+        The iteration ends when every item has a completion marker.
+
+        :rtype: generator
+        :returns: a generator of (index, item) tuples
+        """
+
+        pending = self.order
+        while True:
+            locked = []
+            claimed = False
+            for index in pending:
+                if self.is_completed(index):
+                    continue
+                lock_file = self._try_lock(index)
+                if lock_file is None:
+                    locked.append(index)
+                    continue
+                claimed = True
+                try:
+                    # Another job may have completed the item after we checked.
+                    if not self.is_completed(index):
+                        yield index, self.items[index]
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    lock_file.close()
+            # The items that were locked are being processed by other jobs,
+            # unless a job has died after claiming an item.
+            pending = [index for index in locked
+                       if not self.is_completed(index)]
+            if not pending:
+                break
+            if not claimed:
+                time.sleep(self.poll_interval)
+
+    def is_completed(self, index):
+        """Checks whether an item has been processed.
+
+        :type index: int
+        :param index: index of the item in the item list
+
+        :rtype: bool
+        :returns: ``True`` if the completion marker of the item exists
+        """
+
+        return os.path.exists(self._path(index, 'done'))
+
+    def complete(self, index, result):
+        """Writes the completion marker of an item.
+
+        The result is first written to a temporary file, which is then renamed,
+        so that a partially written marker is never seen by other jobs.
+
+        :type index: int
+        :param index: index of the item in the item list
+
+        :type result: str
+        :param result: the result of processing the item, stored in the marker
+        """
+
+        path = self._path(index, 'done')
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as marker_file:
+            marker_file.write(result)
+            marker_file.flush()
+            os.fsync(marker_file.fileno())
+        os.rename(temp_path, path)
+
+    def _try_lock(self, index):
+        """Tries to take an exclusive lock on the lock file of an item.
+
+        :type index: int
+        :param index: index of the item in the item list
+
+        :rtype: file object
+        :returns: the opened lock file if the lock was taken, ``None`` if
+                  another job holds the lock
+        """
+
+        lock_file = open(self._path(index, 'lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _path(self, index, extension):
+        """Returns the path to a lock file or a completion marker.
+
+        The file names are the zero-padded indices of the items, so the
+        completion markers sort in the order of the item list.
+
+        :type index: int
+        :param index: index of the item in the item list
+
+        :type extension: str
+        :param extension: "lock" or "done"
+
+        :rtype: str
+        :returns: path to the file
+        """
+
+        return os.path.join(self.directory,
+                            '{:08d}.{}'.format(index, extension))